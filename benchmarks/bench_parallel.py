@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Scaling benchmark of the shared-memory parallel functions of utilities (interp_ragged_parallel and pair_statistics_parallel, see
+# 'Shared-memory parallel functions' in utilities.py) from 1 to N processes, on synthetic profiles and pairs.
+#
+# python benchmarks/bench_parallel.py                                  # 1, 2, 4, ... processes up to the number of CPUs
+# python benchmarks/bench_parallel.py --processes 1 8 16 32 --profiles 200000 --pairs 100000 --repeat 3
+#
+# For each number of processes, the median time of 'repeat' runs is reported with the speedup and the parallel efficiency relative to 1 process,
+# and the results are compared with the results of 1 process: they must be identical (the exit status is 1 otherwise).
+# The serial functions (interp_ragged, pair_statistics) are timed as well, as the reference.
+
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import utilities
+
+PLEV = np.arange(10,212,2)
+
+
+# **make_profiles**, **make_pairs**
+#
+# Synthetic ragged profiles (pres, values, offsets as from parse_into_arrays, with some -999) and pairs of profiles on PLEV (before, after, mask).
+def make_profiles(n,seed=0):
+    rng = np.random.default_rng(seed)
+    counts  = rng.integers(0, 200, n)
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+    pres    = np.concatenate([np.sort(rng.uniform(0, 1000, c)) for c in counts])
+    values  = 30 - pres/50 + rng.normal(0, 0.5, len(pres))
+    values[rng.uniform(size=len(values)) < 0.01] = -999
+    return pres, values, offsets
+
+def make_pairs(n,seed=0):
+    rng = np.random.default_rng(seed)
+    before = 20 + np.cumsum(rng.normal(0, 0.1, (n, len(PLEV))), axis=1)
+    after  = before + rng.normal(0, 0.5, (n, len(PLEV)))
+    before[rng.uniform(size=before.shape) < 0.01] = np.nan
+    mask = utilities.pair_mask(rng.uniform(20, 160, n), rng.uniform(-1, 1, n))
+    return before, after, mask
+
+
+# **median_time**
+#
+# Median time of 'repeat' runs of run() and the output of the last run.
+def median_time(run,repeat=3):
+    seconds = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        out = run()
+        seconds.append(time.perf_counter()-start)
+    return float(np.median(seconds)), out
+
+def same(a,b):
+    if isinstance(a, dict):
+        return list(a) == list(b) and all(np.array_equal(a[key], b[key], equal_nan=True) for key in a)
+    return np.array_equal(a, b, equal_nan=True)
+
+
+# **run_scaling**
+#
+# Time the parallel interpolation and pair statistics for each number of processes; returns the results (one dictionary per stage and number of processes).
+def run_scaling(processes,n_profiles,n_pairs,repeat=3,chunk_size=None):
+    (pres, values, offsets) = make_profiles(n_profiles)
+    (before, after, mask) = make_pairs(n_pairs)
+    stages = {'interpolate':     (lambda p: utilities.interp_ragged_parallel(pres, values, offsets, PLEV, processes=p, chunk_size=chunk_size),
+                                  lambda: utilities.interp_ragged(pres, values, offsets, PLEV), n_profiles, 'profiles'),
+              'pair_statistics': (lambda p: utilities.pair_statistics_parallel(before, after, PLEV, mask=mask, processes=p, chunk_size=chunk_size),
+                                  lambda: utilities.pair_statistics(before, after, PLEV, mask=mask), int(mask.sum()), 'pairs')}
+    results = []
+    for (stage, (parallel, serial, items, unit)) in stages.items():
+        (serial_seconds, _) = median_time(serial, repeat)
+        print('{:<16} serial        {:>9.3f} s'.format(stage, serial_seconds), flush=True)
+        reference = None
+        for p in processes:
+            (seconds, out) = median_time(lambda: parallel(p), repeat)
+            if reference is None:
+                (reference, base) = (out, seconds)
+            result = {'stage': stage, 'processes': p, 'seconds': seconds, 'serial_seconds': serial_seconds, 'items': items, 'unit': unit,
+                      'throughput': items/seconds, 'speedup': base/seconds, 'efficiency': base/seconds/(p/processes[0]), 'identical': same(out, reference)}
+            results.append(result)
+            print('{stage:<16} {processes:>3} processes {seconds:>9.3f} s  {throughput:>12.0f} {unit}/s  speedup {speedup:>5.2f}  '
+                  'efficiency {efficiency:>4.0%}  identical {identical}'.format(**result), flush=True)
+    return results
+
+
+def main():
+    cpus = os.cpu_count() or 1
+    parser = argparse.ArgumentParser(description='Scaling of the shared-memory parallel functions of utilities with the number of processes')
+    parser.add_argument('--processes', nargs='+', type=int, default=sorted(set([2**k for k in range(cpus.bit_length()) if 2**k <= cpus] + [cpus])))
+    parser.add_argument('--profiles', type=int, default=50000)
+    parser.add_argument('--pairs', type=int, default=50000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--chunk-size', type=int, default=None, help='rows per shard (default: utilities.PARALLEL_CHUNK_SIZE)')
+    parser.add_argument('--output', help='write the results to this json file')
+    args = parser.parse_args()
+
+    results = run_scaling(args.processes, args.profiles, args.pairs, repeat=args.repeat, chunk_size=args.chunk_size)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'cpus': cpus, 'results': results}, f, indent=1)
+    different = [result for result in results if not result['identical']]
+    for result in different:
+        print('{stage}: results with {processes} processes differ from the results with {first} processes'.format(first=args.processes[0], **result))
+    return 1 if different else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
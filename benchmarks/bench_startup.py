@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Startup benchmark of utilities: time 'import utilities' in fresh interpreters and check that the data core 
+# does not load the heavy dependencies (they are imported on first use, see 'Lazy imports' in utilities.py).
+# 
+# python benchmarks/bench_startup.py [--repeat 7] [--max-seconds 2.0] [--star]
+# 
+# --star also times 'from utilities import *' (as in the notebooks, which loads the plotting layer as well).
+# The exit status is 1 when the median import time is above --max-seconds or a heavy module is loaded by 'import utilities'.
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ['scipy', 'matplotlib', 'cartopy', 'svgpath2mpl']
+
+PROBE = """
+import sys, time, json, resource
+start = time.perf_counter()
+{statement}
+seconds = time.perf_counter() - start
+print(json.dumps({{'seconds': seconds, 
+                  'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024, 
+                  'heavy': [m for m in {heavy} if m in sys.modules]}}))
+"""
+
+# **time_import**
+# 
+# Run 'statement' in 'repeat' fresh interpreters; returns the list of results (seconds, peak memory in MB, heavy modules loaded).
+def time_import(statement,repeat=7):
+    code = PROBE.format(statement=statement, heavy=HEAVY_MODULES)
+    env = dict(os.environ, PYTHONPATH=REPO_DIR+os.pathsep+os.environ.get('PYTHONPATH', ''))
+    results = []
+    for i in range(repeat):
+        out = subprocess.run([sys.executable, '-c', code], env=env, cwd=REPO_DIR, capture_output=True, text=True, check=True)
+        results.append(json.loads(out.stdout.strip().splitlines()[-1]))
+    return results
+
+def report(statement,results):
+    seconds = sorted(r['seconds'] for r in results)
+    median  = seconds[len(seconds)//2]
+    print('{:<28} median {:.3f} s (min {:.3f} s, max {:.3f} s), peak memory {:.0f} MB, heavy modules loaded: {}'.format(
+        statement, median, seconds[0], seconds[-1], max(r['max_rss_mb'] for r in results), ', '.join(results[0]['heavy']) or 'none'))
+    return median
+
+def main():
+    parser = argparse.ArgumentParser(description='Import time of utilities')
+    parser.add_argument('--repeat', type=int, default=7)
+    parser.add_argument('--max-seconds', type=float, default=2.0)
+    parser.add_argument('--star', action='store_true', help="also time 'from utilities import *'")
+    args = parser.parse_args()
+    
+    # warm up the file system cache
+    time_import('import utilities', repeat=1)
+    results = time_import('import utilities', repeat=args.repeat)
+    median  = report('import utilities', results)
+    if args.star:
+        report('from utilities import *', time_import('from utilities import *', repeat=args.repeat))
+    
+    failed = False
+    if results[0]['heavy']:
+        print('FAIL: import utilities loads ' + ', '.join(results[0]['heavy']))
+        failed = True
+    if median > args.max_seconds:
+        print('FAIL: import utilities takes {:.3f} s (> {:.3f} s)'.format(median, args.max_seconds))
+        failed = True
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
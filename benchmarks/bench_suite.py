@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Benchmark suite of the utilities stages (fetch, parse, interpolate, co-locate, track maps, sea ice, pair statistics, profile store) against the stub server
+# of benchmarks/fixtures.py, at several data sizes.
+#
+# python benchmarks/bench_suite.py                           # all stages at 1x, 10x and 100x
+# python benchmarks/bench_suite.py --scales 1 10 --stages parse_into_df parse_into_df_plev --repeat 10
+# python benchmarks/bench_suite.py --save-baseline           # store the results as the baseline (benchmarks/baseline.json)
+#
+# Each stage is run once to warm up, then 'repeat' times: latency percentiles (p50, p90, p99) and throughput (items per second at the median latency)
+# are computed from these runs, and peak memory (allocated by Python, tracemalloc) from one more run. The response cache is off, so that each
+# query goes through the stub server. Results are compared with the baseline (if any): a stage is flagged when its median latency or its
+# peak memory is more than --tolerance above the baseline, and the exit status is then 1. The baseline depends on the machine, hence it should
+# be recorded (--save-baseline) on the machine used for the comparisons.
+
+import os
+import io
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import tracemalloc
+import contextlib
+import numpy as np
+import pandas as pd
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+import utilities
+from fixtures import load_fixtures, scale_fixtures, StubServer, REGION
+
+BASELINE_PATH = os.path.join(BENCH_DIR, 'baseline.json')
+PLEV = np.arange(10,212,2)
+
+
+# **Stages**
+#
+# Each stage is a function of the benchmark context (server, scaled fixtures, data fetched once) returning a function without arguments
+# that runs the stage once and returns the number of items processed (e.g. profiles or measurements), and the unit of the items.
+def stage_fetch_selection(ctx):
+    shape = utilities.box_shape(*REGION['lon'], *REGION['lat'])
+    end = str(pd.Timestamp(REGION['start'])+pd.Timedelta(days=REGION['days']))[0:10]
+    return (lambda: len(utilities.get_selection_profiles(REGION['start'], end, shape, printUrl=False))), 'profiles'
+
+def stage_parse_into_df(ctx):
+    profiles = ctx['selection']
+    return (lambda: len(utilities.parse_into_df(profiles))), 'measurements'
+
+def stage_fetch_platform(ctx):
+    platform_number = str(ctx['fixtures']['platform'][0]['_id']).split('_')[0]
+    return (lambda: len(utilities.get_platform_profiles(platform_number))), 'profiles'
+
+def stage_parse_into_df_plev(ctx):
+    profiles = ctx['platform']
+    return (lambda: len(utilities.parse_into_df_plev(profiles, PLEV))), 'profiles'
+
+def stage_fetch_tracks(ctx):
+    end = str(pd.Timestamp(REGION['start'])+pd.Timedelta(days=REGION['days']))[0:10]
+    return (lambda: len(utilities.get_TCs_byDate(REGION['start'], end))), 'storms'
+
+def stage_colocate(ctx):
+    # the storms of one season (the 1x storms), co-located with the profiles of the scaled selection (map_TC_and_Argo without the map)
+    tracks = [pd.DataFrame(track['traj_data']) for track in ctx['fixtures']['tracks'][0:15]]
+    def run():
+        for df in tracks:
+            utilities.colocate_TC_and_Argo(df, 10, 2, 2, '[0,200]')
+        return sum(len(df) for df in tracks)
+    return run, 'track points'
+
+def stage_parse_into_df_SeaIce(ctx):
+    window = ctx['sea_ice']
+    return (lambda: len(utilities.parse_into_df_SeaIce(window))), 'grid cells'
+
+def stage_sample_sea_ice(ctx):
+    rng = np.random.default_rng(0)
+    n = 100*ctx['scale']
+    lons = rng.uniform(-38, -22, n)
+    lats = rng.uniform(-69, -61, n)
+    dates = pd.Timestamp('2013-08-15') + pd.to_timedelta(rng.integers(0, 10, n), 'D')
+    return (lambda: int(np.isfinite(utilities.sample_SOSE_sea_ice(lons, lats, dates)).sum())), 'positions'
+
+def stage_pair_statistics(ctx):
+    rng = np.random.default_rng(0)
+    n = 1000*ctx['scale']
+    before = 20 + np.cumsum(rng.normal(0, 0.1, (n, len(PLEV))), axis=1)
+    after = before + rng.normal(0, 0.5, (n, len(PLEV)))
+    before[rng.uniform(size=before.shape) < 0.01] = np.nan
+    wind = rng.uniform(20, 160, n)
+    angle = rng.uniform(-1, 1, n)
+    return (lambda: len(utilities.pair_statistics(before, after, PLEV, mask=utilities.pair_mask(wind, angle))['pairs'])), 'pairs'
+
+def stage_store_append(ctx):
+    profiles = ctx['selection']
+    def run():
+        with tempfile.TemporaryDirectory() as store_dir:
+            utilities.store_append_profiles(profiles, store_dir=store_dir)
+        return len(profiles)
+    return run, 'profiles'
+
+def stage_store_read(ctx):
+    store_dir = ctx['store_dir']
+    if not os.path.isdir(os.path.join(store_dir, 'profiles')):
+        utilities.store_append_profiles(ctx['selection'], store_dir=store_dir)
+    where = {'lat': (15, 25), 'lon': (-70, -60)}
+    return (lambda: len(utilities.store_read_df('profiles', where=where, store_dir=store_dir))), 'measurements'
+
+def stage_plot_tracks(ctx):
+    # global map of all the storms (TC_and_storms_view), drawn on an Agg figure
+    import matplotlib
+    matplotlib.use('Agg')
+    import cartopy.crs as ccrs
+    from utilities_plotting import new_figure, plot_tracks_time_in_col
+    tracks = ctx['fixtures']['tracks']
+    def run():
+        fig = new_figure((15,15))
+        ax = fig.add_subplot(projection=ccrs.Mollweide())
+        ax.set_global()
+        plot_tracks_time_in_col(tracks, ax=ax)
+        fig.canvas.draw()
+        return sum(len(track['traj_data']) for track in tracks)
+    return run, 'track points'
+
+STAGES = {'fetch_selection':      stage_fetch_selection,
+          'parse_into_df':        stage_parse_into_df,
+          'fetch_platform':       stage_fetch_platform,
+          'parse_into_df_plev':   stage_parse_into_df_plev,
+          'fetch_tracks':         stage_fetch_tracks,
+          'colocate':             stage_colocate,
+          'plot_tracks':          stage_plot_tracks,
+          'parse_into_df_SeaIce': stage_parse_into_df_SeaIce,
+          'sample_sea_ice':       stage_sample_sea_ice,
+          'pair_statistics':      stage_pair_statistics,
+          'store_append':         stage_store_append,
+          'store_read':           stage_store_read}
+
+
+# **measure**
+#
+# Run a stage once to warm up, 'repeat' times to time it and once more (with tracemalloc) for its peak memory.
+def measure(run,unit,repeat=5):
+    with contextlib.redirect_stdout(io.StringIO()): # urls and keys printed by utilities
+        run()
+        seconds = []
+        for i in range(repeat):
+            start = time.perf_counter()
+            items = run()
+            seconds.append(time.perf_counter()-start)
+        tracemalloc.start()
+        run()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    (p50, p90, p99) = np.percentile(seconds, [50, 90, 99])
+    return {'items': items, 'unit': unit, 'repeat': repeat, 'p50': p50, 'p90': p90, 'p99': p99, 'min': min(seconds), 'max': max(seconds),
+            'throughput': items/p50 if p50 > 0 else None, 'peak_mb': peak/1024**2}
+
+
+# **run_suite**
+#
+# Run the stages at each scale; returns the results keyed by 'stage@scale'.
+def run_suite(stages,scales,repeat=5,seed=0):
+    utilities.CACHE_ENABLED = False
+    utilities.HTTP_RETRIES  = 0
+    base = load_fixtures(seed=seed)
+    results = {}
+    for scale in scales:
+        fixtures = scale_fixtures(base, scale)
+        server = StubServer(fixtures).start()
+        utilities.ARGOVIS_URL = server.url
+        with contextlib.redirect_stdout(io.StringIO()):
+            ctx = {'scale': scale, 'fixtures': fixtures, 'server': server,
+                   'selection': utilities.get_selection_profiles('1900-01-01', '2100-01-01', utilities.box_shape(-180, 180, -90, 90), printUrl=False),
+                   'platform': utilities.get_platform_profiles(str(fixtures['platform'][0]['_id']).split('_')[0]),
+                   'sea_ice': utilities.get_SOSE_sea_ice([-40, -20], [-70, -60], '2013-08-15')}
+        with tempfile.TemporaryDirectory() as store_dir:
+            ctx['store_dir'] = store_dir
+            for stage in stages:
+                (run, unit) = STAGES[stage](ctx)
+                result = measure(run, unit, repeat=repeat)
+                results['{}@{}x'.format(stage, scale)] = dict(result, stage=stage, scale=scale)
+                print('{:<22} {:>4}x  p50 {:>9.4f} s  p90 {:>9.4f} s  p99 {:>9.4f} s  {:>12.0f} {}/s  peak {:>8.1f} MB'.format(
+                    stage, scale, result['p50'], result['p90'], result['p99'], result['throughput'] or 0, unit, result['peak_mb']), flush=True)
+        server.shutdown()
+        server.server_close()
+    return results
+
+
+# **compare**
+#
+# Stages of 'results' slower (median latency) or using more memory (peak) than the baseline by more than 'tolerance' (e.g. 0.25 for 25%).
+def compare(results,baseline,tolerance=0.25,memory_tolerance=0.25):
+    regressions = []
+    for (key, result) in results.items():
+        if key not in baseline:
+            continue
+        base = baseline[key]
+        ratio = result['p50']/base['p50'] if base['p50'] > 0 else 1
+        mem_ratio = result['peak_mb']/base['peak_mb'] if base['peak_mb'] > 0 else 1
+        status = []
+        if ratio > 1+tolerance:
+            status.append('latency x{:.2f}'.format(ratio))
+        if mem_ratio > 1+memory_tolerance:
+            status.append('memory x{:.2f}'.format(mem_ratio))
+        print('{:<28} p50 {:>9.4f} s (baseline {:>9.4f} s, x{:.2f})  peak {:>8.1f} MB (baseline {:>8.1f} MB)  {}'.format(
+            key, result['p50'], base['p50'], ratio, result['peak_mb'], base['peak_mb'], 'REGRESSION: '+', '.join(status) if status else 'ok'))
+        if status:
+            regressions.append(key)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks of the utilities stages against a local stub server')
+    parser.add_argument('--stages', nargs='+', choices=list(STAGES), default=list(STAGES))
+    parser.add_argument('--scales', nargs='+', type=int, default=[1, 10, 100])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the results to this json file')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true', help='save the results as the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='latency increase flagged as a regression (0.25 = 25%%)')
+    parser.add_argument('--memory-tolerance', type=float, default=0.25)
+    args = parser.parse_args()
+
+    results = run_suite(args.stages, args.scales, repeat=args.repeat, seed=args.seed)
+    report = {'meta': {'date': pd.Timestamp.now().isoformat(), 'python': platform.python_version(), 'numpy': np.__version__,
+                       'pandas': pd.__version__, 'machine': platform.platform(), 'processor': platform.processor()},
+              'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+    if args.save_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)['results']
+        baseline.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(dict(report, results=baseline), f, indent=1)
+        print('baseline saved to ' + args.baseline)
+        return 0
+    if not os.path.exists(args.baseline):
+        print('no baseline (' + args.baseline + '), run with --save-baseline to record one')
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)['results']
+    regressions = compare(results, baseline, args.tolerance, args.memory_tolerance)
+    print('{} regressions'.format(len(regressions)))
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Parity checks of the optimized code paths of utilities against the plain ones, on the fixtures of benchmarks/fixtures.py (served by the stub server).
+#
+# python benchmarks/check_parity.py                  # all the checks at 1x
+# python benchmarks/check_parity.py --scale 3 --checks colocate
+#
+# Each check prints its differences (if any) and the exit status is 1 if a check finds one.
+
+import os
+import io
+import sys
+import copy
+import argparse
+import contextlib
+import numpy as np
+import pandas as pd
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+import utilities
+from fixtures import load_fixtures, scale_fixtures, StubServer, _profile
+
+
+# **frame_differences**
+#
+# Differences between two data frames (columns and their order, dtypes, index and values; nan equal to nan), as a list of messages.
+def frame_differences(expected,actual):
+    if list(expected.columns) != list(actual.columns):
+        return ['columns {} != {}'.format(list(expected.columns), list(actual.columns))]
+    try:
+        pd.testing.assert_frame_equal(expected, actual)
+    except AssertionError as err:
+        return [str(err).splitlines()[0]]
+    return []
+
+
+# **check_profile_arrays**
+#
+# parse_into_df (and parse_into_arrays) of profile arrays equal to parse_into_df of the list of profiles, for profiles without BGC (platform history),
+# with BGC (selection) and for subsets (take_profiles).
+def check_profile_arrays(ctx):
+    differences = []
+    for (name, profiles) in (('platform', ctx['fixtures']['platform']), ('selection', ctx['fixtures']['selection']),
+                             ('selection without BGC', [p for p in ctx['fixtures']['selection'] if 'containsBGC' not in p])):
+        arrays = utilities.profile_arrays(copy.deepcopy(profiles))
+        differences += [name+': '+d for d in frame_differences(utilities.parse_into_df(profiles), utilities.parse_into_df(arrays))]
+        rows = np.arange(0, len(profiles), 3)
+        differences += [name+' (subset): '+d for d in frame_differences(utilities.parse_into_df([profiles[i] for i in rows]),
+                                                                        utilities.parse_into_df(utilities.take_profiles(arrays, rows)))]
+    return differences
+
+
+# **colocate_per_point**
+#
+# The plain co-location of map_TC_and_Argo (two queries by date per track point, without the map): prof_beforeTC and prof_afterTC.
+def colocate_per_point(df, delta_days, dx, dy, presRange):
+    prof_beforeTC = []
+    prof_afterTC  = []
+    dti = pd.to_datetime(df['timestamp'])
+    for i in range(len(df['lon'])):
+        for (startDate, endDate, prof_list) in ((str(dti[i]-pd.Timedelta(days=delta_days))[0:10], str(dti[i])[0:10], prof_beforeTC),
+                                                (str(dti[i])[0:10], str(dti[i]+pd.Timedelta(days=delta_days))[0:10], prof_afterTC)):
+            shape = utilities.box_shape(df['lon'][i]-dx/2, df['lon'][i]+dx/2, df['lat'][i]-dy/2, df['lat'][i]+dy/2)
+            selectionProfiles = utilities.get_selection_profiles(startDate, endDate, shape, str(presRange), printUrl=False)
+            if len(selectionProfiles) > 0 and not isinstance(selectionProfiles,str):
+                selectionDf = utilities.parse_into_df(selectionProfiles)
+                selectionDf.replace(-999, np.nan, inplace=True)
+                prof_list.append(dict(list(selectionDf.groupby(by='profile_id'))))
+            else:
+                prof_list.append([])
+    return prof_beforeTC, prof_afterTC
+
+
+# **item_differences**
+#
+# Differences between two items of prof_beforeTC/prof_afterTC: profile ids and, for each profile, the values of its data frame. The rows are compared 
+# in order (not by index, which depends on the other profiles of the query), as well as the columns that are not all nan (e.g. containsBGC of profiles without BGC).
+def item_differences(expected,actual):
+    if sorted(map(str, dict(expected))) != sorted(map(str, dict(actual))):
+        return ['profiles {} != {}'.format(sorted(map(str, dict(expected))), sorted(map(str, dict(actual))))]
+    differences = []
+    for tag_id in sorted(dict(expected)):
+        (e, a) = (frame.dropna(axis=1, how='all').reset_index(drop=True) for frame in (expected[tag_id], actual[tag_id]))
+        try:
+            pd.testing.assert_frame_equal(e, a[list(e.columns)] if set(e.columns) == set(a.columns) else a, check_dtype=False)
+        except AssertionError as err:
+            differences.append('{}: {}'.format(tag_id, str(err).splitlines()[0]))
+    return differences
+
+
+# **check_colocate**
+#
+# colocate_TC_and_Argo (data frames and compact=True) equal to the per-point co-location of map_TC_and_Argo, track point by track point, for the storms of the fixtures.
+def check_colocate(ctx,delta_days=10,dx=2,dy=2,presRange='[0,200]'):
+    differences = []
+    for track in ctx['fixtures']['tracks'][0:15]:
+        df = pd.DataFrame(track['traj_data'])
+        expected = colocate_per_point(df, delta_days, dx, dy, presRange)
+        actual = utilities.colocate_TC_and_Argo(df, delta_days, dx, dy, presRange, strict=True)
+        (arrays, before_rows, after_rows) = utilities.colocate_TC_and_Argo(df, delta_days, dx, dy, presRange, strict=True, compact=True)
+        compact = ([utilities.colocated_profiles(arrays, rows) for rows in before_rows], [utilities.colocated_profiles(arrays, rows) for rows in after_rows])
+        for (name, result) in (('', actual), (' (compact)', compact)):
+            for (window, e_items, a_items) in (('before', expected[0], result[0]), ('after', expected[1], result[1])):
+                if len(e_items) != len(a_items):
+                    differences.append('{} {}{}: {} track points != {}'.format(track['_id'], window, name, len(e_items), len(a_items)))
+                    continue
+                for i in range(len(e_items)):
+                    differences += ['{} {}{} point {}: {}'.format(track['_id'], window, name, i, d) for d in item_differences(e_items[i], a_items[i])]
+    return differences
+
+
+# **check_colocate_dateline**
+#
+# colocate_TC_and_Argo (boxes and radius_km) equal to a search over all the profiles, for a storm crossing the dateline, one staying just west of it 
+# (its profiles east of the dateline are only found if its boxes wrap) and one near the North Pole (boxes of the whole range of longitudes), on profiles around them served by a second stub server: the profile ids of each track point are compared.
+def check_colocate_dateline(ctx,delta_days=10,dx=2,dy=2,radius_km=200,presRange='[0,200]'):
+    rng = np.random.default_rng(1)
+    start = pd.Timestamp('2017-08-20')
+    times = start + pd.to_timedelta(np.arange(40)*6, 'h')
+    tracks = [pd.DataFrame({'lon': (170 + np.arange(40)*0.5 + 180) % 360 - 180, 'lat': 15 + np.arange(40)*0.1, 'timestamp': times.strftime('%Y-%m-%dT%H:%M:%S')}),
+              pd.DataFrame({'lon': 179 + 0.8*np.sin(np.arange(40)/6), 'lat': 15 + np.arange(40)*0.1, 'timestamp': times.strftime('%Y-%m-%dT%H:%M:%S')}),
+              pd.DataFrame({'lon': (np.arange(40)*9.0 + 180) % 360 - 180, 'lat': np.full(40, 88.5), 'timestamp': times.strftime('%Y-%m-%dT%H:%M:%S')})]
+    profiles = []
+    for (k, (lon_range, lat_range)) in enumerate((((165, 195), (10, 22)), ((-180, 180), (86, 90)))):
+        for i in range(400):
+            date = start + pd.Timedelta(days=rng.uniform(-12, 22))
+            profiles.append(_profile(rng, '{}_{}'.format(5900000+10*k+i//100, i), i, (rng.uniform(*lon_range)+180) % 360 - 180, rng.uniform(*lat_range), date, 5))
+    server = StubServer(dict(ctx['fixtures'], selection=profiles)).start()
+    (url, utilities.ARGOVIS_URL) = (utilities.ARGOVIS_URL, server.url)
+    prof_lon = np.array([p['lon'] for p in profiles])
+    prof_lat = np.array([p['lat'] for p in profiles])
+    prof_date = utilities.to_utc_naive([p['date'] for p in profiles]).to_numpy()
+    prof_id = np.array([p['_id'] for p in profiles])
+    differences = []
+    try:
+        for (name, df) in zip(('dateline', 'west of dateline', 'pole'), tracks):
+            dti = utilities.to_utc_naive(df['timestamp'])
+            windows = {'before': ((dti-pd.Timedelta(days=delta_days)).floor('D'), dti.floor('D')), 'after': (dti.floor('D'), (dti+pd.Timedelta(days=delta_days)).floor('D'))}
+            for radius in (None, radius_km):
+                result = utilities.colocate_TC_and_Argo(df, delta_days, dx, dy, presRange, radius_km=radius, strict=True)
+                for i in range(len(df)):
+                    if radius is None:
+                        near = (np.abs((prof_lon-df['lon'][i]+180) % 360 - 180) <= dx/2) & (np.abs(prof_lat-df['lat'][i]) <= dy/2)
+                    else:
+                        near = utilities.haversine_km(df['lon'][i], df['lat'][i], prof_lon, prof_lat) <= radius
+                    for (w, items) in zip(('before', 'after'), result):
+                        expected = sorted(map(str, prof_id[near & utilities.query_dates_mask(prof_date, windows[w][0][i].to_datetime64(), windows[w][1][i].to_datetime64())]))
+                        actual = sorted(map(str, dict(items[i])))
+                        if expected != actual:
+                            differences.append('{} radius_km={} {} point {}: profiles {} != {}'.format(name, radius, w, i, expected, actual))
+    finally:
+        utilities.ARGOVIS_URL = url
+        server.shutdown()
+        server.server_close()
+    return differences
+
+
+CHECKS = {'profile_arrays': check_profile_arrays, 'colocate': check_colocate, 'colocate_dateline': check_colocate_dateline}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Parity checks of the optimized code paths of utilities')
+    parser.add_argument('--checks', nargs='+', choices=list(CHECKS), default=list(CHECKS))
+    parser.add_argument('--scale', type=int, default=1)
+    args = parser.parse_args()
+
+    utilities.CACHE_ENABLED = False
+    fixtures = scale_fixtures(load_fixtures(), args.scale)
+    server = StubServer(fixtures).start()
+    utilities.ARGOVIS_URL = server.url
+    ctx = {'fixtures': fixtures, 'server': server}
+    failed = 0
+    for check in args.checks:
+        with contextlib.redirect_stdout(io.StringIO()): # urls and keys printed by utilities
+            differences = CHECKS[check](ctx)
+        print('{:<20} {}'.format(check, 'ok' if not differences else '{} differences'.format(len(differences))))
+        for difference in differences[0:20]:
+            print('    ' + difference)
+        failed += bool(differences)
+    server.shutdown()
+    server.server_close()
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Argovis responses for the benchmarks, served by a local stub server (StubServer) so that benchmarks do not depend on the network or on Argovis.
+#
+# The data are generated (deterministic, see make_fixtures) or replayed from responses recorded from Argovis (python benchmarks/fixtures.py --record,
+# saved in benchmarks/fixtures/), and scaled by replicating the profiles, storms and grid cells 'scale' times (new IDs, shifted dates and positions).
+# The stub server answers the queries used by utilities: selections of profiles (filtered by date and box), platform histories, single profiles,
+# TC tracks (by date range and by name and year) and SOSE sea-ice windows.
+
+import os
+import sys
+import json
+import gzip
+import argparse
+import threading
+import urllib.parse
+import http.server
+import socketserver
+import numpy as np
+import pandas as pd
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+# queries recorded from Argovis by --record (name: url path and query)
+RECORDED_QUERIES = {'selection': '/selection/profiles?startDate=2017-09-01&endDate=2017-09-30&shape=[[[-80,10],[-80,30],[-50,30],[-50,10],[-80,10]]]&presRange=[0,200]',
+                    'platform':  '/catalog/platforms/4902911',
+                    'tracks':    '/tc/findByDateRange?startDate=2017-08-15T00:00:00&endDate=2017-10-15T00:00:00',
+                    'sea_ice':   '/griddedProducts/nonUniformGrid/window?gridName=sose_si_area_1_day_sparse&presLevel=0&latRange=[-70,-60]&lonRange=[-40,-20]&date=2013-08-15'}
+
+# area and period of the synthetic data (a hurricane season in the North Atlantic)
+REGION = {'lon': (-80., -50.), 'lat': (10., 30.), 'start': '2017-08-15', 'days': 60}
+
+
+def _profile(rng,profile_id,cycle,lon,lat,date,n_levels,bgc=False):
+    pres = np.sort(rng.uniform(2, 2000, n_levels)).round(1)
+    temp = (28*np.exp(-pres/300) + 2 + rng.normal(0, 0.1, n_levels)).round(3)
+    psal = (35 + 0.5*np.exp(-pres/500) + rng.normal(0, 0.01, n_levels)).round(3)
+    profile = {'_id': profile_id, 'platform_number': profile_id.split('_')[0], 'cycle_number': int(cycle),
+               'lat': float(lat), 'lon': float(lon), 'date': pd.Timestamp(date).strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+               'position_qc': 1, 'date_qc': 1, 'BASIN': 1, 'dac': 'aoml', 'station_parameters': ['pres', 'temp', 'psal'],
+               'measurements': [{'pres': float(p), 'temp': float(t), 'psal': float(s)} for (p, t, s) in zip(pres, temp, psal)]}
+    if bgc:
+        profile['containsBGC'] = True
+        profile['bgcMeas'] = [{'pres': float(p), 'pres_qc': 1, 'temp': float(t), 'temp_qc': 1, 'psal': float(s), 'psal_qc': 1,
+                               'doxy': float(200+p/20), 'doxy_qc': 1, 'chla': float(np.exp(-p/50)), 'chla_qc': 1}
+                              for (p, t, s) in zip(pres[::4], temp[::4], psal[::4])]
+    return profile
+
+
+# **make_fixtures**
+#
+# Synthetic responses at 1x: 'selection' (300 profiles in REGION: 50 floats, one profile every 10 days), 'platform' (the history of one float, 100 cycles),
+# 'tracks' (15 storms of the season) and 'sea_ice' (one SOSE window, 60 x 60 cells), with 'source' = 'synthetic'. 'seed' makes the data reproducible.
+def make_fixtures(seed=0):
+    rng = np.random.default_rng(seed)
+    start = pd.Timestamp(REGION['start'])
+    selection = []
+    for k in range(50):
+        (lon, lat) = (rng.uniform(*REGION['lon']), rng.uniform(*REGION['lat']))
+        for cycle in range(int(REGION['days']//10)):
+            date = start + pd.Timedelta(days=10*cycle + rng.uniform(0, 10))
+            (lon, lat) = (lon + rng.normal(0, 0.2), lat + rng.normal(0, 0.2))
+            selection.append(_profile(rng, '{}_{}'.format(4900000+k, cycle), cycle, lon, lat, date, int(rng.integers(40, 80)), bgc=(k % 10 == 0)))
+    platform = []
+    (lon, lat) = (-60., 20.)
+    for cycle in range(100):
+        (lon, lat) = (lon + rng.normal(0, 0.2), lat + rng.normal(0, 0.2))
+        platform.append(_profile(rng, '4902911_{}'.format(cycle), cycle, lon, lat, pd.Timestamp('2013-01-01') + pd.Timedelta(days=10*cycle),
+                                 int(rng.integers(40, 80))))
+    tracks = []
+    for k in range(15):
+        n = int(rng.integers(20, 60))
+        times = start + pd.Timedelta(days=rng.uniform(0, REGION['days']-15)) + pd.to_timedelta(np.arange(n)*6, 'h')
+        lon = rng.uniform(-60, -40) - np.cumsum(rng.uniform(0.2, 0.8, n))
+        lat = rng.uniform(10, 18) + np.cumsum(rng.uniform(0, 0.4, n))
+        wind = np.clip(30 + 120*np.sin(np.linspace(0, np.pi, n)) + rng.normal(0, 5, n), 20, 160).round()
+        tracks.append({'_id': 'AL{:02d}2017'.format(k+1), 'name': 'storm{}'.format(k+1), 'year': 2017, 'num': k+1, 'source': ['synthetic'],
+                       'traj_data': [{'lon': float(x), 'lat': float(y), 'wind': float(w), 'pres': float(1010-w/2), 'timestamp': t.strftime('%Y-%m-%dT%H:%M:%S'),
+                                      'date': t.strftime('%Y-%m-%dT%H:%M:%S'), 'class': 'HU' if w >= 64 else 'TS'} for (x, y, w, t) in zip(lon, lat, wind, times)]})
+    (glon, glat) = np.meshgrid(np.arange(-40, -20, 1/3), np.arange(-70, -60, 1/6))
+    keep = rng.uniform(size=glon.shape) < 0.7 # the SOSE grid is sparse
+    sea_ice = [{'_id': 'sose_si_area_1_day_sparse-2013-08-15', 'gridName': 'sose_si_area_1_day_sparse', 'date': '2013-08-15T00:00:00.000Z',
+                'data': [{'lon': float(x), 'lat': float(y), 'value': float(np.clip(1-(y+70)/12 + rng.normal(0, 0.05), 0, 1))}
+                         for (x, y) in zip(glon[keep], glat[keep])]}]
+    return {'selection': selection, 'platform': platform, 'tracks': tracks, 'sea_ice': sea_ice, 'source': 'synthetic'}
+
+
+# **load_fixtures**
+#
+# Responses recorded by --record if they are in fixtures_dir (all four of them), synthetic ones (make_fixtures) otherwise.
+def load_fixtures(fixtures_dir=FIXTURES_DIR,seed=0):
+    paths = {name: os.path.join(fixtures_dir, name+'.json.gz') for name in RECORDED_QUERIES}
+    if all(os.path.exists(path) for path in paths.values()):
+        fixtures = {}
+        for (name, path) in paths.items():
+            with gzip.open(path, 'rt') as f:
+                fixtures[name] = json.load(f)
+        fixtures['source'] = 'recorded'
+        return fixtures
+    return make_fixtures(seed)
+
+
+# **scale_fixtures**
+#
+# Replicate the responses 'scale' times: profiles and storms get new IDs (the copies are shifted by a few days and tenths of a degree),
+# the platform history gets more cycles and the SOSE window more cells (the grid is refined).
+def scale_fixtures(fixtures,scale=1):
+    rng = np.random.default_rng(scale)
+    out = {'source': fixtures['source'], 'scale': scale}
+    def shifted(profile, copy, cycle=None):
+        p = dict(profile)
+        if copy:
+            (platform, cyc) = str(profile['_id']).split('_')[0:2]
+            p['_id'] = '{}{:03d}_{}'.format(platform, copy, cyc if cycle is None else cycle)
+            p['cycle_number'] = profile['cycle_number'] if cycle is None else cycle
+            p['lon'] = profile['lon'] + rng.uniform(-0.5, 0.5)
+            p['lat'] = profile['lat'] + rng.uniform(-0.5, 0.5)
+            p['date'] = (pd.Timestamp(profile['date']) + pd.Timedelta(hours=rng.uniform(-48, 48))).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+        return p
+    out['selection'] = [shifted(profile, copy) for copy in range(scale) for profile in fixtures['selection']]
+    n = len(fixtures['platform'])
+    out['platform'] = [dict(shifted(profile, 0), _id='{}_{}'.format(str(profile['_id']).split('_')[0], copy*n+i), cycle_number=copy*n+i)
+                       for copy in range(scale) for (i, profile) in enumerate(fixtures['platform'])]
+    out['tracks'] = [dict(track, _id=track['_id'][0:2]+'{:03d}'.format(copy)+track['_id'][2:], name=track.get('name', '')+str(copy) if copy else track.get('name', ''))
+                     for copy in range(scale) for track in fixtures['tracks']]
+    grid = fixtures['sea_ice'][0]
+    cells = [dict(cell, lon=cell['lon'] + copy*1e-3, lat=cell['lat']) for copy in range(scale) for cell in grid['data']]
+    out['sea_ice'] = [dict(grid, data=cells)]
+    return out
+
+
+# **StubServer**
+#
+# Local HTTP server answering Argovis queries from the (scaled) fixtures, in a background thread: server = StubServer(fixtures).start(), then
+# utilities.ARGOVIS_URL = server.url. Profiles are serialized once, so that serving a selection costs little compared with the client side.
+class StubServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self,fixtures,port=0):
+        super().__init__(('127.0.0.1', port), _StubHandler)
+        selection = fixtures['selection']
+        self.profiles_json = [json.dumps(profile).encode() for profile in selection]
+        self.profiles_index = {str(profile['_id']): i for (i, profile) in enumerate(selection)}
+        self.lon  = np.array([profile['lon'] for profile in selection])
+        self.lat  = np.array([profile['lat'] for profile in selection])
+        self.date = pd.DatetimeIndex(pd.to_datetime([profile['date'] for profile in selection], utc=True)).tz_localize(None).to_numpy()
+        self.platform_json = json.dumps(fixtures['platform']).encode()
+        self.platform = str(fixtures['platform'][0]['_id']).split('_')[0] if fixtures['platform'] else ''
+        self.tracks   = fixtures['tracks']
+        self.sea_ice_json = json.dumps(fixtures['sea_ice']).encode()
+        self.requests = 0
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server_address[1])
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    # as Argovis: startDate and endDate ('yyyy-mm-dd') are read as 00:00 UTC of that day and both are included,
+    # i.e. the profiles of the endDate day after 00:00 are not returned
+    def select(self,query):
+        shape = json.loads(query['shape'][0])[0]
+        (xs, ys) = ([point[0] for point in shape], [point[1] for point in shape])
+        start = np.datetime64(pd.Timestamp(query['startDate'][0]))
+        end   = np.datetime64(pd.Timestamp(query['endDate'][0]))
+        ind = np.flatnonzero((self.lon >= min(xs)) & (self.lon <= max(xs)) & (self.lat >= min(ys)) & (self.lat <= max(ys)) &
+                             (self.date >= start) & (self.date <= end))
+        return b'[' + b','.join(self.profiles_json[i] for i in ind) + b']'
+
+    def tracks_by_date(self,query):
+        start = query['startDate'][0][0:19]
+        end   = query['endDate'][0][0:19]
+        return json.dumps([track for track in self.tracks
+                           if any(start <= point['timestamp'][0:19] <= end for point in track['traj_data'])]).encode()
+
+    def tracks_by_name(self,query):
+        return json.dumps([track for track in self.tracks
+                           if str(track.get('name', '')).lower() == query['name'][0].lower() and str(track.get('year')) == query['year'][0]]).encode()
+
+
+class _StubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        server.requests += 1
+        url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        try:
+            if url.path == '/selection/profiles':
+                body = server.select(query)
+            elif url.path.startswith('/catalog/platforms/'):
+                body = server.platform_json if url.path.rsplit('/', 1)[1] == server.platform else b'[]'
+            elif url.path.startswith('/catalog/profiles/'):
+                i = server.profiles_index.get(urllib.parse.unquote(url.path.rsplit('/', 1)[1]))
+                body = server.profiles_json[i] if i is not None else b'null'
+            elif url.path == '/tc/findByDateRange':
+                body = server.tracks_by_date(query)
+            elif url.path == '/tc/findByNameYear':
+                body = server.tracks_by_name(query)
+            elif url.path == '/griddedProducts/nonUniformGrid/window':
+                body = server.sea_ice_json
+            else:
+                self.send_response(404)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+        except (KeyError, ValueError):
+            self.send_response(400)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self,*args):
+        pass
+
+
+# **record_fixtures**
+#
+# Query Argovis (argovis_url) for RECORDED_QUERIES and save the responses in fixtures_dir, to be replayed by load_fixtures.
+def record_fixtures(argovis_url='https://argovis.colorado.edu',fixtures_dir=FIXTURES_DIR):
+    import requests
+    os.makedirs(fixtures_dir, exist_ok=True)
+    for (name, query) in RECORDED_QUERIES.items():
+        resp = requests.get(argovis_url+query, timeout=(10, 300))
+        resp.raise_for_status()
+        with gzip.open(os.path.join(fixtures_dir, name+'.json.gz'), 'wt') as f:
+            json.dump(resp.json(), f)
+        print('{}: {} bytes'.format(name, len(resp.content)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Record Argovis responses for the benchmarks, or serve the fixtures with the stub server')
+    parser.add_argument('--record', action='store_true', help='record RECORDED_QUERIES from Argovis into benchmarks/fixtures/')
+    parser.add_argument('--argovis-url', default='https://argovis.colorado.edu')
+    parser.add_argument('--serve', type=int, metavar='SCALE', help='serve the fixtures at this scale until interrupted')
+    parser.add_argument('--port', type=int, default=8000)
+    args = parser.parse_args()
+    if args.record:
+        record_fixtures(args.argovis_url)
+    elif args.serve:
+        server = StubServer(scale_fixtures(load_fixtures(), args.serve), port=args.port)
+        print('serving on ' + server.url + ' (ARGOVIS_URL=' + server.url + ')')
+        server.serve_forever()
+    else:
+        parser.print_help()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Batch co-location of Argo profiles with the tropical cyclones of a season (or of a list of storms), without plotting.
+#
+# python colocate_season.py --start 2018-07-01 --end 2018-09-30 --processes 4
+# python colocate_season.py --storms maria:2017 irma:2017 --delta-days 7 --dx 2 --dy 2
+#
+# Storms are co-located with colocate_TC_and_Argo in a pool of processes. Each storm is saved to out_dir/storms/<storm id>.pkl as soon as it is done
+# (prof_beforeTC, prof_afterTC and the track, see load_storm), with its report in out_dir/storms/<storm id>.json. Running the same command again
+# (e.g. after a crash or a network failure) skips the storms already done and retries the ones that failed (--force to redo all of them).
+# A summary of the run (pairs found, time spent and errors for each storm) is written to out_dir/summary.json and the exit status is 1 if a storm failed.
+
+import os
+import sys
+import json
+import time
+import pickle
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import pandas as pd
+
+from utilities import TC_and_storms_view, get_track_for_storm, colocate_TC_and_Argo
+
+# **storm_jobs**
+#
+# One job per storm: (storm id, track) for the TCs between start and end (as TC_and_storms_view), or (name:year, None) for storms given by name and year
+# (the track is then fetched by the worker with get_track_for_storm).
+def storm_jobs(start=None,end=None,storms=None):
+    if storms:
+        return [(storm, None) for storm in storms]
+    TCs = TC_and_storms_view(start, end, tag_TC_or_SH_FILT='TC', create_figure=False)
+    if isinstance(TCs, str):
+        raise RuntimeError(TCs)
+    jobs = []
+    for x in TCs:
+        track = pd.DataFrame(x['traj_data'])
+        track['_id'] = x['_id']
+        jobs.append((x['_id'], track))
+    return jobs
+
+
+def _storm_file(out_dir,storm,ext):
+    return os.path.join(out_dir, 'storms', storm.replace(':', '_').replace(os.sep, '_')+ext)
+
+def _write_atomic(path,write,mode='w'):
+    tmp = path+'.tmp-'+str(os.getpid())
+    with open(tmp, mode) as f:
+        write(f)
+    os.replace(tmp, path)
+
+
+# **colocate_storm**
+#
+# Co-locate one storm (a job of storm_jobs) and save it; returns the report of the storm (also saved as json).
+def colocate_storm(job,out_dir,delta_days,dx,dy,presRange,radius_km=None):
+    (storm, track) = job
+    start = time.perf_counter()
+    report = {'storm': storm, 'status': 'failed', 'seconds': None, 'track_points': 0,
+              'profiles_before': 0, 'profiles_after': 0, 'pairs': 0, 'error': ''}
+    try:
+        if track is None:
+            (name, year) = storm.split(':')
+            track = get_track_for_storm(name, year)
+        (prof_beforeTC, prof_afterTC) = colocate_TC_and_Argo(track, delta_days, dx, dy, presRange, radius_km=radius_km, strict=True)
+        _write_atomic(_storm_file(out_dir, storm, '.pkl'),
+                      lambda f: pickle.dump({'storm': storm, 'track': track, 'prof_beforeTC': prof_beforeTC, 'prof_afterTC': prof_afterTC}, f,
+                                            protocol=pickle.HIGHEST_PROTOCOL), mode='wb')
+        report.update({'status': 'done', 'track_points': len(track),
+                       'profiles_before': len(set(tag_id for x in prof_beforeTC for tag_id in x)),
+                       'profiles_after': len(set(tag_id for y in prof_afterTC for tag_id in y)),
+                       'pairs': sum(1 for (x, y) in zip(prof_beforeTC, prof_afterTC) if any(x) and any(y))})
+    except Exception as err:
+        report['error'] = '{}: {}'.format(type(err).__name__, err)
+    report['seconds'] = time.perf_counter()-start
+    _write_atomic(_storm_file(out_dir, storm, '.json'), lambda f: json.dump(report, f))
+    return report
+
+
+# **load_storm**
+#
+# Load a storm saved by colocate_storm: a dictionary with storm, track, prof_beforeTC and prof_afterTC.
+def load_storm(out_dir,storm):
+    with open(_storm_file(out_dir, storm, '.pkl'), 'rb') as f:
+        return pickle.load(f)
+
+
+# report of a storm done in a previous run (None if it was not done)
+def _done_report(out_dir,storm):
+    try:
+        with open(_storm_file(out_dir, storm, '.json')) as f:
+            report = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if report.get('status') != 'done' or not os.path.exists(_storm_file(out_dir, storm, '.pkl')):
+        return None
+    return report
+
+
+# **run_season**
+#
+# Co-locate the storms of 'jobs' (see storm_jobs) in 'processes' processes (processes=1 runs in the current process), skipping the storms
+# done in a previous run in out_dir (unless force=True). Returns the summary (also saved in out_dir/summary.json).
+def run_season(jobs,out_dir,delta_days=7,dx=2,dy=2,presRange='[0,100]',radius_km=None,processes=None,force=False,args=None):
+    os.makedirs(os.path.join(out_dir, 'storms'), exist_ok=True)
+    start = time.perf_counter()
+    reports = {}
+    todo = []
+    for job in jobs:
+        report = None if force else _done_report(out_dir, job[0])
+        if report is not None:
+            report['resumed'] = True
+            reports[job[0]] = report
+        else:
+            todo.append(job)
+    print('{} storms, {} done in a previous run, {} to co-locate'.format(len(jobs), len(jobs)-len(todo), len(todo)))
+    kwargs = dict(out_dir=out_dir, delta_days=delta_days, dx=dx, dy=dy, presRange=presRange, radius_km=radius_km)
+    if processes == 1 or len(todo) <= 1:
+        for job in todo:
+            reports[job[0]] = colocate_storm(job, **kwargs)
+            _print_report(reports[job[0]])
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            futures = {pool.submit(colocate_storm, job, **kwargs): job for job in todo}
+            for future in as_completed(futures):
+                storm = futures[future][0]
+                try:
+                    reports[storm] = future.result()
+                except Exception as err: # e.g. a worker killed
+                    reports[storm] = {'storm': storm, 'status': 'failed', 'error': '{}: {}'.format(type(err).__name__, err)}
+                _print_report(reports[storm])
+    storms = [reports[job[0]] for job in jobs]
+    done = [report for report in storms if report['status'] == 'done']
+    summary = {'arguments': args or {},
+               'storms': storms,
+               'n_storms': len(storms),
+               'n_done': len(done),
+               'n_failed': len(storms)-len(done),
+               'n_resumed': sum(1 for report in storms if report.get('resumed')),
+               'pairs': sum(report['pairs'] for report in done),
+               'profiles_before': sum(report['profiles_before'] for report in done),
+               'profiles_after': sum(report['profiles_after'] for report in done),
+               'seconds': time.perf_counter()-start,
+               'failed': {report['storm']: report['error'] for report in storms if report['status'] != 'done'}}
+    _write_atomic(os.path.join(out_dir, 'summary.json'), lambda f: json.dump(summary, f, indent=1))
+    return summary
+
+def _print_report(report):
+    if report['status'] == 'done':
+        print('{storm}: {pairs} pairs, {profiles_before} profiles before and {profiles_after} after the TC ({seconds:.1f} s)'.format(**report))
+    else:
+        print('{}: failed ({})'.format(report['storm'], report['error']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Co-locate Argo profiles with the tropical cyclones of a season')
+    parser.add_argument('--start', help="first day, 'yyyy-mm-dd'")
+    parser.add_argument('--end', help="last day, 'yyyy-mm-dd'")
+    parser.add_argument('--storms', nargs='+', help='storms as name:year, e.g. maria:2017 (instead of --start/--end)')
+    parser.add_argument('--delta-days', type=float, default=7)
+    parser.add_argument('--dx', type=float, default=2)
+    parser.add_argument('--dy', type=float, default=2)
+    parser.add_argument('--pres-range', default='[0,100]')
+    parser.add_argument('--radius-km', type=float, default=None)
+    parser.add_argument('--processes', type=int, default=None, help='number of processes (default: number of CPUs)')
+    parser.add_argument('--out-dir', default='./ColocationRuns/')
+    parser.add_argument('--force', action='store_true', help='co-locate again the storms done in a previous run')
+    args = parser.parse_args()
+    if not args.storms and not (args.start and args.end):
+        parser.error('either --storms or --start and --end are required')
+
+    jobs = storm_jobs(args.start, args.end, args.storms)
+    summary = run_season(jobs, args.out_dir, delta_days=args.delta_days, dx=args.dx, dy=args.dy, presRange=args.pres_range,
+                         radius_km=args.radius_km, processes=args.processes, force=args.force, args=vars(args))
+    print('{n_done} of {n_storms} storms done ({n_resumed} from a previous run, {n_failed} failed), {pairs} pairs, {seconds:.1f} s'.format(**summary))
+    print('summary: ' + os.path.join(args.out_dir, 'summary.json'))
+    return 1 if summary['n_failed'] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,44 +2,648 @@
 # -*- coding: utf-8 -*-
 
 # Data manipulation
+import os
+import json
+import atexit
+import gzip
+import codecs
+import time
+import random
+import hashlib
+import threading
+import functools
+import contextlib
+import urllib.parse
 import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from multiprocessing import shared_memory
 import numpy as np
 import pandas as pd
-from scipy import interpolate
 from itertools import compress
 from datetime import datetime
 from datetime import timedelta  
 
-# Visualizations
-import matplotlib
-import matplotlib.pylab as plt
-from matplotlib import cm
-import matplotlib.dates as mdates
-import cartopy.crs as ccrs
-import cartopy.feature as cft
-from cartopy.mpl.gridliner import LONGITUDE_FORMATTER, LATITUDE_FORMATTER
-
-from svgpath2mpl import parse_path
+# Heavy dependencies (scipy, matplotlib, cartopy, svgpath2mpl) are imported on first use, see 'Lazy imports' at the end of this file.
 
 #prevent warnings from showing on screen
 import warnings
 warnings.filterwarnings('ignore')
 
 
+# #### Instrumentation functions
+# ---
+# Time spent in each stage (fetch, decode, parse, interpolate, co-locate, plot, ...) and counters (requests, bytes, retries, cache hits, profiles and rows parsed, 
+# figures rendered, ...) are recorded when tracing is on: set TRACE_ENABLED=True (or ARGOVIS_TRACE=1), or use the context manager 'tracing', e.g.:
+# 
+# with tracing('trace.jsonl'):       # spans are also written to trace.jsonl, one JSON object per line
+#     prof_beforeTC,prof_afterTC = colocate_TC_and_Argo(df, delta_days, dx, dy, presRange)
+# trace_report()                     # {'timers': {'fetch': {'count': ..., 'seconds': ..., 'max': ...}, ...}, 'counters': {'http.requests': ..., ...}}
+# 
+# Each timed stage is a span (name, start, seconds, parent span, thread, process and attributes). When tracing is off, trace_span and trace_count return at once.
+TRACE_ENABLED   = os.environ.get('ARGOVIS_TRACE', '0') == '1'
+TRACE_FILE      = os.environ.get('ARGOVIS_TRACE_FILE') # JSON lines file for the spans (None: spans are only kept in memory)
+TRACE_MAX_SPANS = 100000 # spans kept in memory (the most recent ones)
+
+_trace_lock     = threading.Lock()
+_trace_local    = threading.local()
+_trace_counters = {}
+_trace_timers   = {}
+_trace_spans    = []
+_trace_ids      = iter(range(1, 2**63))
+_no_span        = contextlib.nullcontext()
+_trace_blocks   = []   # (token, path) of the tracing blocks running, and the settings before the first one
+_trace_before   = None
+_trace_files    = {}   # one open handle per span file, written under _trace_file_lock (not _trace_lock)
+_trace_file_lock = threading.Lock()
+
+# **trace_count**
+# 
+# Add n to counter 'name' (when tracing is on).
+def trace_count(name,n=1):
+    if not TRACE_ENABLED:
+        return
+    with _trace_lock:
+        _trace_counters[name] = _trace_counters.get(name, 0) + n
+
+
+# **trace_time**
+# 
+# Add a duration (seconds) measured elsewhere to timer 'name' (when tracing is on), e.g. the time spent on a figure in a worker process.
+def trace_time(name,seconds):
+    if not TRACE_ENABLED:
+        return
+    with _trace_lock:
+        timer = _trace_timers.setdefault(name, [0, 0., 0.])
+        timer[0] += 1
+        timer[1] += seconds
+        timer[2]  = max(timer[2], seconds)
+
+
+@contextlib.contextmanager
+def _span(name,attrs):
+    stack = _trace_local.__dict__.setdefault('stack', [])
+    path = TRACE_FILE
+    span_id = next(_trace_ids)
+    parent  = stack[-1] if stack else None
+    stack.append(span_id)
+    start_time = time.time()
+    start = time.perf_counter()
+    error = None
+    try:
+        yield attrs
+    except BaseException as err:
+        error = type(err).__name__
+        raise
+    finally:
+        seconds = time.perf_counter()-start
+        stack.pop()
+        trace_time(name, seconds)
+        record = {'span': span_id, 'parent': parent, 'name': name, 'start': start_time, 'seconds': seconds, 
+                  'pid': os.getpid(), 'thread': threading.get_ident()}
+        if attrs:
+            record['attrs'] = attrs
+        if error:
+            record['error'] = error
+        with _trace_lock:
+            _trace_spans.append(record)
+            if len(_trace_spans) > TRACE_MAX_SPANS:
+                del _trace_spans[:len(_trace_spans)-TRACE_MAX_SPANS]
+        if path:
+            _trace_write(path, json.dumps(record, default=str)+'\n')
+
+# spans are written to a (line buffered) handle kept open per file, closed by _trace_close at the end of a tracing block and at exit
+def _trace_write(path,line):
+    with _trace_file_lock:
+        f = _trace_files.get(path)
+        if f is None:
+            f = _trace_files[path] = open(path, 'a', buffering=1)
+        f.write(line)
+
+def _trace_close(keep=None):
+    with _trace_file_lock:
+        for path in list(_trace_files):
+            _trace_files[path].flush()
+            if path != keep:
+                _trace_files.pop(path).close()
+
+# forked processes (e.g. ProcessPoolExecutor workers) open their own handles, with a new lock
+def _trace_reset_files():
+    global _trace_files, _trace_file_lock
+    _trace_files     = {}
+    _trace_file_lock = threading.Lock()
+
+atexit.register(_trace_close)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_trace_reset_files)
+
+# **trace_span**
+# 
+# Context manager timing a stage: with trace_span('parse', profiles=len(profiles)): ... (keyword arguments are stored with the span). 
+# The dictionary of attributes is returned, so that attributes known at the end can be added (with trace_span(...) as attrs: attrs['rows'] = n).
+def trace_span(name,**attrs):
+    if not TRACE_ENABLED:
+        return _no_span
+    return _span(name, attrs)
+
+
+# **traced**
+# 
+# Decorator timing every call of a function as a span named 'name' (default: the function name).
+def traced(name=None):
+    def decorator(func):
+        span_name = name or func.__name__
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not TRACE_ENABLED:
+                return func(*args, **kwargs)
+            with _span(span_name, {}):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# **tracing**
+# 
+# Context manager turning tracing on (from a clean state, see trace_reset) in a block of code, and writing the spans to 'path' (JSON lines) if given.
+# The settings before the block are restored at the end; the report is still available with trace_report. Blocks may be nested or run in several threads 
+# (e.g. around fetch_json_batch calls): tracing stays on until the last block ends, and spans go to the file of the most recent block still running 
+# (each span is written to the file set when it started).
+@contextlib.contextmanager
+def tracing(path=None,reset=True):
+    global TRACE_ENABLED, TRACE_FILE, _trace_before
+    token = object()
+    if reset:
+        trace_reset()
+    with _trace_lock:
+        if not _trace_blocks:
+            _trace_before = (TRACE_ENABLED, TRACE_FILE)
+        _trace_blocks.append((token, path))
+        TRACE_ENABLED = True
+        TRACE_FILE = path if path is not None else TRACE_FILE
+    try:
+        yield
+    finally:
+        with _trace_lock:
+            _trace_blocks[:] = [block for block in _trace_blocks if block[0] is not token]
+            if not _trace_blocks:
+                (TRACE_ENABLED, TRACE_FILE) = _trace_before
+            else:
+                TRACE_FILE = next((p for (t, p) in reversed(_trace_blocks) if p is not None), _trace_before[1])
+            keep = TRACE_FILE
+        _trace_close(keep)
+
+
+# **trace_report**
+# 
+# Timers (number of calls, total and maximum seconds) and counters recorded so far. If path is given, the report is also appended 
+# as one JSON line to that file (e.g. after the spans written by tracing).
+def trace_report(path=None):
+    with _trace_lock:
+        report = {'timers': {name: {'count': timer[0], 'seconds': timer[1], 'max': timer[2]} for (name, timer) in sorted(_trace_timers.items())},
+                  'counters': dict(sorted(_trace_counters.items())),
+                  'spans': len(_trace_spans)}
+    if path is not None:
+        _trace_close(TRACE_FILE)
+        with open(path, 'a') as f:
+            f.write(json.dumps({'report': report})+'\n')
+    return report
+
+
+# **trace_spans**
+# 
+# Spans recorded so far (most recent TRACE_MAX_SPANS), as a list of dictionaries.
+def trace_spans():
+    with _trace_lock:
+        return list(_trace_spans)
+
+
+# **trace_reset**
+# 
+# Clear the timers, counters and spans.
+def trace_reset():
+    with _trace_lock:
+        _trace_counters.clear()
+        _trace_timers.clear()
+        del _trace_spans[:]
+
+
+# #### HTTP client functions
+# ---
+# All the Argovis queries below go through fetch_json_batch. Queries share a pool of keep-alive connections 
+# (so that the TCP/TLS handshake is paid once per connection rather than once per query), run concurrently 
+# (up to HTTP_MAX_WORKERS at a time), and are retried with exponential backoff and random jitter when the 
+# connection fails, times out or the server is busy (HTTP_RETRY_STATUS).
+# 
+# ARGOVIS_URL can be pointed to a different server, e.g. a local stand-in server for testing: 
+# utilities.ARGOVIS_URL = 'http://127.0.0.1:8000' (or set the ARGOVIS_URL environment variable).
+ARGOVIS_URL       = os.environ.get('ARGOVIS_URL', 'https://argovis.colorado.edu')
+HTTP_TIMEOUT      = (10, 120) # seconds, (connect, read)
+HTTP_RETRIES      = 3
+HTTP_BACKOFF      = 0.5 # seconds, doubled at each retry
+HTTP_MAX_WORKERS  = 8
+HTTP_RETRY_STATUS = (429, 500, 502, 503, 504)
+
+_session      = None
+_session_lock = threading.Lock()
+
+# **get_session**
+# 
+# Returns the requests.Session shared by all queries (created on first use). The connection pool holds up to HTTP_MAX_WORKERS connections per host.
+def get_session():
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_MAX_WORKERS)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _session = session
+    return _session
+
+# a forked process (e.g. a worker of a process pool) must not share the connections of its parent
+def _reset_session():
+    global _session, _session_lock
+    _session      = None
+    _session_lock = threading.Lock()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_session)
+
+
+# **http_get**
+# 
+# GET url with the shared session, retrying (after a random wait, growing exponentially) when the connection fails, times out or the status is in HTTP_RETRY_STATUS.
+# Returns the response (status 2xx) or an error string. With stream=True the body is not downloaded yet (see stream_json_items).
+def http_get(url,retries=None,timeout=None,stream=False):
+    if retries is None:
+        retries = HTTP_RETRIES
+    if timeout is None:
+        timeout = HTTP_TIMEOUT
+    for attempt in range(retries+1):
+        trace_count('http.requests')
+        try:
+            resp = get_session().get(url, timeout=timeout, stream=stream)
+        except (requests.ConnectionError, requests.Timeout) as err:
+            error = "Error: {}".format(err)
+        else:
+            # Consider any status other than 2xx an error
+            if resp.status_code // 100 == 2:
+                return resp
+            error = "Error: Unexpected response {}".format(resp)
+            resp.close()
+            if resp.status_code not in HTTP_RETRY_STATUS:
+                trace_count('http.errors')
+                return error
+        if attempt < retries:
+            # exponential backoff with full jitter, so that concurrent workers do not retry in lockstep
+            trace_count('http.retries')
+            time.sleep(random.uniform(0, HTTP_BACKOFF*2**attempt))
+    trace_count('http.errors')
+    return error
+
+
+# **fetch_json**
+# 
+# Query one url and return the decoded JSON response. 
+# 
+# As for the query functions below, a response with a status other than 2xx is returned as an error string ("Error: Unexpected response ..."); 
+# the same is done when the connection still fails after 'retries' attempts. Responses are read from (and stored in) the response cache, see cache_get.
+def fetch_json(url,retries=None,timeout=None):
+    data = cache_get(url)
+    if data is not _cache_miss:
+        return data
+    if CACHE_OFFLINE:
+        return "Error: No cached response for {} (offline mode)".format(url)
+    with trace_span('fetch'):
+        resp = http_get(url, retries=retries, timeout=timeout)
+        if isinstance(resp, str):
+            return resp
+        content = resp.content
+    trace_count('http.bytes', len(content))
+    with trace_span('decode'):
+        data = resp.json()
+    cache_put(url, content)
+    return data
+
+
+# **iter_json_array**
+# 
+# Decode a JSON array incrementally from an iterable of text chunks, yielding its items one at a time (so that only one item is held in memory, not the whole array).
+def iter_json_array(chunks):
+    decoder = json.JSONDecoder()
+    buf = ''
+    started = False
+    for chunk in chunks:
+        buf += chunk
+        pos = 0
+        while True:
+            while pos < len(buf) and buf[pos] in ' \t\r\n,':
+                pos += 1
+            if pos >= len(buf):
+                break
+            if not started:
+                if buf[pos] != '[':
+                    raise ValueError('Expected a JSON array, found {}'.format(buf[pos:pos+50]))
+                started = True
+                pos += 1
+                continue
+            if buf[pos] == ']':
+                return
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                break # the item is not complete yet
+            if end == len(buf) and not isinstance(item, (dict, list)):
+                break # e.g. a number that may continue in the next chunk
+            yield item
+            pos = end
+        buf = buf[pos:]
+    raise ValueError('The JSON array is not complete: {}'.format(buf[0:50]))
+
+
+# **stream_json_items**
+# 
+# Yield the items of the JSON array returned by url one at a time, reading the response in chunks of chunk_size bytes (from the response cache when possible). 
+# A response that is not in the cache yet is compressed into the cache while it is read. Raises RuntimeError if the query fails.
+def stream_json_items(url,chunk_size=2**20,retries=None,timeout=None):
+    path = cache_lookup(url)
+    if path is not None:
+        os.utime(path, (time.time(), os.stat(path).st_mtime))
+        _cache_count('hits')
+        _cache_count('bytes_read', os.path.getsize(path))
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            for item in iter_json_array(iter(lambda: f.read(chunk_size), '')):
+                yield item
+        return
+    if CACHE_OFFLINE:
+        raise RuntimeError("Error: No cached response for {} (offline mode)".format(url))
+    resp = http_get(url, retries=retries, timeout=timeout, stream=True)
+    if isinstance(resp, str):
+        raise RuntimeError(resp)
+    cache_file = cache_open(url) if CACHE_ENABLED else None
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    def chunks():
+        for content in resp.iter_content(chunk_size=chunk_size):
+            trace_count('http.bytes', len(content))
+            if cache_file is not None:
+                cache_file.write(content)
+            yield decoder.decode(content)
+    try:
+        for item in iter_json_array(chunks()):
+            yield item
+    except BaseException:
+        resp.close()
+        if cache_file is not None:
+            cache_file.close()
+            os.remove(cache_file.name)
+        raise
+    if cache_file is not None:
+        cache_close(url, cache_file)
+
+
+# **fetch_json_batch**
+# 
+# Query a list of urls concurrently and return the list of results (see fetch_json) in the same order as 'urls'.
+# 
+# max_workers sets the number of concurrent queries (default: HTTP_MAX_WORKERS). A single url is queried without starting any thread.
+@traced('fetch_batch')
+def fetch_json_batch(urls,max_workers=None,retries=None,timeout=None):
+    urls = list(urls)
+    if max_workers is None:
+        max_workers = HTTP_MAX_WORKERS
+    max_workers = max(1, min(max_workers, len(urls)))
+    trace_count('http.queries', len(urls))
+    if max_workers == 1:
+        return [fetch_json(url, retries=retries, timeout=timeout) for url in urls]
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        return list(pool.map(lambda url: fetch_json(url, retries=retries, timeout=timeout), urls))
+
+
+# #### Response cache functions
+# ---
+# Successful responses are stored on disk (gzip-compressed JSON, one file per query named after the hash of the normalized url), 
+# so that re-running a notebook over the same storms and dates reads the responses from disk instead of querying Argovis again.
+# 
+# CACHE_TTL sets how long responses are kept for each kind of query (in seconds, None for no expiration). For the prefixes of CACHE_TTL_FINAL, 
+# responses to queries that end long enough before the response was stored (endDate, or the season of 'year') never expire: the tracks of past seasons 
+# do not change, while the tracks of the active season are updated as long as the storms last. CACHE_MAX_BYTES is the size of 
+# the cache on disk (least recently used responses are removed first). With CACHE_OFFLINE=True (or ARGOVIS_OFFLINE=1) queries are only 
+# answered from the cache, whatever the age of the response. The cache is turned off with CACHE_ENABLED=False (or ARGOVIS_CACHE=0).
+CACHE_ENABLED   = os.environ.get('ARGOVIS_CACHE', '1') != '0'
+CACHE_OFFLINE   = os.environ.get('ARGOVIS_OFFLINE', '0') == '1'
+CACHE_DIR       = os.environ.get('ARGOVIS_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'argovis'))
+CACHE_MAX_BYTES = 2*1024**3
+CACHE_TTL = {'/tc/':                 86400,      # tracks of the active season
+             '/catalog/profiles/':   30*86400,
+             '/catalog/platforms/':  86400,      # active floats add a new cycle every ~10 days
+             '/selection/profiles':  7*86400,
+             '/griddedProducts/':    None}
+CACHE_TTL_DEFAULT = 86400
+CACHE_TTL_FINAL = {'/tc/': 30*86400} # seconds after the end of the query after which a response never expires
+
+_cache_lock  = threading.Lock()
+_cache_bytes = None # size of the cache on disk, computed at the first write
+_cache_stats = {'hits': 0, 'misses': 0, 'stale': 0, 'writes': 0, 'evictions': 0, 'bytes_read': 0, 'bytes_written': 0}
+_cache_miss  = object()
+
+# **cache_key**
+# 
+# Normalize the url (sorted query parameters, decoded values) and return its hash, used as the file name of the cached response.
+def cache_key(url):
+    parts = urllib.parse.urlsplit(url)
+    query = sorted(urllib.parse.parse_qsl(parts.query, keep_blank_values=True))
+    normalized = '{}://{}{}?{}'.format(parts.scheme, parts.netloc.lower(), parts.path.rstrip('/'), urllib.parse.urlencode(query))
+    return hashlib.sha256(normalized.encode()).hexdigest()
+
+# **cache_path**, **cache_ttl**
+# 
+# Path of the cached response for url, and how long (in seconds) the response is kept, from the first CACHE_TTL prefix matching the url path 
+# (None if the response, stored at the time 'stored', is final, see CACHE_TTL_FINAL).
+def cache_path(url):
+    key = cache_key(url)
+    return os.path.join(CACHE_DIR, key[0:2], key+'.json.gz')
+
+def cache_ttl(url,stored=None):
+    path = urllib.parse.urlsplit(url).path
+    for prefix in CACHE_TTL_FINAL:
+        if stored is not None and path.startswith(prefix):
+            end = cache_query_end(url)
+            if end is not None and stored - end > CACHE_TTL_FINAL[prefix]:
+                return None
+    for prefix in CACHE_TTL:
+        if path.startswith(prefix):
+            return CACHE_TTL[prefix]
+    return CACHE_TTL_DEFAULT
+
+# end of the period queried by url (seconds since the epoch, UTC): its endDate, or for a 'year' the end of June of the next year 
+# (the last southern hemisphere season named after it); None if the url has neither
+def cache_query_end(url):
+    query = dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(url).query))
+    try:
+        if 'endDate' in query:
+            return pd.Timestamp(query['endDate'][0:19]).timestamp()
+        if 'year' in query:
+            return pd.Timestamp(year=int(query['year'])+1, month=7, day=1).timestamp()
+    except ValueError:
+        pass
+    return None
+
+def _cache_count(name, n=1):
+    with _cache_lock:
+        _cache_stats[name] += n
+    trace_count('cache.'+name, n)
+
+
+# **cache_lookup**
+# 
+# Returns the path of the cached response for url, or None if there is none (or it is older than its TTL, unless in offline mode).
+def cache_lookup(url):
+    if not CACHE_ENABLED:
+        return None
+    path = cache_path(url)
+    try:
+        st = os.stat(path)
+    except OSError:
+        _cache_count('misses')
+        return None
+    ttl = cache_ttl(url, st.st_mtime)
+    if not CACHE_OFFLINE and ttl is not None and time.time()-st.st_mtime > ttl:
+        _cache_count('stale')
+        return None
+    return path
+
+
+# **cache_get**
+# 
+# Returns the cached response for url, or _cache_miss if there is none (see cache_lookup).
+def cache_get(url):
+    path = cache_lookup(url)
+    if path is None:
+        return _cache_miss
+    try:
+        st = os.stat(path)
+        with open(path, 'rb') as f:
+            content = f.read()
+        data = json.loads(gzip.decompress(content))
+    except (OSError, ValueError, EOFError):
+        # e.g. a file being replaced by another process or a truncated file
+        _cache_count('misses')
+        return _cache_miss
+    # the access time orders the responses for eviction, the modification time is the time the response was stored
+    os.utime(path, (time.time(), st.st_mtime))
+    _cache_count('hits')
+    _cache_count('bytes_read', len(content))
+    return data
+
+
+# **cache_put**
+# 
+# Store the (raw JSON) content of a response for url, then remove the least recently used responses if the cache is larger than CACHE_MAX_BYTES.
+def cache_put(url, content):
+    if not CACHE_ENABLED:
+        return
+    try:
+        f = cache_open(url)
+        f.write(content)
+    except OSError:
+        return
+    cache_close(url, f)
+
+
+# **cache_open**, **cache_close**
+# 
+# cache_open returns a gzip file to write the response for url to (a temporary file, so that readers never see a partial response); 
+# cache_close moves it in place of the cached response and evicts old responses if needed.
+def cache_open(url):
+    path = cache_path(url)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+    return gzip.open(tmp_path, 'wb', compresslevel=6)
+
+def cache_close(url, f):
+    global _cache_bytes
+    path = cache_path(url)
+    f.close()
+    try:
+        old_size = os.path.getsize(path) if os.path.exists(path) else 0
+        size = os.path.getsize(f.name)
+        os.replace(f.name, path)
+    except OSError:
+        return
+    _cache_count('writes')
+    _cache_count('bytes_written', size)
+    with _cache_lock:
+        if _cache_bytes is None:
+            _cache_bytes = sum(file_size for (file_path, file_size, atime) in _cache_files())
+        else:
+            _cache_bytes += size - old_size
+        if _cache_bytes > CACHE_MAX_BYTES:
+            _cache_bytes = cache_evict(int(0.9*CACHE_MAX_BYTES))
+
+def _cache_files():
+    files = []
+    for (root, dirs, names) in os.walk(CACHE_DIR):
+        for name in names:
+            if name.endswith('.json.gz'):
+                try:
+                    st = os.stat(os.path.join(root, name))
+                except OSError:
+                    continue
+                files.append((os.path.join(root, name), st.st_size, st.st_atime))
+    return files
+
+
+# **cache_evict**
+# 
+# Remove the least recently used responses until the cache is at most max_bytes large, and return the size of the cache.
+def cache_evict(max_bytes):
+    files = sorted(_cache_files(), key=lambda f: f[2])
+    total = sum(size for (path, size, atime) in files)
+    for (path, size, atime) in files:
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        _cache_stats['evictions'] += 1
+    return total
+
+
+# **cache_stats**
+# 
+# Returns the number of cache hits, misses, stale responses (older than their TTL), writes and evictions since the start of the session, and the bytes read and written.
+def cache_stats():
+    with _cache_lock:
+        return dict(_cache_stats)
+
+
+# **clear_cache**
+# 
+# Remove all the cached responses.
+def clear_cache():
+    global _cache_bytes
+    with _cache_lock:
+        cache_evict(0)
+        _cache_bytes = 0
+
+
 # **get_TCs_byNameYear**
 # 
 # Query Tropical Cyclone data by name ('tc_name') and year ('tc_year').
 # 
 # name format: e.g. 'maria', date format: 'yyyy-mm-dd'.
+# 
+# TCs_byNameYear_url returns the url of the query (e.g. to query several storms at once with fetch_json_batch).
+def TCs_byNameYear_url(tc_name,tc_year):
+    return ARGOVIS_URL+'/tc/findByNameYear?name='+tc_name+'&year='+str(tc_year) #2018-07-15
+
 def get_TCs_byNameYear(tc_name,tc_year):
-    url = 'https://argovis.colorado.edu/tc/findByNameYear?name='+tc_name+'&year='+str(tc_year) #2018-07-15
+    url = TCs_byNameYear_url(tc_name,tc_year)
     print(url)
-    resp = requests.get(url)
-    # Consider any status other than 2xx an error
-    if not resp.status_code // 100 == 2:
-        return "Error: Unexpected response {}".format(resp)
-    data = resp.json()
-    return data
+    return fetch_json_batch([url])[0]
 
 
 # **get_TCs_byDate**
@@ -47,15 +651,15 @@ def get_TCs_byNameYear(tc_name,tc_year):
 # Query Tropical Cyclones data by date ('startDate','endDate').
 # 
 # date format: 'yyyy-mm-dd'.
+# 
+# TCs_byDate_url returns the url of the query.
+def TCs_byDate_url(startDate,endDate):
+    return ARGOVIS_URL+'/tc/findByDateRange?startDate='+startDate+'T00:00:00&endDate='+endDate+'T00:00:00' #2018-07-15
+
 def get_TCs_byDate(startDate,endDate):
-    url = 'https://argovis.colorado.edu/tc/findByDateRange?startDate='+startDate+'T00:00:00&endDate='+endDate+'T00:00:00' #2018-07-15
+    url = TCs_byDate_url(startDate,endDate)
     print(url)
-    resp = requests.get(url)
-    # Consider any status other than 2xx an error
-    if not resp.status_code // 100 == 2:
-        return "Error: Unexpected response {}".format(resp)
-    data = resp.json()
-    return data
+    return fetch_json_batch([url])[0]
 
 # **get_track_for_storm**
 
@@ -67,48 +671,426 @@ def get_track_for_storm(tc_name='maria',tc_year='2017'):
     return df
 
 
-# **get_hurricane_marker**
-# 
-# Generates a hurricane marker for plotting.
-#
-# create a marker for tropical cyclones
-def get_hurricane_marker():
-    hurricane = parse_path("""M 188.79857,492.55018 L 180.09663,484.17671 L 188.57725,474.97463 
-     C 212.44187,449.07984 230.37031,423.34927 246.04359,392.5 
-     C 254.14781,376.5487 265.0005,350.78866 265.0005,347.50373 
-     C 265.0005,346.53236 263.21255,347.40666 259.7505,350.07094 
-     C 251.67361,356.28665 233.85001,364.64767 222.5005,367.54485 
-     C 204.24051,372.20605 178.92084,371.97166 159.45635,366.96123 
-     C 147.77122,363.95331 130.93184,355.3283 122.0005,347.77659 
-     C 95.11018,325.04006 81.65749,291.36529 81.74139,247 
-     C 81.78993,221.33674 85.91479,197.1747 94.55247,171.95714 
-     C 111.06665,123.74428 136.98179,82.210848 180.29075,34.54693 
-     L 185.6999,28.59386 L 189.6002,31.718323 
-     C 191.74536,33.436777 195.9159,37.308373 198.86805,40.32187 
-     L 204.23561,45.800955 L 193.66355,57.483549 
-     C 168.69038,85.080007 151.53704,109.91644 136.8182,139.79028 
-     C 130.67851,152.2516 118.91503,180.17836 119.52809,180.83739 
-     C 119.70071,181.02295 122.91512,178.62979 126.67122,175.51926 
-     C 144.84799,160.46658 171.06913,152.9127 200.0005,154.39429 
-     C 227.96505,155.82638 249.78837,164.40176 267.15103,180.78081 
-     C 291.49094,203.74185 302.41509,234.21538 302.36063,279 
-     C 302.33536,299.77768 300.97355,312.12979 296.41891,332.89349 
-     C 286.70405,377.18157 262.85893,424.36347 228.55502,467.17452 
-     C 219.26505,478.76833 199.25099,501.02345 198.17004,500.96183 
-     C 197.80179,500.94084 193.58463,497.15559 188.79857,492.55018 
-     z M 212.92994,343.99452 C 242.28307,336.85605 266.31414,312.68729 
-     273.9846,282.59004 C 276.76052,271.6979 276.75301,253.72727 273.96762,242 
-     C 266.78666,211.76606 241.98871,187.12253 211.5005,179.92186 
-     C 203.8953,178.12567 200.40831,177.86988 189.0005,178.27134 
-     C 173.93019,178.80168 167.30498,180.26871 156.08925,185.55888 
-     C 132.8924,196.50023 116.23621,216.81521 109.90648,241.88639 
-     C 108.09535,249.06004 107.84969,252.38603 108.2077,264.88639 
-     C 108.58615,278.10034 108.93262,280.39476 111.82513,288.842 
-     C 113.58452,293.98009 116.23139,300.28009 117.70707,302.842 
-     C 137.50495,337.21285 174.70639,353.29022 212.92994,343.99452 z""")
-    return hurricane
-hurricane = get_hurricane_marker()
-hurricane.vertices -= hurricane.vertices.mean()
+# **TC_and_storms_view**
+# 
+# Function to map all tropical cyclones for selected time window ('startDate' - 'endDate').
+# 
+# startDate, endDate: 'yyyy-mm-dd'.
+# 
+# tag_TC_or_SH_FILT = 'TC' to map TCs only.
+# 
+# This function has the capability to map tracks for Southern Hemisphere storms using tag_TC_or_SH_FILT = 'SH_FILT'. Nevertheless, the database for Southern Hemisphere storms is still in development. See Section 1.9.
+def TC_and_storms_view(startDate,endDate,tag_TC_or_SH_FILT='TC',create_figure=True):
+    TCs_Dict = get_TCs_byDate(startDate,endDate=endDate)
+    bool_list = [] 
+    for x in TCs_Dict:
+        if ('SH_FILT' in tag_TC_or_SH_FILT):
+            df_title = ' Southern Hemisphere storms intensity '
+            df_ctag = 'intensity'
+            bool_list.append('SH_FILT' in x['_id'])
+        else:
+            df_title = 'Tropical Cyclone tracks'
+            df_ctag = 'wind'
+            bool_list.append('SH_FILT' not in x['_id'])
+    output_select = list(compress(TCs_Dict, bool_list))
+    if create_figure:
+        from utilities_plotting import map_TC_tracks
+        map_TC_tracks(output_select,df_ctag,df_title,tag_TC_or_SH_FILT)
+    return output_select
+
+
+# #### Tropical cyclone catalogue functions
+# ---
+# The track points of all the storms in a time window are loaded once into a catalogue (a dictionary of arrays, one item per track point, 
+# with the index of the storm in catalogue['storm_id']), indexed with a KD-tree on the positions (as unit vectors, so that distances are great-circle distances), 
+# to find the storms near a position or the track points nearest to profiles without querying Argovis again.
+EARTH_RADIUS_KM = 6371.0
+
+# **lonlat_to_xyz**
+# 
+# Unit vectors (one row per position) for positions in degrees longitude and latitude.
+def lonlat_to_xyz(lon,lat):
+    lon = np.radians(np.asarray(lon, dtype=float))
+    lat = np.radians(np.asarray(lat, dtype=float))
+    return np.stack((np.cos(lat)*np.cos(lon), np.cos(lat)*np.sin(lon), np.sin(lat)), axis=-1)
+
+
+# **km_to_chord**
+# 
+# Distance between two unit vectors that are distance_km apart along a great circle.
+def km_to_chord(distance_km):
+    return 2*np.sin(np.minimum(np.asarray(distance_km, dtype=float)/EARTH_RADIUS_KM, np.pi)/2)
+
+
+# **get_TC_catalogue**
+# 
+# Load the tracks of all the storms between startDate and endDate ('yyyy-mm-dd') into a catalogue. Long time windows are queried one year at a time (concurrently).
+# 
+# The catalogue has one item per storm in 'storm_id' and 'SH_FILT' (True for Southern Hemisphere storms, see TC_and_storms_view) and one item per track point 
+# in 'storm' (index of the storm), 'lon', 'lat', 'time' and 'wind'; 'tree' is the KD-tree of the track point positions.
+def get_TC_catalogue(startDate,endDate):
+    return update_TC_catalogue(None,startDate,endDate)
+
+
+# **update_TC_catalogue**
+# 
+# Add the storms between startDate and endDate to a catalogue (e.g. a new season), without querying again the storms already in the catalogue 
+# (unless they are in the new time window, e.g. storms that were still active at the time of the last update, which are then replaced). Returns the updated catalogue.
+@traced('catalogue')
+def update_TC_catalogue(catalogue,startDate,endDate):
+    from scipy.spatial import cKDTree
+    start = pd.Timestamp(startDate)
+    end   = pd.Timestamp(endDate)
+    bounds = [start] + [pd.Timestamp(year=y, month=1, day=1) for y in range(start.year+1, end.year+1)] + [end]
+    urls = [TCs_byDate_url(str(t0)[0:10], str(t1)[0:10]) for (t0, t1) in zip(bounds[:-1], bounds[1:]) if t1 > t0]
+    storms = {}
+    for TCs_Dict in fetch_json_batch(urls):
+        if isinstance(TCs_Dict, str):
+            raise RuntimeError(TCs_Dict)
+        for x in TCs_Dict:
+            storms[x['_id']] = x
+    
+    storm_id = [] if catalogue is None else list(catalogue['storm_id'])
+    keep     = np.ones(len(storm_id), dtype=bool)
+    for (i, sid) in enumerate(storm_id):
+        keep[i] = sid not in storms
+    columns = {'storm': [], 'lon': [], 'lat': [], 'time': [], 'wind': []}
+    if catalogue is not None:
+        # renumber the storms that are kept
+        new_index = np.cumsum(keep)-1
+        kept = keep[catalogue['storm']]
+        columns['storm'].append(new_index[catalogue['storm'][kept]])
+        for key in ('lon', 'lat', 'time', 'wind'):
+            columns[key].append(catalogue[key][kept])
+    storm_id = [sid for (sid, k) in zip(storm_id, keep) if k]
+    for sid in storms:
+        traj = storms[sid]['traj_data']
+        columns['storm'].append(np.full(len(traj), len(storm_id), dtype=np.int32))
+        columns['lon'].append(np.array([p['lon'] for p in traj], dtype=np.float32))
+        columns['lat'].append(np.array([p['lat'] for p in traj], dtype=np.float32))
+        columns['time'].append(to_utc_naive([p['timestamp'] for p in traj]).to_numpy().astype('datetime64[s]'))
+        columns['wind'].append(np.array([p.get('wind', np.nan) for p in traj], dtype=np.float32))
+        storm_id.append(sid)
+    
+    catalogue = {'storm_id': np.array(storm_id, dtype=object),
+                 'SH_FILT':  np.array(['SH_FILT' in sid for sid in storm_id], dtype=bool)}
+    dtypes = {'storm': np.int32, 'lon': np.float32, 'lat': np.float32, 'time': 'datetime64[s]', 'wind': np.float32}
+    for key in columns:
+        catalogue[key] = np.concatenate(columns[key]).astype(dtypes[key]) if columns[key] else np.array([], dtype=dtypes[key])
+    catalogue['tree'] = cKDTree(lonlat_to_xyz(catalogue['lon'], catalogue['lat']).reshape(-1,3))
+    return catalogue
+
+
+# **save_TC_catalogue**, **load_TC_catalogue**
+# 
+# Save a catalogue to a .npz file and load it back (the KD-tree is built again when loading).
+def save_TC_catalogue(catalogue,path):
+    np.savez_compressed(path, **{key: (catalogue[key].astype(str) if key == 'storm_id' else catalogue[key]) 
+                                 for key in catalogue if key != 'tree'})
+
+def load_TC_catalogue(path):
+    from scipy.spatial import cKDTree
+    with np.load(path) as data:
+        catalogue = {key: data[key] for key in data.files}
+    catalogue['storm_id'] = catalogue['storm_id'].astype(object)
+    catalogue['tree'] = cKDTree(lonlat_to_xyz(catalogue['lon'], catalogue['lat']).reshape(-1,3))
+    return catalogue
+
+
+# **TC_track_points_near**
+# 
+# Index of the track points within radius_km of (lon, lat) and, if given, between startDate and endDate. 
+# tag_TC_or_SH_FILT = 'TC' (or 'SH_FILT') only keeps points of tropical cyclones (or Southern Hemisphere storms), as in TC_and_storms_view.
+def TC_track_points_near(catalogue,lon,lat,radius_km,startDate=None,endDate=None,tag_TC_or_SH_FILT=None):
+    ind = np.array(catalogue['tree'].query_ball_point(lonlat_to_xyz(lon, lat), km_to_chord(radius_km)), dtype=int)
+    mask = np.ones(len(ind), dtype=bool)
+    if startDate is not None:
+        mask &= catalogue['time'][ind] >= np.datetime64(pd.Timestamp(startDate), 's')
+    if endDate is not None:
+        mask &= catalogue['time'][ind] <= np.datetime64(pd.Timestamp(endDate), 's')
+    if tag_TC_or_SH_FILT is not None:
+        mask &= catalogue['SH_FILT'][catalogue['storm'][ind]] == ('SH_FILT' in tag_TC_or_SH_FILT)
+    return np.sort(ind[mask])
+
+
+# **TC_storms_near**
+# 
+# IDs of the storms with at least one track point within radius_km of (lon, lat) and, if given, between startDate and endDate (see TC_track_points_near).
+def TC_storms_near(catalogue,lon,lat,radius_km,startDate=None,endDate=None,tag_TC_or_SH_FILT=None):
+    ind = TC_track_points_near(catalogue,lon,lat,radius_km,startDate,endDate,tag_TC_or_SH_FILT)
+    return list(catalogue['storm_id'][np.unique(catalogue['storm'][ind])])
+
+
+# **TC_nearest_track_point**
+# 
+# For each position (lons, lats, e.g. of Argo profiles), index of the nearest track point in the catalogue and its great-circle distance in km. 
+# If dates are given, only track points within max_days of the date of each position are considered (index -1 and distance nan if there is none): 
+# positions are grouped in bins of max_days, and the positions of a bin are searched in a tree of the track points of the bin extended by max_days 
+# on both sides (the catalogue sorted by time, so this window is found with searchsorted), k nearest points first and twice as many until one is close enough in time.
+def TC_nearest_track_point(catalogue,lons,lats,dates=None,max_days=None,k=32):
+    xyz = lonlat_to_xyz(np.atleast_1d(lons), np.atleast_1d(lats)).reshape(-1,3)
+    n_points = len(catalogue['lon'])
+    index = np.full(len(xyz), -1)
+    dist  = np.full(len(xyz), np.nan)
+    if n_points == 0:
+        return index, dist
+    if dates is None or max_days is None:
+        chord, index = catalogue['tree'].query(xyz)
+        return index, 2*EARTH_RADIUS_KM*np.arcsin(np.minimum(chord/2, 1))
+    from scipy.spatial import cKDTree
+    times = to_utc_naive(np.atleast_1d(dates)).to_numpy().astype('datetime64[s]')
+    max_dt = np.timedelta64(int(max_days*86400), 's')
+    width  = max(max_dt, np.timedelta64(1, 's'))
+    order = np.argsort(catalogue['time'], kind='stable')
+    sorted_time = catalogue['time'][order]
+    pos = np.flatnonzero(~np.isnat(times))
+    if len(pos) == 0:
+        return index, dist
+    bins = (times[pos]-times[pos].min()) // width
+    pos  = pos[np.argsort(bins, kind='stable')]
+    bins = np.sort(bins)
+    for rows in np.split(pos, np.flatnonzero(np.diff(bins))+1):
+        t0 = times[rows].min()
+        window = order[np.searchsorted(sorted_time, t0-max_dt, 'left'):np.searchsorted(sorted_time, t0+width+max_dt, 'right')]
+        if len(window) == 0:
+            continue
+        tree = cKDTree(catalogue['tree'].data[window])
+        kk = min(k, len(window))
+        while len(rows) > 0:
+            chord, cand = tree.query(xyz[rows], k=kk)
+            chord, cand = chord.reshape(len(rows),-1), window[cand.reshape(len(rows),-1)]
+            ok = np.abs(catalogue['time'][cand]-times[rows,np.newaxis]) <= max_dt
+            first = np.argmax(ok, axis=1)
+            found = ok.any(axis=1)
+            index[rows[found]] = cand[found, first[found]]
+            dist[rows[found]]  = 2*EARTH_RADIUS_KM*np.arcsin(np.minimum(chord[found, first[found]]/2, 1))
+            if kk == len(window):
+                break
+            rows = rows[~found]
+            kk = min(2*kk, len(window))
+    return index, dist
+
+
+# #### Geometry functions
+# ---
+# Great-circle geometry between profiles and storm tracks, and simplification of tracks for maps. Functions broadcast over NumPy arrays; profile_track_geometry processes 
+# the profiles in chunks (GEOMETRY_CHUNK_SIZE profile-segment pairs at a time) so that memory is bounded for a whole season of profiles and storms.
+GEOMETRY_CHUNK_SIZE = 2**20
+QUADRANTS = np.array(['RF','RR','LR','LF']) # right-front, right-rear, left-rear, left-front (relative to the storm motion)
+
+# **haversine_km**
+# 
+# Great-circle distance in km between (lon1, lat1) and (lon2, lat2), in degrees.
+def haversine_km(lon1,lat1,lon2,lat2):
+    lon1, lat1, lon2, lat2 = [np.radians(np.asarray(x, dtype=float)) for x in (lon1, lat1, lon2, lat2)]
+    a = np.sin((lat2-lat1)/2)**2 + np.cos(lat1)*np.cos(lat2)*np.sin((lon2-lon1)/2)**2
+    return 2*EARTH_RADIUS_KM*np.arcsin(np.sqrt(np.minimum(a, 1)))
+
+
+# **bearing_deg**
+# 
+# Initial bearing (degrees clockwise from north, 0-360) of the great circle from (lon1, lat1) to (lon2, lat2).
+def bearing_deg(lon1,lat1,lon2,lat2):
+    lon1, lat1, lon2, lat2 = [np.radians(np.asarray(x, dtype=float)) for x in (lon1, lat1, lon2, lat2)]
+    y = np.sin(lon2-lon1)*np.cos(lat2)
+    x = np.cos(lat1)*np.sin(lat2) - np.sin(lat1)*np.cos(lat2)*np.cos(lon2-lon1)
+    return np.degrees(np.arctan2(y, x)) % 360
+
+
+# **xyz_to_lonlat**
+# 
+# Longitude and latitude (degrees) of vectors (one row per position, not necessarily unit vectors).
+def xyz_to_lonlat(xyz):
+    xyz = np.asarray(xyz, dtype=float)
+    return (np.degrees(np.arctan2(xyz[...,1], xyz[...,0])),
+            np.degrees(np.arctan2(xyz[...,2], np.hypot(xyz[...,0], xyz[...,1]))))
+
+
+# **profile_track_geometry**
+# 
+# Position of M profiles (lons, lats and, optionally, times) relative to storm tracks with N track points (track_lon, track_lat, track_time; 
+# points of several storms can be passed at once with 'storm', the storm index of each track point, as in a catalogue from get_TC_catalogue, e.g. 
+# profile_track_geometry(c['lon'], c['lat'], c['time'], lons, lats, times, storm=c['storm'])). Each storm's points should be in time order.
+# 
+# For each profile, the closest track segment is found (great-circle distance) and the function returns a dictionary of arrays (one item per profile):
+# - 'segment': index of the first track point of the closest segment,
+# - 'distance_km': distance to the track,
+# - 'cross_track_km', 'cross_track_angle': signed distance from the great circle of the segment, in km and in degrees of arc (positive to the right of the storm motion),
+# - 'along_track_km': distance along the track (from the first point of the storm) of the point of closest approach,
+# - 'passage_time': time when the storm was at the point of closest approach,
+# - 'time_since_passage': profile time minus passage time, in days (negative for profiles before the storm),
+# - 'quadrant', 'relative_bearing': storm-relative quadrant ('RF','RR','LR','LF', see QUADRANTS) and bearing of the profile from the storm position at the profile time, 
+#   relative to the storm motion (only if 'times' is given, '' and nan otherwise).
+@traced('geometry')
+def profile_track_geometry(track_lon,track_lat,track_time,lons,lats,times=None,storm=None,chunk_size=None):
+    if chunk_size is None:
+        chunk_size = GEOMETRY_CHUNK_SIZE
+    T = lonlat_to_xyz(track_lon, track_lat).reshape(-1,3)
+    P = lonlat_to_xyz(np.atleast_1d(lons), np.atleast_1d(lats)).reshape(-1,3)
+    n_track, n_prof = len(T), len(P)
+    storm = np.zeros(n_track, dtype=int) if storm is None else np.asarray(storm)
+    track_time = to_utc_naive(np.asarray(track_time).ravel()).to_numpy().astype('datetime64[s]')
+    
+    # segments between consecutive points of the same storm, plus one zero-length segment for storms with a single point
+    same = storm[1:] == storm[:-1]
+    alone = ~np.concatenate(([False], same)) & ~np.concatenate((same, [False]))
+    seg_a = np.concatenate((np.flatnonzero(same), np.flatnonzero(alone)))
+    seg_b = np.concatenate((np.flatnonzero(same)+1, np.flatnonzero(alone)))
+    A, B = T[seg_a], T[seg_b]
+    normal = np.cross(A, B)
+    norm   = np.linalg.norm(normal, axis=1)
+    degenerate = norm < 1e-12
+    normal[~degenerate] /= norm[~degenerate, np.newaxis]
+    d12 = np.arctan2(norm, np.einsum('ij,ij->i', A, B))
+    C   = np.cross(normal, A)
+    # distance along the track of the first point of each segment
+    step = np.zeros(n_track)
+    step[1:] = np.where(same, 2*np.arcsin(np.minimum(np.linalg.norm(T[1:]-T[:-1], axis=1)/2, 1)), 0)
+    along = np.cumsum(step)
+    first = np.concatenate(([0], np.flatnonzero(~same)+1))
+    along -= np.repeat(along[first], np.diff(np.concatenate((first, [n_track]))))
+    
+    out = {'segment': np.zeros(n_prof, dtype=int), 'distance_km': np.full(n_prof, np.nan), 
+           'cross_track_km': np.full(n_prof, np.nan), 'along_track_km': np.full(n_prof, np.nan)}
+    fraction = np.zeros(n_prof)
+    rows = max(1, chunk_size // max(len(seg_a), 1))
+    for start in range(0, n_prof if len(seg_a) > 0 else 0, rows):
+        p   = P[start:start+rows]
+        # the projection of p on the great circle of a segment is at an angle atan2(p.C, p.A) from A, with C = normal x A
+        xt  = np.arcsin(np.clip(p @ normal.T, -1, 1))            # profiles x segments
+        pA  = p @ A.T
+        pB  = p @ B.T
+        at  = np.arctan2(p @ C.T, pA)
+        dA  = 2*np.arcsin(np.sqrt(np.clip((1-pA)/2, 0, 1)))
+        dB  = 2*np.arcsin(np.sqrt(np.clip((1-pB)/2, 0, 1)))
+        inside = (at >= 0) & (at <= d12) & ~degenerate
+        dist = np.where(inside, np.abs(xt), np.minimum(dA, dB))
+        best = np.argmin(dist, axis=1)
+        r    = np.arange(len(p))
+        frac = np.where(inside[r,best], at[r,best]/np.where(d12[best] > 0, d12[best], 1), (dB[r,best] < dA[r,best]).astype(float))
+        frac[degenerate[best]] = 0
+        sl = slice(start, start+len(p))
+        out['segment'][sl]        = seg_a[best]
+        out['distance_km'][sl]    = dist[r,best]*EARTH_RADIUS_KM
+        # the normal A x B points to the left of the motion from A to B
+        out['cross_track_km'][sl] = np.where(degenerate[best], 0, -xt[r,best])*EARTH_RADIUS_KM
+        out['along_track_km'][sl] = (along[seg_a[best]] + frac*d12[best])*EARTH_RADIUS_KM
+        fraction[sl] = frac
+    out['cross_track_angle'] = np.degrees(out['cross_track_km']/EARTH_RADIUS_KM)
+    # passage time: linear in time along the closest segment (NaT if a point of the segment has no time)
+    track_sec = track_time.astype('int64')
+    has_time  = ~np.isnat(track_time)
+    run   = np.cumsum(np.concatenate(([0], ~same)))            # index of the storm of each track point
+    ends  = np.concatenate((first[1:], [n_track]))              # points of storm s: first[s]:ends[s]
+    ia    = out['segment']
+    ib    = np.minimum(ia+1, n_track-1)
+    ib    = np.where(run[ib] == run[ia], ib, ia)
+    passage = track_sec[ia] + fraction*(track_sec[ib]-track_sec[ia])
+    no_passage = ~has_time[ia] | ~has_time[ib]
+    out['passage_time'] = np.where(no_passage, np.datetime64('NaT', 's'), passage.astype('int64').astype('datetime64[s]'))
+    out['quadrant'] = np.full(n_prof, '', dtype=object)
+    out['relative_bearing'] = np.full(n_prof, np.nan)
+    out['time_since_passage'] = np.full(n_prof, np.nan)
+    if times is None or n_prof == 0 or len(seg_a) == 0:
+        return out
+    t = to_utc_naive(np.atleast_1d(times)).to_numpy().astype('datetime64[s]')
+    no_time = np.isnat(t)
+    t = t.astype('int64')
+    out['time_since_passage'] = np.where(no_passage | no_time, np.nan, (t-passage)/86400)
+    
+    # storm position and heading at the profile time, within the storm of the closest segment (clamped to its first and last points with a time): 
+    # the profiles are grouped by storm and the profile times searched in the times of their storm
+    k0 = ia.copy()
+    k1 = ia.copy()
+    r  = run[ia]
+    rows = np.flatnonzero(~no_time)
+    rows = rows[np.argsort(r[rows], kind='stable')]
+    for rows_s in np.split(rows, np.flatnonzero(np.diff(r[rows]))+1) if len(rows) else []:
+        s   = r[rows_s[0]]
+        pts = first[s] + np.flatnonzero(has_time[first[s]:ends[s]])
+        if len(pts) == 0:
+            continue
+        j = np.clip(np.searchsorted(track_sec[pts], t[rows_s], side='right') - 1, 0, max(len(pts)-2, 0))
+        k0[rows_s] = pts[j]
+        k1[rows_s] = pts[np.minimum(j+1, len(pts)-1)]
+    dt = track_sec[k1]-track_sec[k0]
+    w  = np.where(dt > 0, np.clip((t-track_sec[k0])/np.where(dt > 0, dt, 1), 0, 1), 0)
+    center_lon, center_lat = xyz_to_lonlat((1-w)[:,np.newaxis]*T[k0] + w[:,np.newaxis]*T[k1])
+    track_lon = np.asarray(track_lon, dtype=float).ravel()
+    track_lat = np.asarray(track_lat, dtype=float).ravel()
+    heading = bearing_deg(track_lon[k0], track_lat[k0], track_lon[k1], track_lat[k1])
+    rel = (bearing_deg(center_lon, center_lat, np.atleast_1d(lons), np.atleast_1d(lats)) - heading) % 360
+    rel[k0 == k1] = np.nan
+    out['relative_bearing'] = rel
+    out['quadrant'] = np.where(np.isnan(rel), '', QUADRANTS[np.nan_to_num(rel // 90).astype(int) % 4])
+    return out
+
+
+# **TC_track_arrays**
+# 
+# The track points of all the storms in TCs_Dict (e.g. get_TCs_byDate output) in one array per key of traj_data (e.g. keys=('lon','lat','wind')), 
+# the points of storm i being at offsets[i]:offsets[i+1] (as in parse_into_arrays), without building a data frame per storm. Missing values are nan. 
+# tag_TC_or_SH_FILT = 'TC' (or 'SH_FILT') only keeps tropical cyclones (or Southern Hemisphere storms), as in TC_and_storms_view.
+def TC_track_arrays(TCs_Dict,keys=('lon','lat','wind'),tag_TC_or_SH_FILT=None):
+    if tag_TC_or_SH_FILT is not None:
+        TCs_Dict = [x for x in TCs_Dict if ('SH_FILT' in x['_id']) == ('SH_FILT' in tag_TC_or_SH_FILT)]
+    counts  = [len(x['traj_data']) for x in TCs_Dict]
+    offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+    points  = [p for x in TCs_Dict for p in x['traj_data']]
+    arrays  = {key: values_to_array([p.get(key, np.nan) for p in points]) for key in keys}
+    return arrays, offsets
+
+
+# **simplify_tracks**
+# 
+# Douglas-Peucker simplification of tracks (points of track i at offsets[i]:offsets[i+1]) with great-circle distances: returns a boolean array, True for the points kept, 
+# so that no point removed is further than tolerance_km from the simplified track (the first and last points of each track are always kept). 
+# All the tracks are simplified at once: at each step, the point furthest from each segment of every track is found with one pass over the points.
+def simplify_tracks(lon,lat,offsets,tolerance_km):
+    offsets = np.asarray(offsets, dtype=np.int64)
+    counts  = np.diff(offsets)
+    keep = np.zeros(offsets[-1], dtype=bool)
+    if tolerance_km <= 0:
+        keep[:] = True
+        return keep
+    keep[offsets[:-1][counts > 0]] = True
+    keep[offsets[1:][counts > 0]-1] = True
+    P = lonlat_to_xyz(lon, lat).reshape(-1,3)
+    tolerance = tolerance_km/EARTH_RADIUS_KM
+    seg_a = offsets[:-1][counts > 2]
+    seg_b = offsets[1:][counts > 2]-1
+    while len(seg_a) > 0:
+        inner = seg_b-seg_a-1
+        start = np.cumsum(inner)-inner
+        seg   = np.repeat(np.arange(len(seg_a)), inner)
+        ind   = np.arange(inner.sum()) - np.repeat(start, inner) + np.repeat(seg_a+1, inner)
+        # distance of each point to the segment of its track (as in profile_track_geometry): to the great circle if it projects inside the segment, to the closest end otherwise
+        A, B, p = P[seg_a], P[seg_b], P[ind]
+        normal = np.cross(A, B)
+        norm   = np.linalg.norm(normal, axis=1)
+        degenerate = norm < 1e-12
+        normal[~degenerate] /= norm[~degenerate, np.newaxis]
+        d12 = np.arctan2(norm, np.einsum('ij,ij->i', A, B))
+        pA  = np.einsum('ij,ij->i', p, A[seg])
+        pB  = np.einsum('ij,ij->i', p, B[seg])
+        at  = np.arctan2(np.einsum('ij,ij->i', p, np.cross(normal, A)[seg]), pA)
+        xt  = np.arcsin(np.clip(np.einsum('ij,ij->i', p, normal[seg]), -1, 1))
+        dA  = 2*np.arcsin(np.sqrt(np.clip((1-pA)/2, 0, 1)))
+        dB  = 2*np.arcsin(np.sqrt(np.clip((1-pB)/2, 0, 1)))
+        inside = (at >= 0) & (at <= d12[seg]) & ~degenerate[seg]
+        dist = np.where(inside, np.abs(xt), np.minimum(dA, dB))
+        # furthest point of each segment, split there if it is further than the tolerance
+        order = np.lexsort((-dist, seg))
+        far   = order[start]
+        split = dist[far] > tolerance
+        mid   = ind[far[split]]
+        keep[mid] = True
+        seg_a, seg_b = np.concatenate((seg_a[split], mid)), np.concatenate((mid, seg_b[split]))
+        long_enough = seg_b-seg_a > 1
+        seg_a, seg_b = seg_a[long_enough], seg_b[long_enough]
+    trace_count('simplify.points', offsets[-1])
+    trace_count('simplify.kept', int(keep.sum()))
+    return keep
 
 
 # #### Sea-ice data functions
@@ -122,34 +1104,97 @@ hurricane.vertices -= hurricane.vertices.mean()
 # 
 # date format: 'yyyy-mm-dd'.
 # 
-# If printUrl=True, the function print Url for the data query.
-def get_SOSE_sea_ice(xreg,yreg,date,printUrl=True):
+# If printUrl=True, the function print Url for the data query. SOSE_sea_ice_url returns the url of the query.
+def SOSE_sea_ice_url(xreg,yreg,date):
     # yreg, xreg, date should be lists
-    url  = 'https://argovis.colorado.edu/griddedProducts/nonUniformGrid/window?'
+    url  = ARGOVIS_URL+'/griddedProducts/nonUniformGrid/window?'
     url += 'gridName=sose_si_area_1_day_sparse&presLevel=0&'
     url += 'latRange={}'.format(yreg)
     url += '&lonRange={}'.format(xreg)
     url += '&date={}'.format(date)
+    return url
+
+def get_SOSE_sea_ice(xreg,yreg,date,printUrl=True):
+    url = SOSE_sea_ice_url(xreg,yreg,date)
     if printUrl:
         print(url)
-    resp = requests.get(url)
-    # Consider any status other than 2xx an error
-    if not resp.status_code // 100 == 2:
-        return "Error: Unexpected response {}".format(resp)
-    selectionSeaIce = resp.json()    
-    return selectionSeaIce
+    return fetch_json_batch([url])[0]
 
 
 # **parse_into_df_SeaIce**
 # 
 # This function parses the output of the function get_SOSE_sea_ice.
+# 
+# The data frame is built once from the columns of the grid cells (one row per grid cell, index 0 for all rows as in the row-by-row version).
 def parse_into_df_SeaIce(selectionSeaIce):
-    meas_keys = selectionSeaIce[0]['data'][0].keys()
-    df = pd.DataFrame(columns=meas_keys)
-    for data in selectionSeaIce[0]['data']:
-        bfrDf = pd.DataFrame(data={'lon':  [data['lon']], 'lat':  [data['lat']], 'value':  [data['value']]}) #pd.DataFrame(data={'lon':  data['lon'], 'lat':  data['lat']})
-        df = pd.concat([df, bfrDf], sort=False)
-    return df
+    cells = selectionSeaIce[0]['data']
+    columns = dict.fromkeys(list(cells[0].keys())+['lon','lat','value'])
+    for key in columns:
+        if key in ('lon','lat','value'):
+            columns[key] = values_to_array([data[key] for data in cells])
+        else:
+            columns[key] = np.full(len(cells), np.nan)
+    return pd.DataFrame(columns, index=np.zeros(len(cells), dtype=int))
+
+
+# **sample_SOSE_sea_ice**
+# 
+# Sample SOSE sea-ice concentration at many positions at once: lons, lats and dates are arrays with one item per position (e.g. the 'lon', 'lat' and 'date' columns of the parse_into_df_plev output for a platform).
+# 
+# Positions are grouped by day and one window enclosing all the positions of the day is queried (all days concurrently). The grid cells of each day are then indexed with a KD-tree and:
+# - method='mean' averages the grid cells in the dx by dy box around each position (e.g. dx = dy = 1/6, based on SOSE resolution),
+# - method='nearest' takes the closest grid cell (within the box),
+# - method='linear' interpolates linearly between grid cells (as interpolate.griddata).
+# All the methods work in coordinates scaled by the box size (lon/dx, lat/dy), so that 'linear' uses the same distances as the box. Another method raises ValueError 
+# (before any query).
+# 
+# The SOSE grid is sparse, so positions with no grid cell nearby are set to fill_value (0 by default, i.e. no sea ice); positions for which the query fails are nan.
+# SOSE is daily, hence the number of queries is the number of distinct days.
+@traced('sea_ice')
+def sample_SOSE_sea_ice(lons,lats,dates,dx=1/6,dy=1/6,method='mean',fill_value=0.):
+    if method not in ('mean', 'nearest', 'linear'):
+        raise ValueError("method should be 'mean', 'nearest' or 'linear', not {}".format(method))
+    from scipy import interpolate
+    from scipy.spatial import cKDTree
+    lons  = np.asarray(lons, dtype=float)
+    lats  = np.asarray(lats, dtype=float)
+    days  = np.array([str(date)[0:10] for date in dates])
+    out   = np.full(len(lons), np.nan)
+    unique_days = np.unique(days)
+    windows = [np.flatnonzero(days == day) for day in unique_days]
+    urls = [SOSE_sea_ice_url(xreg=[float(lons[ind].min()-dx), float(lons[ind].max()+dx)],
+                             yreg=[float(lats[ind].min()-dy), float(lats[ind].max()+dy)], date=day)
+            for (ind, day) in zip(windows, unique_days)]
+    for (ind, selectionSeaIce) in zip(windows, fetch_json_batch(urls)):
+        if isinstance(selectionSeaIce, str):
+            continue
+        cells = selectionSeaIce[0]['data'] if len(selectionSeaIce) > 0 else []
+        out[ind] = fill_value
+        if len(cells) == 0:
+            continue
+        grid  = np.array([[data['lon'], data['lat']] for data in cells], dtype=float)
+        value = values_to_array([data['value'] for data in cells])
+        pts   = np.column_stack((lons[ind], lats[ind]))
+        # in coordinates scaled by the box size, the box around each position is the unit ball for the maximum norm
+        scale = np.array([1/dx, 1/dy])
+        if method == 'linear':
+            res = interpolate.griddata(grid*scale, value, pts*scale) if len(cells) > 2 else np.full(len(ind), np.nan)
+            out[ind] = np.where(np.isnan(res), fill_value, res)
+            continue
+        tree  = cKDTree(grid*scale)
+        if method == 'nearest':
+            dist, j = tree.query(pts*scale, p=np.inf, distance_upper_bound=1)
+            found = np.isfinite(dist)
+            out[ind[found]] = value[j[found]]
+        elif method == 'mean':
+            neighbours = tree.query_ball_point(pts*scale, r=1, p=np.inf)
+            counts = np.array([len(n) for n in neighbours])
+            found  = counts > 0
+            if found.any():
+                flat = np.concatenate([n for n in neighbours if len(n) > 0]).astype(int)
+                sums = np.bincount(np.repeat(np.arange(len(ind)), counts), weights=value[flat], minlength=len(ind))
+                out[ind[found]] = sums[found]/counts[found]
+    return out
 
 
 # #### Argo float data functions
@@ -163,344 +1208,629 @@ def parse_into_df_SeaIce(selectionSeaIce):
 # Shape is a list of lists containing [lon, lat] coordinates, e.g. for a squared region:[[[min_longitude,min_latitude],[min_longitude,max_latitude],[max_longitude,max_latitude],[max_longitude,min_latitude],[min_longitude,min_latitude]]].
 # 
 # For a custom polygon, the user can draw a region using the select region feature in the main Argovis map at https://argovis.colorado.edu: once the shape appears on the map, the corresponding vertices for the polygon appear in URL and can be copied from there to define 'shape' as input.
-def get_selection_profiles(startDate, endDate, shape, presRange=None, printUrl=True):
-    url = 'https://argovis.colorado.edu/selection/profiles'
+# 
+# selection_profiles_url returns the url of the query (e.g. to query several regions at once with fetch_json_batch).
+def selection_profiles_url(startDate, endDate, shape, presRange=None):
+    url = ARGOVIS_URL+'/selection/profiles'
     url += '?startDate={}'.format(startDate)
     url += '&endDate={}'.format(endDate)
     url += '&shape={}'.format(shape)
     if presRange:
         pressRangeQuery = '&presRange=' + presRange
         url += pressRangeQuery
+    return url
+
+def get_selection_profiles(startDate, endDate, shape, presRange=None, printUrl=True):
+    url = selection_profiles_url(startDate, endDate, shape, presRange)
     if printUrl:
         print(url)
-    resp = requests.get(url)
-    # Consider any status other than 2xx an error
-    if not resp.status_code // 100 == 2:
-        return "Error: Unexpected response {}".format(resp)
-    selectionProfiles = resp.json()    
-    return selectionProfiles
+    return fetch_json_batch([url])[0]
 
 
 # **get_profile**
 # 
 # This function is from [Tucker, Giglio, Scanderbeg 2020](https://www.essoar.org/doi/10.1002/essoar.10504304.1) and gets an Argo float profile of interest.
 # 
-# profileID format: '5904912_239'.
+# profileID format: '5904912_239'. profile_url returns the url of the query.
+def profile_url(profileID):
+    return ARGOVIS_URL+'/catalog/profiles/{}'.format(profileID)
+
 def get_profile(profileID):
-    url = 'https://argovis.colorado.edu/catalog/profiles/{}'.format(profileID)
-    resp = requests.get(url)
-    # Consider any status other than 2xx an error
-    if not resp.status_code // 100 == 2:
-        return "Error: Unexpected response {}".format(resp)
-    profile = resp.json()
-    return profile
+    return fetch_json_batch([profile_url(profileID)])[0]
 
 
 # **get_platform_profiles**
 # 
 # This function is from [Tucker, Giglio, Scanderbeg 2020](https://www.essoar.org/doi/10.1002/essoar.10504304.1) and gets profiles an Argo float of interest.
 # 
-# platform_number format: '7900379'.
+# platform_number format: '7900379'. platform_profiles_url returns the url of the query.
+def platform_profiles_url(platform_number):
+    return ARGOVIS_URL+'/catalog/platforms/{}'.format(platform_number)
+
 def get_platform_profiles(platform_number):
-    url = 'https://argovis.colorado.edu/catalog/platforms/{}'.format(platform_number)
-    resp = requests.get(url)
-    # Consider any status other than 2xx an error
-    if not resp.status_code // 100 == 2:
-        return "Error: Unexpected response {}".format(resp)
-    platformProfiles = resp.json()
-    return platformProfiles
+    return fetch_json_batch([platform_profiles_url(platform_number)])[0]
+
+
+# **values_to_array**
+# 
+# Convert a list of values to a float64 array (None is converted to nan); lists with non numeric values are kept as object arrays.
+def values_to_array(values):
+    try:
+        return np.array(values, dtype=float)
+    except (TypeError, ValueError):
+        return np.array(values, dtype=object)
+
+
+# **parse_into_arrays**
+# 
+# Parse profiles (e.g. get_platform_profiles or get_selection_profiles output) into one array per column, with one value per measurement, 
+# in one pass and without using pandas. Columns (and their order) are the same as the columns of the parse_into_df output: 
+# measurement variables, then profile metadata repeated for all the measurements of each profile.
+# 
+# Returns the dictionary of columns and 'offsets': the measurements of profiles[i] are at offsets[i]:offsets[i+1] in each column.
+# For profile arrays (see Profile arrays functions) the measurement columns are the measurement arrays themselves and only the profile attributes are repeated.
+@traced('parse')
+def parse_into_arrays(profiles):
+    meta_keys = ['cycle_number','_id','lat','lon','date','position_qc']
+    meta_cols = ['cycle_number','profile_id','lat','lon','date','position_qc']
+    if is_profile_arrays(profiles):
+        counts = np.diff(profiles['offsets'])
+        order  = profiles.get('columns') or list(profiles['measurements']) + meta_cols + ['containsBGC']
+        columns = {}
+        for key in order:
+            if key in profiles['measurements']:
+                columns[key] = profiles['measurements'][key]
+            elif key == 'date':
+                columns[key] = np.repeat(argovis_dates(profiles['date']), counts)
+            elif key == 'profile_id':
+                columns[key] = np.repeat(profiles['profile_id'].astype(object), counts)
+            elif key == 'containsBGC':
+                # only when some profile has the key, as for a list of profiles
+                if key in profiles:
+                    values = [np.nan if np.isnan(value) else bool(value) for value in values_to_array(profiles[key])]
+                    columns[key] = np.repeat(np.array(values, dtype=object), counts)
+            else:
+                columns[key] = np.repeat(values_to_array(profiles[key]), counts)
+        return columns, profiles['offsets']
+    columns = dict.fromkeys(parse_columns(profiles))
+    counts  = np.array([len(profile['measurements']) for profile in profiles])
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+    measurements = [meas for profile in profiles for meas in profile['measurements']]
+    trace_count('parse.profiles', len(profiles))
+    trace_count('parse.rows', len(measurements))
+    for key in columns:
+        if key in meta_cols:
+            values = [profile[meta_keys[meta_cols.index(key)]] for profile in profiles]
+        elif key == 'containsBGC':
+            values = [profile.get('containsBGC', np.nan) for profile in profiles]
+        else:
+            columns[key] = values_to_array([meas.get(key) for meas in measurements])
+            continue
+        if key in ('profile_id','date','containsBGC'):
+            columns[key] = np.repeat(np.array(values, dtype=object), counts)
+        else:
+            columns[key] = np.repeat(values_to_array(values), counts)
+    return columns, offsets
+
+
+# **parse_columns**
+# 
+# Names of the columns of parse_into_arrays (and parse_into_df) for a list of profiles, in their order: the same column order as pd.concat of the data frames 
+# of each profile (measurement variables of the first profile, profile metadata, then the variables and containsBGC as they first appear).
+def parse_columns(profiles):
+    columns = {}
+    for profile in profiles:
+        columns.update(dict.fromkeys(key for meas in profile['measurements'] for key in meas))
+        columns.update(dict.fromkeys(['cycle_number','profile_id','lat','lon','date','position_qc']))
+        if 'containsBGC' in profile:
+            columns['containsBGC'] = None
+    return list(columns)
 
 
 # **parse_into_df**
 # 
 # This function is from [Tucker, Giglio, Scanderbeg 2020](https://www.essoar.org/doi/10.1002/essoar.10504304.1) and parses profiles from e.g. get_platform_profiles output ('platformProfiles') and get_selection_profiles output ('selectionProfiles') and returns a data frame.
-def parse_into_df(profiles):
-    meas_keys = profiles[0]['measurements'][0].keys()
-    df = pd.DataFrame(columns=meas_keys)
+# 
+# The data frame is built once from the columns returned by parse_into_arrays (the index restarts from 0 for each profile, as when concatenating one data frame per profile). 
+# If return_arrays=True, the output of parse_into_arrays is returned instead (no pandas involved).
+# If store is a table name (e.g. store='profiles'), the profiles are also appended to that table of the profile store (see store_append_profiles).
+@traced('parse_into_df')
+def parse_into_df(profiles,return_arrays=False,store=None):
+    columns, offsets = parse_into_arrays(profiles)
+    if store is not None:
+        store_append_profiles(profiles, table=store, arrays=(columns, offsets))
+    if return_arrays:
+        return columns, offsets
+    index = np.arange(offsets[-1]) - np.repeat(offsets[:-1], np.diff(offsets))
+    return pd.DataFrame(columns, index=index)
+
+
+# **iter_profile_batches**
+# 
+# Parse profiles (any iterable of profiles, e.g. from stream_json_items) batch_size profiles at a time, yielding the output of parse_into_arrays for each batch 
+# (columns and offsets; the columns of a batch are the variables found in the profiles of that batch).
+def iter_profile_batches(profiles,batch_size=500):
+    batch = []
     for profile in profiles:
-        profileDf = pd.DataFrame(profile['measurements'])
-        profileDf['cycle_number'] = profile['cycle_number']
-        profileDf['profile_id'] = profile['_id']
-        profileDf['lat'] = profile['lat']
-        profileDf['lon'] = profile['lon']
-        profileDf['date'] = profile['date']
-        profileDf['position_qc'] = profile['position_qc']
-        if 'containsBGC' in profile.keys():
-            profileDf['containsBGC'] = profile['containsBGC']
-        df = pd.concat([df, profileDf], sort=False)
-    return df
+        batch.append(profile)
+        if len(batch) == batch_size:
+            yield parse_into_arrays(batch)
+            batch = []
+    if batch:
+        yield parse_into_arrays(batch)
+
+
+# **iter_selection_profiles**
+# 
+# Streaming version of get_selection_profiles for large selections: the time window is split into windows of window_days days, which are queried one after the other, 
+# each response is decoded one profile at a time (stream_json_items) and profiles are yielded in batches of batch_size profiles (see iter_profile_batches), 
+# so that memory does not depend on the size of the selection. E.g. to interpolate a large selection batch by batch:
+# 
+# for (columns, offsets) in iter_selection_profiles(startDate, endDate, shape, presRange):
+#     temp = interp_ragged(columns['pres'], columns['temp'], offsets, plev)
+def iter_selection_profiles(startDate,endDate,shape,presRange=None,window_days=30,batch_size=500):
+    def profiles():
+        start = pd.Timestamp(startDate)
+        end   = pd.Timestamp(endDate)
+        previous_ids = set()
+        while True:
+            window_end = min(start+timedelta(days=window_days), end)
+            ids = set()
+            for profile in stream_json_items(selection_profiles_url(str(start)[0:10], str(window_end)[0:10], shape, presRange)):
+                # profiles on the day shared by two windows are returned twice
+                if profile['_id'] in previous_ids:
+                    continue
+                ids.add(profile['_id'])
+                yield profile
+            previous_ids = ids
+            if window_end >= end:
+                break
+            start = window_end
+    return iter_profile_batches(profiles(), batch_size)
+
+
+# **iter_platform_profiles**
+# 
+# Streaming version of get_platform_profiles: the profiles of a platform are yielded in batches of batch_size profiles (see iter_selection_profiles).
+def iter_platform_profiles(platform_number,batch_size=500):
+    return iter_profile_batches(stream_json_items(platform_profiles_url(platform_number)), batch_size)
+
+
+# **interp_ragged**
+# 
+# Interpolate many profiles onto the pressure levels 'plev' at once. 'pres' and 'values' hold the measurements of all the profiles one after the other 
+# (as the columns of parse_into_arrays), the measurements of profile i being at offsets[i]:offsets[i+1]. 
+# 
+# Measurements with nan or 'fill_value' (-999 in Argovis) are skipped and each profile is sorted by pressure (duplicated pressures are only used once). 
+# method is 'linear' (as interp1d), 'pchip' (as scipy.interpolate.PchipInterpolator) or 'nearest'; levels outside the pressure range of a profile are nan.
+# 
+# Returns a float32 array with one row per profile and one column per pressure level.
+@traced('interpolate')
+def interp_ragged(pres, values, offsets, plev, method='linear', fill_value=-999):
+    pres    = np.asarray(pres, dtype=float)
+    values  = np.asarray(values, dtype=float)
+    plev    = np.asarray(plev, dtype=float)
+    n_prof  = len(offsets)-1
+    trace_count('interpolate.profiles', n_prof)
+    out     = np.full((n_prof, len(plev)), np.nan, dtype=np.float32)
+    prof    = np.repeat(np.arange(n_prof), np.diff(offsets))
+    valid   = np.isfinite(pres) & np.isfinite(values) & (pres != fill_value) & (values != fill_value)
+    prof, p, v = prof[valid], pres[valid], values[valid]
+    if len(p) == 0:
+        return out
+    # sort by profile, then pressure, and drop duplicated pressures
+    order = np.lexsort((p, prof))
+    prof, p, v = prof[order], p[order], v[order]
+    keep = np.concatenate(([True], (prof[1:] != prof[:-1]) | (p[1:] != p[:-1])))
+    prof, p, v = prof[keep], p[keep], v[keep]
+    
+    # one sorted key for all profiles (profile i is shifted by i*span), so that all levels of all profiles are located with a single searchsorted
+    base   = min(p.min(), plev.min())
+    span   = max(p.max(), plev.max()) - base + 1
+    key    = (p-base) + prof*span
+    row    = np.repeat(np.arange(n_prof), len(plev))
+    target = np.tile(plev, n_prof)
+    hi     = np.searchsorted(key, (target-base) + row*span)
+    hi_ok  = hi < len(key)
+    hi_c   = np.minimum(hi, len(key)-1)
+    lo_c   = np.maximum(hi-1, 0)
+    exact  = hi_ok & (prof[hi_c] == row) & (p[hi_c] == target)
+    inside = hi_ok & (hi > 0) & (prof[hi_c] == row) & (prof[lo_c] == row) & ~exact
+    
+    res = np.full(len(target), np.nan)
+    res[exact] = v[hi_c[exact]]
+    lo, hi = lo_c[inside], hi_c[inside]
+    x  = target[inside]
+    h  = p[hi]-p[lo]
+    t  = (x-p[lo])/h
+    if method == 'linear':
+        res[inside] = v[lo] + t*(v[hi]-v[lo])
+    elif method == 'nearest':
+        # as interp1d, the lower point is used half-way between two points
+        res[inside] = np.where(x-p[lo] <= p[hi]-x, v[lo], v[hi])
+    elif method == 'pchip':
+        d = pchip_slopes(prof, p, v)
+        res[inside] = ((2*t**3-3*t**2+1)*v[lo] + (t**3-2*t**2+t)*h*d[lo] + 
+                       (-2*t**3+3*t**2)*v[hi] + (t**3-t**2)*h*d[hi])
+    else:
+        raise ValueError("method should be 'linear', 'pchip' or 'nearest', not {}".format(method))
+    out[:] = res.reshape(n_prof, len(plev))
+    return out
+
+
+# **pchip_slopes**
+# 
+# Slopes at each point for PCHIP interpolation (as in scipy.interpolate.PchipInterpolator) of sorted profiles stored one after the other (prof is the profile index of each point).
+def pchip_slopes(prof, p, v):
+    n   = len(p)
+    seg = prof[1:] == prof[:-1] # segments within a profile
+    with np.errstate(divide='ignore', invalid='ignore'):
+        h = np.diff(p)
+        m = np.diff(v)/h
+        hL, hR = np.concatenate(([np.nan], h)), np.concatenate((h, [np.nan]))
+        mL, mR = np.concatenate(([np.nan], m)), np.concatenate((m, [np.nan]))
+        hasL, hasR = np.concatenate(([False], seg)), np.concatenate((seg, [False]))
+        d = np.zeros(n)
+        # interior points: weighted harmonic mean of the slopes, 0 at local extrema
+        interior = hasL & hasR
+        w1 = 2*hR + hL
+        w2 = hR + 2*hL
+        hmean = (w1+w2)/(w1/mL + w2/mR)
+        flat  = (np.sign(mL) != np.sign(mR)) | (mL == 0) | (mR == 0)
+        d[interior & ~flat] = hmean[interior & ~flat]
+        # first and last points of each profile: one-sided three-point estimate, or slope of the only segment
+        hasR2 = hasR & np.concatenate((hasR[1:], [False]))
+        hasL2 = hasL & np.concatenate(([False], hasL[:-1]))
+        hR2, mR2 = np.concatenate((hR[1:], [np.nan])), np.concatenate((mR[1:], [np.nan]))
+        hL2, mL2 = np.concatenate(([np.nan], hL[:-1])), np.concatenate(([np.nan], mL[:-1]))
+        for (edge, edge3, h0, h1, m0, m1) in ((~hasL & hasR, hasR2, hR, hR2, mR, mR2), (hasL & ~hasR, hasL2, hL, hL2, mL, mL2)):
+            d[edge & ~edge3] = m0[edge & ~edge3]
+            e = edge & edge3
+            de = ((2*h0[e] + h1[e])*m0[e] - h0[e]*m1[e])/(h0[e] + h1[e])
+            de[np.sign(de) != np.sign(m0[e])] = 0
+            mask = (np.sign(de) == np.sign(m0[e])) & (np.sign(m0[e]) != np.sign(m1[e])) & (np.abs(de) > 3*np.abs(m0[e]))
+            de[mask] = 3*m0[e][mask]
+            d[e] = de
+    return d
+
+
+# **interp_profiles_plev**
+# 
+# Interpolate profiles (e.g. get_platform_profiles or get_selection_profiles output) onto the pressure levels 'plev' (e.g. 'plev = np.arange(5,505,5)') 
+# with one call to interp_ragged per variable. 
+# 
+# Returns a dictionary with one float32 array (number of profiles x number of pressure levels) for each variable in 'variables', 
+# e.g. the temperature section for a platform is interp_profiles_plev(platformProfiles, plev)['temp'].T
+# With processes other than 1, profiles are interpolated in a pool of processes (interp_ragged_parallel; None for all the CPUs).
+@traced('interp_profiles_plev')
+def interp_profiles_plev(profiles, plev, variables=('temp','psal'), method='linear', processes=1):
+    if is_profile_arrays(profiles):
+        offsets = profiles['offsets']
+        pres = profiles['measurements'].get('pres', np.full(offsets[-1], np.nan))
+    else:
+        counts  = [len(profile['measurements']) for profile in profiles]
+        offsets = np.concatenate(([0], np.cumsum(counts))).astype(int)
+        measurements = [meas for profile in profiles for meas in profile['measurements']]
+        pres = values_to_array([meas.get('pres') for meas in measurements])
+    plevArrays = {}
+    for var in variables:
+        if is_profile_arrays(profiles):
+            values = profiles['measurements'].get(var, np.full(offsets[-1], np.nan))
+        else:
+            values = values_to_array([meas.get(var) for meas in measurements])
+        if processes == 1:
+            plevArrays[var] = interp_ragged(pres, values, offsets, plev, method=method)
+        else:
+            plevArrays[var] = interp_ragged_parallel(pres, values, offsets, plev, method=method, processes=processes)
+    return plevArrays
 
 
 # **parse_into_df_plev**
 # 
 # This function is from [Tucker, Giglio, Scanderbeg 2020](https://www.essoar.org/doi/10.1002/essoar.10504304.1) and parses profiles from e.g. get_platform_profiles output ('platformProfiles') and get_selection_profiles output ('selectionProfiles'), and returns a data frame after interpolating profile onto defined pressure levels (e.g. 'plev = np.arange(5,505,5)').
-def parse_into_df_plev(profiles, plev):
-    plevProfileList = []
-    for profile in profiles:
-        profileDf_bfr = pd.DataFrame(profile['measurements'])
-        plevProfile = profile
-        fT = interpolate.interp1d(profileDf_bfr['pres'], profileDf_bfr['temp'], bounds_error=False)
-        plevProfile['temp'] = fT(plev)
-        # some of the profiles in Argovis may not have salinity 
-        # (either because there is no salinity value in the original Argo file or the quality is bad)
-        try:
-            fS = interpolate.interp1d(profileDf_bfr['pres'], profileDf_bfr['psal'], bounds_error=False)
-            plevProfile['psal'] = fS(plev)
-        except:
-            plevProfile['psal'] = np.nan #  No salinity found in profile
-        plevProfile['pres'] = plev
-        plevProfileList.append(plevProfile)
-    df = pd.DataFrame(plevProfileList)
+# 
+# Profiles are interpolated all at once with interp_profiles_plev ('method' is 'linear', 'pchip' or 'nearest'; measurements equal to -999 are skipped). 
+# To get the dense arrays directly (e.g. temp2d, psal2d for a platform) use interp_profiles_plev.
+# If store is a table name (e.g. store='profiles_plev'), the interpolated profiles are also appended to that table of the profile store 
+# (one record per profile, with temp, psal and pres as 2D blocks; see store_append_plev).
+# processes is passed to interp_profiles_plev (e.g. processes=None to interpolate a large selection on all the CPUs).
+# The profiles (a list of profiles or profile arrays) are not modified.
+@traced('parse_into_df_plev')
+def parse_into_df_plev(profiles, plev, method='linear', store=None, processes=1):
+    plevArrays = interp_profiles_plev(profiles, plev, method=method, processes=processes)
+    if store is not None:
+        store_append_plev(profiles, plev, plevArrays, table=store)
+    # the profiles are not modified: the data frame is built from the profile attributes and the interpolated arrays
+    if is_profile_arrays(profiles):
+        n = len(profiles['profile_id'])
+        psal = profiles['measurements'].get('psal', np.full(profiles['offsets'][-1], np.nan))
+        prof = np.repeat(np.arange(n), np.diff(profiles['offsets']))
+        has_psal = np.bincount(prof[~np.isnan(psal)], minlength=n) > 0
+        df = pd.DataFrame({'cycle_number': profiles['cycle_number'], '_id': profiles['profile_id'].astype(object), 
+                           'date': argovis_dates(profiles['date']), 'lon': profiles['lon'], 'lat': profiles['lat']})
+        keys = list(key for key in profiles if key not in ('offsets', 'columns'))
+    else:
+        n = len(profiles)
+        has_psal = [any('psal' in meas for meas in profile['measurements']) for profile in profiles]
+        df = pd.DataFrame({'cycle_number': [profile['cycle_number'] for profile in profiles], '_id': [profile['_id'] for profile in profiles],
+                           'date': [profile['date'] for profile in profiles], 'lon': [profile['lon'] for profile in profiles], 
+                           'lat': [profile['lat'] for profile in profiles]})
+        keys = list(dict.fromkeys(key for profile in profiles for key in profile))
+    df['pres'] = [plev]*n
+    df['temp'] = list(plevArrays['temp'])
+    # some of the profiles in Argovis may not have salinity 
+    # (either because there is no salinity value in the original Argo file or the quality is bad)
+    df['psal'] = [row if has else np.nan for (row, has) in zip(plevArrays['psal'], has_psal)] #  nan: no salinity found in profile
+    for key in ('position_qc', 'date_qc'):
+        df[key] = profile_values(profiles, key) if is_profile_arrays(profiles) else [profile.get(key, np.nan) for profile in profiles]
     df = df.sort_values(by=['cycle_number'])
     df = df.reset_index(drop=True)
     # print all that is available (only some of the info will be stored in the output dataframe, yet users can add more if interested)
-    print(df.keys())
+    print(pd.Index(keys + ['temp', 'psal', 'pres']))
     df = df[['cycle_number','_id','date','lon','lat','pres','temp','psal','position_qc','date_qc']]
     return df
 
 
-# ### Data visualization functions
-# ---
-# #### Tropical cyclone visualization functions
+# #### Profile arrays functions
 # ---
-
-# **plot_tracks_time_in_col**
+# Profiles can be kept as profile arrays instead of a list of JSON dictionaries: a dictionary with one array per profile attribute (profile_id, platform, 
+# cycle_number, date, lat, lon, position_qc, date_qc and containsBGC if present), 'offsets' and 'measurements', a dictionary with one contiguous float64 array 
+# per measurement variable (pres, temp, psal, ...), the measurements of profile i being at offsets[i]:offsets[i+1] (as in parse_into_arrays and the profile store), 
+# and 'columns', the column order of parse_into_df for the original list of profiles (see parse_columns). 
+# Strings are fixed-width and dates datetime64, so a season of profiles is held in a few arrays instead of millions of Python objects.
 # 
-# This function plots Tropical Cyclone tracks ('TCs_Dict') that are output by get_TCs_byDate and get_TCs_byNameYear.
+# parse_into_arrays, parse_into_df, interp_profiles_plev, parse_into_df_plev, store_append_profiles, store_append_plev and platform_section_update accept 
+# profile arrays in place of a list of profiles, and colocate_TC_and_Argo returns them with compact=True. E.g.:
 # 
-# df_ctag is a tag for the variable plotted in the colorbar: e.g. df_ctag='wind' plots maximum sustained winds for the TC at each position along the track. 
+# arrays = profile_arrays(get_platform_profiles('7900414'))
+# temp = profile_view(arrays, 0)['temp']            # measurements of the first profile (a view of arrays['measurements']['temp'], no copy)
+# df = parse_into_df(take_profiles(arrays, rows))   # data frame of some of the profiles, on demand
+
+# **is_profile_arrays**
 # 
-# df_title is a tag for the figure title. If df_title='', the default title is used: 'Tropical Cyclone tracks'.
+# True if 'profiles' are profile arrays (not a list of profiles).
+def is_profile_arrays(profiles):
+    return isinstance(profiles, dict) and 'offsets' in profiles and 'measurements' in profiles
+
+
+# **profile_arrays**
 # 
-# tag_TC_or_SH_FILT = 'TC' to map TCs only.
+# Profile arrays of a list of profiles (e.g. get_platform_profiles or get_selection_profiles output), built in one pass over the profiles.
+def profile_arrays(profiles):
+    if is_profile_arrays(profiles):
+        return profiles
+    profiles = list(profiles)
+    arrays = profile_records(profiles)
+    arrays['date_qc'] = profile_values(profiles, 'date_qc')
+    counts = [len(profile['measurements']) for profile in profiles]
+    arrays['offsets'] = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+    measurements = [meas for profile in profiles for meas in profile['measurements']]
+    keys = dict.fromkeys(key for meas in measurements for key in meas)
+    arrays['measurements'] = {key: values_to_array([meas.get(key) for meas in measurements]) for key in keys}
+    arrays['columns'] = parse_columns(profiles)
+    trace_count('profile_arrays.profiles', len(profiles))
+    return arrays
+
+
+# **profile_values**
 # 
-# This function has the capability to map tracks for Southern Hemisphere storms using tag_TC_or_SH_FILT = 'SH_FILT'. Nevertheless, the database for Southern Hemisphere storms is still in development. See Section 1.9.
+# Array of the values of 'key' (e.g. 'date_qc') for each profile of profiles or profile arrays (nan where missing).
+def profile_values(profiles,key):
+    if is_profile_arrays(profiles):
+        return profiles[key] if key in profiles else np.full(len(profiles['profile_id']), np.nan)
+    return values_to_array([profile.get(key) for profile in profiles])
+
+
+# **profile_view**
 # 
-def plot_tracks_time_in_col(TCs_Dict,df_ctag='wind',df_title='',tag_TC_or_SH_FILT='TC'):
-    for i in range(0,len(TCs_Dict)):
-        df  = pd.DataFrame(TCs_Dict[i]['traj_data'])
-        if (('SH_FILT' == tag_TC_or_SH_FILT) and (tag_TC_or_SH_FILT in TCs_Dict[i]['_id'])) or         (('TC' == tag_TC_or_SH_FILT) and ('SH_FILT' not in TCs_Dict[i]['_id'])):
-            plt.scatter(df['lon'],df['lat'],transform=ccrs.PlateCarree(),s=5,c=df[df_ctag],cmap='viridis')#c=mdates.date2num(dti))
-    cb = plt.colorbar(orientation='vertical',fraction=0.03,pad=0.02)
-    cb.ax.tick_params(labelsize=15)
-    cb.set_label('maximum sustained winds, knots', fontsize=16)
-    tt = plt.title(df_title,fontsize=24)
-    plt.show()
+# Profile i of profile arrays as a dictionary: its attributes, and its measurements as views of the measurement arrays (no copy).
+def profile_view(arrays,i):
+    view = {key: arrays[key][i] for key in arrays if key not in ('offsets', 'measurements', 'columns')}
+    (start, stop) = (arrays['offsets'][i], arrays['offsets'][i+1])
+    view.update({key: values[start:stop] for (key, values) in arrays['measurements'].items()})
+    return view
 
 
-# **TC_and_storms_view**
+# **take_profiles**
 # 
-# Function to map all tropical cyclones for selected time window ('startDate' - 'endDate').
+# Profile arrays of the profiles 'rows' (indices or a boolean mask) of profile arrays, in the order of rows.
+def take_profiles(arrays,rows):
+    rows = np.asarray(rows)
+    rows = np.flatnonzero(rows) if rows.dtype == bool else rows.astype(np.int64)
+    (index, offsets) = ragged_take(arrays['offsets'], rows)
+    out = {key: arrays[key][rows] for key in arrays if key not in ('offsets', 'measurements', 'columns')}
+    if 'columns' in arrays:
+        out['columns'] = arrays['columns']
+    out['offsets'] = offsets
+    out['measurements'] = {key: values[index] for (key, values) in arrays['measurements'].items()}
+    return out
+
+
+# **argovis_dates**
 # 
-# startDate, endDate: 'yyyy-mm-dd'.
+# Dates (datetime64) as Argovis date strings ('2017-09-20T10:21:00.000Z').
+def argovis_dates(dates):
+    return np.array(pd.DatetimeIndex(dates).strftime('%Y-%m-%dT%H:%M:%S.%f').str[0:23] + 'Z', dtype=object)
+
+
+# #### Co-location functions
+# ---
+
+# **to_utc_naive**
 # 
-# tag_TC_or_SH_FILT = 'TC' to map TCs only.
+# Convert dates (e.g. Argovis 'date' strings or the TC 'timestamp' column) to a DatetimeIndex in UTC without time zone, so that profile and track dates can be compared.
+def to_utc_naive(dates):
+    return pd.DatetimeIndex(pd.to_datetime(dates, utc=True)).tz_localize(None)
+
+
+# **box_shape**
 # 
-# This function has the capability to map tracks for Southern Hemisphere storms using tag_TC_or_SH_FILT = 'SH_FILT'. Nevertheless, the database for Southern Hemisphere storms is still in development. See Section 1.9.
-def TC_and_storms_view(startDate,endDate,tag_TC_or_SH_FILT='TC',create_figure=True):
-    TCs_Dict = get_TCs_byDate(startDate,endDate=endDate)
-    bool_list = [] 
-    for x in TCs_Dict:
-        if ('SH_FILT' in tag_TC_or_SH_FILT):
-            df_title = ' Southern Hemisphere storms intensity '
-            df_ctag = 'intensity'
-            bool_list.append('SH_FILT' in x['_id'])
-        else:
-            df_title = 'Tropical Cyclone tracks'
-            df_ctag = 'wind'
-            bool_list.append(~('SH_FILT' in x['_id']))      
-    output_select = list(compress(TCs_Dict, bool_list))
-    if create_figure:
-        fig = plt.figure(figsize=(15,15))
-        ax = plt.axes(projection=ccrs.Mollweide())
-        gl = ax.gridlines(draw_labels=True,color='black')
-        gl.xlabels_top = False
-        gl.ylabels_right = False
-        gl.xformatter = LONGITUDE_FORMATTER
-        gl.yformatter = LATITUDE_FORMATTER
-        ax.stock_img()
-        plot_tracks_time_in_col(list(compress(TCs_Dict, bool_list)),df_ctag,df_title,tag_TC_or_SH_FILT)
-    return output_select
+# Returns the 'shape' string used by get_selection_profiles for the box [lon_min,lon_max] x [lat_min,lat_max].
+def box_shape(lon_min,lon_max,lat_min,lat_max):
+    lon_min,lon_max,lat_min,lat_max = float(lon_min),float(lon_max),float(lat_min),float(lat_max)
+    shape = [[[lon_min,lat_min],[lon_min,lat_max],[lon_max,lat_max],[lon_max,lat_min],[lon_min,lat_min]]]
+    return str(shape).replace(' ', '')
 
-# **map_TC**
-
-# Map of the TC track. TC track info is stored in the dataframe 'df' (which is output of get_track_for_storm)
-def map_TC(df,printing=False,printing_flag='',dx_buffer = 5,dy_buffer = 5,font_size=20):
-    fig = plt.figure(figsize=(15,15))
-    ax = plt.axes(projection=ccrs.PlateCarree()) #Mollweide
-    gl = ax.gridlines(draw_labels=True,color='black')
-    gl.xlabels_top = False
-    gl.ylabels_right = False
-    gl.xlabel_style = {'size': font_size}
-    gl.ylabel_style = {'size': font_size}
-    gl.xformatter = LONGITUDE_FORMATTER
-    gl.yformatter = LATITUDE_FORMATTER
-    ax.coastlines()
-    ax.add_feature(cft.LAND)
-    ax.add_feature(cft.OCEAN)
-    im = plt.scatter(df['lon'],df['lat'],transform=ccrs.PlateCarree(),s=2000,marker=hurricane,
-                c=df['wind'], facecolors='none', linewidth=3.5)
-    cb = plt.colorbar(orientation='vertical',fraction=0.03,pad=0.02)
-    cb.ax.tick_params(labelsize=15)
-    cb.set_label('maximum sustained winds, knots', fontsize=16)
-    dti = pd.to_datetime(df['timestamp'])
-    ax.set_extent([min(df['lon'])-dx_buffer, max(df['lon'])+dx_buffer,
-                   min(df['lat'])-dy_buffer, max(df['lat'])+dy_buffer,], crs=ccrs.PlateCarree())
-    
-    if printing:
-        plt.show()
-        fig.savefig('./Figures/'+printing_flag+'_map.png')
-                
-    return fig
 
-# **map_TC_and_Argo**
+# **query_dates_mask**
+# 
+# Mask of the dates selected by an Argovis query by date from startDate to endDate: both are days ('yyyy-mm-dd', or dates floored to the day) read as 00:00 UTC 
+# and both are included, i.e. the profiles of the endDate day after 00:00 are not selected. Broadcasts as numpy comparisons.
+def query_dates_mask(dates,startDate,endDate):
+    return (dates >= startDate) & (dates <= endDate)
+
 
-# Co-locate Argo profiles along TC track and map location of profiles and TC track. TC track info is stored in the dataframe 'df' (which is output of get_track_for_storm)
-def map_TC_and_Argo(df, delta_days, dx, dy, presRange,printing=False,printing_flag='',font_size=20):
+# **lon_ranges**
+# 
+# The longitudes from lon_min to lon_max (degrees, lon_max-lon_min at most 360, e.g. a box around a track point past the dateline) as one or two ranges 
+# within [-180, 180], split at +-180 (normalized as in basin_of).
+def lon_ranges(lon_min,lon_max):
+    if lon_max - lon_min >= 360:
+        return [(-180., 180.)]
+    low  = (lon_min+180) % 360 - 180
+    high = low + (lon_max-lon_min)
+    if high <= 180:
+        return [(low, high)]
+    return [(low, 180.), (-180., high-360)]
+
+
+# **colocate_TC_and_Argo**
+# 
+# Co-locate Argo profiles along the TC track stored in the dataframe 'df' (output of get_track_for_storm), without any plotting. 
+# 
+# For each track point, "before" profiles are the ones in a dx by dy box centered on the track point and in the 'delta_days' days before the track point date, 
+# "after" profiles are in the same box and in the 'delta_days' days after the track point date (dates are rounded down to the day and the windows end at 00:00 UTC 
+# of their last day, as the query by date of map_TC_and_Argo, see query_dates_mask).
+# 
+# Boxes of neighbouring track points overlap, hence track points are merged into groups whose boxes and time windows are covered by one query 
+# (at most max_span degrees in longitude and latitude and max_days days): each group is queried once (all groups concurrently), 
+# each profile is parsed once and profiles are then assigned to the track points locally.
+# 
+# If radius_km is given, profiles are co-located with track points within radius_km (great-circle distance, see haversine_km) instead of the dx by dy box 
+# (boxes are too narrow near the poles, where longitudes converge). Boxes and distances wrap around the dateline: a query box past +-180 is split in two (see lon_ranges).
+# 
+# Returns prof_beforeTC and prof_afterTC as in map_TC_and_Argo: a list with one item per track point, i.e. a dictionary {profile_id: dataframe of the profile} or [] if no profiles are found.
+# Queries that fail are printed and skipped, or raise a RuntimeError if strict=True (e.g. in batch runs, to retry the storm later).
+# 
+# With compact=True, no data frame is built: returns (arrays, prof_beforeTC, prof_afterTC) where arrays are the profile arrays of all the co-located profiles 
+# (see Profile arrays functions; -999 replaced by nan) and each item of prof_beforeTC/prof_afterTC is the index (in arrays) of the profiles of a track point, 
+# ordered by profile id (see colocated_profiles to get the dictionary of data frames of an item). 
+# df may also be a dictionary of arrays (lon, lat and timestamp), e.g. the points of one storm from TC_track_arrays.
+@traced('colocate')
+def colocate_TC_and_Argo(df, delta_days, dx, dy, presRange, max_span=10, max_days=60, radius_km=None, strict=False, compact=False):
+    lon = np.asarray(df['lon'], dtype=float)
+    lat = np.asarray(df['lat'], dtype=float)
+    dti = to_utc_naive(df['timestamp'])
+    day = dti.floor('D')
+    before_start = (dti-timedelta(days=delta_days)).floor('D')
+    after_end    = (dti+timedelta(days=delta_days)).floor('D')
+    # half widths of the box queried around each track point
+    if radius_km is None:
+        hx = np.full(len(lon), dx/2)
+        hy = np.full(len(lon), dy/2)
+    else:
+        hy = np.full(len(lon), np.degrees(radius_km/EARTH_RADIUS_KM))
+        hx = np.minimum(hy/np.cos(np.radians(np.minimum(np.abs(lat)+hy, 89.9))), 180)
+    
+    # merge track points into groups covered by one query (longitudes of a group are kept continuous across the dateline)
+    groups = []
+    for i in range(len(lon)):
+        if groups:
+            g = groups[-1]
+            lon_i    = lon[i] + 360*np.round(((g['lon_min']+g['lon_max'])/2 - lon[i])/360)
+            lon_span = max(g['lon_max'], lon_i+hx[i]) - min(g['lon_min'], lon_i-hx[i])
+            lat_span = max(g['lat_max'], lat[i]+hy[i]) - min(g['lat_min'], lat[i]-hy[i])
+            t_span   = (max(g['end'], after_end[i]) - min(g['start'], before_start[i])).days
+            if lon_span <= max_span and lat_span <= max_span and t_span <= max_days:
+                g['lon_min'] = min(g['lon_min'], lon_i-hx[i])
+                g['lon_max'] = max(g['lon_max'], lon_i+hx[i])
+                g['lat_min'] = min(g['lat_min'], lat[i]-hy[i])
+                g['lat_max'] = max(g['lat_max'], lat[i]+hy[i])
+                g['start']   = min(g['start'], before_start[i])
+                g['end']     = max(g['end'], after_end[i])
+                continue
+        groups.append({'lon_min': lon[i]-hx[i], 'lon_max': lon[i]+hx[i], 'lat_min': lat[i]-hy[i], 'lat_max': lat[i]+hy[i],
+                       'start': before_start[i], 'end': after_end[i]})
+    # boxes past the dateline are queried as two boxes, split at +-180
+    urls = [selection_profiles_url(str(g['start'])[0:10], str(g['end'])[0:10],
+                                   box_shape(lon_min,lon_max,max(g['lat_min'],-90),min(g['lat_max'],90)), str(presRange))
+            for g in groups for (lon_min, lon_max) in lon_ranges(g['lon_min'], g['lon_max'])]
+    
+    # fetch each group once and keep one copy of each profile
+    profiles = {}
+    for selectionProfiles in fetch_json_batch(urls):
+        if isinstance(selectionProfiles,str):
+            if strict:
+                raise RuntimeError(selectionProfiles)
+            print(selectionProfiles)
+            continue
+        for profile in selectionProfiles:
+            profiles[profile['_id']] = profile
+    if compact:
+        return _colocate_compact(list(profiles.values()), lon, lat, before_start, day, after_end, dx, dy, radius_km)
+    if not profiles:
+        return [[] for i in range(len(lon))], [[] for i in range(len(lon))]
+    profiles = list(profiles.values())
+    
+    selectionDf = parse_into_df(profiles)
+    selectionDf.replace(-999, np.nan, inplace=True)
+    profile_groups = dict(list(selectionDf.groupby(by='profile_id')))
+    for tag_id in profile_groups:
+        # only keep the containsBGC column for profiles that do contain bgc measurements
+        if 'containsBGC' in profile_groups[tag_id] and profile_groups[tag_id]['containsBGC'].isnull().all():
+            profile_groups[tag_id] = profile_groups[tag_id].drop(columns='containsBGC')
+    
+    prof_id = np.array([profile['_id'] for profile in profiles])
+    (is_before, is_after) = _colocate_masks(lon, lat, before_start, day, after_end, dx, dy, radius_km, 
+                                            np.array([profile['lon'] for profile in profiles], dtype=float),
+                                            np.array([profile['lat'] for profile in profiles], dtype=float),
+                                            to_utc_naive([profile['date'] for profile in profiles]).to_numpy())
+    
     prof_beforeTC = []
     prof_afterTC  = []
-    col='magenta'
-    dx_buffer = 5
-    dy_buffer = 5
-    fig = plt.figure(figsize=(15,15))
-    ax = plt.axes(projection=ccrs.PlateCarree()) #Mollweide
-    gl = ax.gridlines(draw_labels=True,color='black')
-    gl.xlabels_top = False
-    gl.ylabels_right = False
-    gl.xlabel_style = {'size': font_size}
-    gl.ylabel_style = {'size': font_size}
-    gl.xformatter = LONGITUDE_FORMATTER
-    gl.yformatter = LATITUDE_FORMATTER
-    ax.coastlines()
-    ax.add_feature(cft.LAND)
-    ax.add_feature(cft.OCEAN)
-    im = plt.scatter(df['lon'],df['lat'],transform=ccrs.PlateCarree(),s=2000,marker=hurricane,
-                c=df['wind'], facecolors='none', linewidth=3.5)
-    cb = plt.colorbar(orientation='vertical',fraction=0.03,pad=0.02)
-    cb.ax.tick_params(labelsize=15)
-    cb.set_label('maximum sustained winds, knots', fontsize=16)
-    dti = pd.to_datetime(df['timestamp'])
-    ax.set_extent([min(df['lon'])-dx_buffer, max(df['lon'])+dx_buffer,
-                   min(df['lat'])-dy_buffer, max(df['lat'])+dy_buffer,], crs=ccrs.PlateCarree())
-    for i in np.arange(0,len(df['lon']),1):
-        for ii in np.arange(0,2,1):
-            if ii == 0:# look for "before" profiles
-                startDate=str(dti[i]-timedelta(days=delta_days))[0:10]
-                endDate=str(dti[i])[0:10]
-                mrkr = '*'
-                #col = 'k'
-            else: #look for "after" profiles
-                startDate=str(dti[i])[0:10]
-                endDate=str(dti[i]+timedelta(days=delta_days))[0:10]
-                mrkr = '*' 
-                #col = 'red'
-            shape = [[[df['lon'][i]-(dx/2),df['lat'][i]-(dy/2)],[df['lon'][i]-(dx/2),df['lat'][i]+(dy/2)],[df['lon'][i]+(dx/2),df['lat'][i]+(dy/2)],[df['lon'][i]+(dx/2),df['lat'][i]-(dy/2)],[df['lon'][i]-(dx/2),df['lat'][i]-(dy/2)]]]
-
-            strShape = str(shape).replace(' ', '')
-            selectionProfiles = get_selection_profiles(startDate, endDate, strShape, str(presRange), printUrl=False)
-            selectionProfiles_raw = selectionProfiles
-            if len(selectionProfiles) > 0 and not isinstance(selectionProfiles,str):
-                selectionDf = parse_into_df(selectionProfiles)
-                selectionDf.replace(-999, np.nan, inplace=True)
-
-                gb     = selectionDf.groupby(by='profile_id')
-                groups = dict(list(gb))
-                gb_list = gb.groups.keys()
-
-                if ii == 0:
-                    prof_beforeTC.append(groups)
-                else:
-                    prof_afterTC.append(groups)
-                for tag_id in gb_list:
-
-                    plt.plot(groups[tag_id]['lon'][0],groups[tag_id]['lat'][0],mrkr,transform=ccrs.Geodetic(),markersize=15,linewidth=4,color=col)
-
-
-                    ax.text(groups[tag_id]['lon'][0]+.25, groups[tag_id]['lat'][0], tag_id,transform=ccrs.Geodetic(),color=col)
-
+    for i in range(len(lon)):
+        for (mask, prof_list) in ((is_before[i], prof_beforeTC), (is_after[i], prof_afterTC)):
+            if mask.any():
+                prof_list.append({tag_id: profile_groups[tag_id] for tag_id in sorted(prof_id[mask])})
             else:
-                if ii == 0:
-                    prof_beforeTC.append([])
-                else:
-                    prof_afterTC.append([])
-    plt.title('Tropical Cyclone track and location of Argo profiles (magenta)',fontsize=20)
-    plt.show()
-    if printing:
-        fig.savefig('./Figures/'+printing_flag+'_map.png')
-                
-    return prof_beforeTC,prof_afterTC
-
-
-# #### Argo profiles visualization functions
-# ---
+                prof_list.append([])
+    return prof_beforeTC, prof_afterTC
+
+# assign profiles to track points (track points x profiles)
+def _colocate_masks(lon, lat, before_start, day, after_end, dx, dy, radius_km, prof_lon, prof_lat, prof_date):
+    if radius_km is None:
+        in_box = ((np.abs((prof_lon[np.newaxis,:]-lon[:,np.newaxis]+180) % 360 - 180) <= dx/2) & 
+                  (np.abs(prof_lat[np.newaxis,:]-lat[:,np.newaxis]) <= dy/2))
+    else:
+        in_box = haversine_km(lon[:,np.newaxis], lat[:,np.newaxis], prof_lon[np.newaxis,:], prof_lat[np.newaxis,:]) <= radius_km
+    is_before = in_box & query_dates_mask(prof_date, before_start.to_numpy()[:,np.newaxis], day.to_numpy()[:,np.newaxis])
+    is_after  = in_box & query_dates_mask(prof_date, day.to_numpy()[:,np.newaxis], after_end.to_numpy()[:,np.newaxis])
+    return is_before, is_after
+
+def _colocate_compact(profiles, lon, lat, before_start, day, after_end, dx, dy, radius_km):
+    arrays = profile_arrays(profiles)
+    for values in arrays['measurements'].values():
+        if values.dtype.kind == 'f':
+            values[values == -999] = np.nan
+    (is_before, is_after) = _colocate_masks(lon, lat, before_start, day, after_end, dx, dy, radius_km, arrays['lon'], arrays['lat'], arrays['date'])
+    order = np.argsort(arrays['profile_id'], kind='stable')
+    return arrays, [order[mask[order]] for mask in is_before], [order[mask[order]] for mask in is_after]
+
+
+# **colocated_profiles**
+# 
+# One item of prof_beforeTC or prof_afterTC from colocate_TC_and_Argo(..., compact=True) (index of profiles in 'arrays') as with compact=False: 
+# a dictionary {profile_id: dataframe of the profile}, or [] if there are no profiles.
+def colocated_profiles(arrays,rows):
+    if len(rows) == 0:
+        return []
+    df = parse_into_df(take_profiles(arrays, rows))
+    profile_groups = dict(list(df.groupby(by='profile_id')))
+    for tag_id in profile_groups:
+        if 'containsBGC' in profile_groups[tag_id] and profile_groups[tag_id]['containsBGC'].isnull().all():
+            profile_groups[tag_id] = profile_groups[tag_id].drop(columns='containsBGC')
+    return {tag_id: profile_groups[tag_id] for tag_id in sorted(profile_groups)}
 
-# **plot_prof**
-# 
-# This function plots Argo float profiles.
-# 
-# dataX is an array vector containing the profile variable. E.g. temperature (df['temp'])  or salinity (df['sal']) at each pressure level from the output of parse_into_df_plev ('df').
-# 
-# dataY is an array vector containing the profile pressure levels (df['pres']) from the output of  parse_into_df_plev ('df').
-# 
-# xlab, ylab are the labels for each axis (e.g. xlab = 'Temperature, degC' and ylab=''Pressure, dbar').
-# 
-# xlim and ylim define the x and y axes limits. If xlim=[], the axis is adjusted automatically to fit the data range, otherwise specified as xlim=[min value, max value]. E.g. xlim=[22,30] for temperature. 
-# 
-# ylim =[presRange], where presRange=[min value, max_vale]. E.g. presRange=[0,100].
-# 
-# label sets the label for the plot legend (e.g. label='before' for before TC profiles).
-# 
-# col sets the color for the profile based on wether the profile was recorded before or after the TC's passage. E.g. col='k' , for black if the profile was recorded before the TC.
-def plot_prof(dataX,dataY,xlab,ylab,xlim,ylim,label,col):
-    plt.plot(dataX,dataY,label=label,color=col,linewidth=5)
-    plt.gca().set_xlabel(xlab,fontsize=24)
-    plt.gca().set_ylabel(ylab,fontsize=24)
-    plt.ylim(ylim)
-    if xlim:
-        plt.xlim(xlim)
-    plt.gca().invert_yaxis()
-    for tick in plt.gca().xaxis.get_majorticklabels():  # example for xaxis
-        tick.set_fontsize(24) 
-    for tick in plt.gca().yaxis.get_majorticklabels():  # example for xaxis
-        tick.set_fontsize(24) 
-    return
-
-
-# **plot_prof_pairs**
-
-# Print ID (i.e. platformNumber_cycleNumber) of oceanic profiles in each item of two lists (prof_beforeTC,prof_afterTC), when the item (i.e. the item that corresponds to a certain index) has profiles in both lists. This function was build to plot profiles before the TC in red and after in black, i.e. when the two lists are indeed for profiles before/after the TC, the plot is done only for locations along the tropical cyclone track of interest where co-located oceanic profiles (stored in prof_beforeTC,prof_afterTC for the TC of interest) are available both before and after the cyclone.
-def plot_prof_pairs(prof_beforeTC,prof_afterTC,presRange=[0,100]):
-    for x,y in zip(prof_beforeTC,prof_afterTC):
-        if any(x) and any(y):
-            print('-------------')
-            # temperature
-            fig = plt.figure(figsize=(30,10))
-            plt.subplot(121)
-            for d in x.keys():
-                print('Temperature, before (black): ' + d)
-                plot_prof(dataX=x[d]['temp'],dataY=x[d]['pres'],xlab='Temperature, degC',ylab='Pressure, dbar',xlim=[],ylim=presRange,label='before',col='k')
-            for d in y.keys():
-                print('Temperature, after (red): ' + d)
-                plot_prof(dataX=y[d]['temp'],dataY=y[d]['pres'],xlab='Temperature, degC',ylab='Pressure, dbar',xlim=[],ylim=presRange,label='after',col='r')
-            plt.title('Temperature profiles',fontsize=24)
-            plt.legend(fontsize=18)
-            # salinity
-            plt.subplot(122)
-            for d in x.keys():
-                print('Salinity, before (black): ' + d)
-                try:
-                    plot_prof(dataX=x[d]['psal'],dataY=x[d]['pres'],xlab='Salinity, psu',ylab='Pressure, dbar',xlim=[],ylim=presRange,label='before',col='k')
-                except:
-                    pass
-            for d in y.keys():
-                print('Salinity, after (red): ' + d)
-                try:
-                    plot_prof(dataX=y[d]['psal'],dataY=y[d]['pres'],xlab='Salinity, psu',ylab='Pressure, dbar',xlim=[],ylim=presRange,label='after',col='r')
-                except:
-                    pass
-            plt.title('Salinity profiles',fontsize=24)
-            plt.legend(fontsize=18)
-            plt.show()
 
 # function to parse bgc profiles
 def parse_1prof_into_df(profileDict,data_type='core'): #'bgc' to retrieve bgc measurements (including T,S,p yet with no selection and including qc flag)
@@ -523,24 +1853,950 @@ def parse_1prof_into_df(profileDict,data_type='core'): #'bgc' to retrieve bgc me
     df.head()
     return df
 
-# function to plot the profiles
-def make_plot(b,a,b_tag,a_tag,x_tag,b_yax,a_yax,y_tag,y_lim,title_plot,font_size=20):
-    b_mask = (b_yax>=min(y_lim)) & (b_yax<=max(y_lim))
-    a_mask = (a_yax>=min(y_lim)) & (a_yax<=max(y_lim))
-    if 'QC' not in x_tag:
-        plt.plot(b[b_mask],b_yax[b_mask],linewidth=3,color='k',marker='*',label=b_tag)
-        plt.plot(a[a_mask],a_yax[a_mask],linewidth=3,color='r',marker='*',label=a_tag)
+
+# #### BGC profile functions
+# ---
+# BGC measurements (bgcMeas) of many profiles are loaded at once with load_bgc_profiles: profile IDs are de-duplicated, the profiles are fetched concurrently 
+# (fetch_json_batch, through the response cache) and bgcMeas is parsed into one array per variable with the measurements of all the profiles one after the other 
+# (as parse_into_arrays), QC flags apart. The profiles that carry each variable are indexed, e.g.:
+# 
+# bgc = load_bgc_profiles(bgc_profile_ids(prof_beforeTC+prof_afterTC))
+# bgc_profiles_with(bgc, 'chla')     # IDs of the profiles with chla measurements
+# bgc_profile(bgc, '5904693_12')    # arrays of one profile (pres, chla, chla_qc, ...)
+
+# **bgc_profile_ids**
+# 
+# IDs of the profiles flagged with containsBGC in a list of co-located profiles (e.g. prof_beforeTC+prof_afterTC from colocate_TC_and_Argo), without duplicates.
+def bgc_profile_ids(prof_list):
+    ids = {}
+    for x in prof_list:
+        for tag_id in x:
+            if 'containsBGC' in x[tag_id].keys():
+                ids[tag_id] = None
+    return list(ids)
+
+
+# **parse_bgc_arrays**
+# 
+# Parse the bgcMeas of profiles (get_profile output) into arrays: returns a dictionary with the profile metadata (profile_id, lat, lon, date; one item per profile), 
+# 'offsets' (the measurements of profile i are at offsets[i]:offsets[i+1]), 'meas' and 'qc' (one array per variable and per QC flag, e.g. qc['chla'] for chla_qc) 
+# and 'index' (for each variable, the position of the profiles with at least one value of that variable).
+def parse_bgc_arrays(profiles):
+    levels = [profile.get('bgcMeas') or [] for profile in profiles]
+    counts = np.array([len(meas) for meas in levels], dtype=int)
+    keys   = dict.fromkeys(key for meas in levels for level in meas for key in level)
+    flat   = [level for meas in levels for level in meas]
+    bgc = {'profile_id': np.array([profile['_id'] for profile in profiles], dtype=str),
+           'lat':        values_to_array([profile.get('lat') for profile in profiles]),
+           'lon':        values_to_array([profile.get('lon') for profile in profiles]),
+           'date':       to_utc_naive([profile.get('date') for profile in profiles]).to_numpy(),
+           'offsets':    np.concatenate(([0], np.cumsum(counts))).astype(np.int64),
+           'meas': {}, 'qc': {}, 'index': {}}
+    prof = np.repeat(np.arange(len(profiles)), counts)
+    for key in keys:
+        values = values_to_array([level.get(key) for level in flat])
+        if key.endswith('_qc'):
+            bgc['qc'][key[:-3]] = values
+            continue
+        bgc['meas'][key] = values
+        has_value = np.isfinite(values) if values.dtype != object else np.array([value is not None for value in values], dtype=bool)
+        bgc['index'][key] = np.flatnonzero(np.bincount(prof[has_value], minlength=len(profiles)) > 0)
+    return bgc
+
+
+# **load_bgc_profiles**
+# 
+# Fetch profiles (concurrently and through the response cache) and parse their BGC measurements with parse_bgc_arrays. 
+# Each ID is fetched once; IDs that cannot be fetched are listed in bgc['errors'] (with the error message).
+@traced('bgc.load')
+def load_bgc_profiles(profile_ids,max_workers=None):
+    profile_ids = list(dict.fromkeys(profile_ids))
+    responses = fetch_json_batch([profile_url(profile_id) for profile_id in profile_ids], max_workers=max_workers)
+    profiles, errors = [], {}
+    for (profile_id, profile) in zip(profile_ids, responses):
+        # /catalog/profiles/ returns a list of one profile in some versions of the API
+        if isinstance(profile, list) and len(profile) == 1:
+            profile = profile[0]
+        if isinstance(profile, dict):
+            profiles.append(profile)
+        else:
+            errors[profile_id] = profile if isinstance(profile, str) else 'Error: No profile found'
+    bgc = parse_bgc_arrays(profiles)
+    bgc['errors'] = errors
+    return bgc
+
+
+# **bgc_profiles_with**
+# 
+# IDs of the profiles in 'bgc' (load_bgc_profiles output) with measurements of variable 'var' (e.g. 'chla', 'doxy').
+def bgc_profiles_with(bgc,var):
+    return list(bgc['profile_id'][bgc['index'].get(var, [])])
+
+
+# **bgc_profile**
+# 
+# Measurements of one profile of 'bgc' (load_bgc_profiles output) as a dictionary of arrays (views of the arrays in bgc): 
+# pres and the other variables, and the QC flags as var+'_qc'.
+def bgc_profile(bgc,profile_id):
+    i = np.flatnonzero(bgc['profile_id'] == profile_id)
+    if len(i) == 0:
+        raise KeyError(profile_id)
+    segment = slice(bgc['offsets'][i[0]], bgc['offsets'][i[0]+1])
+    out = {key: bgc['meas'][key][segment] for key in bgc['meas']}
+    out.update({key+'_qc': bgc['qc'][key][segment] for key in bgc['qc']})
+    return out
+
+
+# #### TC-pair statistics functions
+# ---
+# Statistics of pairs of profiles before/after a TC (e.g. the raw_before_variable and raw_after_variable columns of the pair data frames), 
+# computed for all the pairs at once: the profiles are stacked into two arrays (pairs x pressure levels, on the same pressure levels 'pres', 
+# e.g. np.arange(10,212,2)) and missing values (nan) are masked. E.g., for the hurricane strength pairs close to the TC:
+# 
+# (before, after) = stack_pairs(df)
+# mask  = pair_mask(df['wind'], df['signed_angle'], min_wind=64, max_angle=0.25)   # or pair_track_angle(df, catalogue) instead of df['signed_angle']
+# stats = pair_statistics(before, after, np.arange(10,212,2), mask=mask)
+# stats['val_of_max_after'] - stats['val_of_max_before']
+
+# **stack_pairs**
+# 
+# Before and after profiles of the pairs in 'df' as two float arrays (pairs x pressure levels).
+def stack_pairs(df,before='raw_before_variable',after='raw_after_variable'):
+    return (np.stack([np.asarray(x, dtype=float) for x in df[before]]) if len(df) else np.zeros((0, 0)),
+            np.stack([np.asarray(x, dtype=float) for x in df[after]]) if len(df) else np.zeros((0, 0)))
+
+
+# **pair_track_angle**
+# 
+# Angle between each pair and the track of its TC, computed from the tracks: the cross-track angle (degrees of arc, positive to the right of the storm motion, 
+# see profile_track_geometry) of the pair position (columns lon, lat) relative to the track of its storm (column storm) in 'catalogue' (see get_TC_catalogue), 
+# nan for storms that are not in the catalogue. E.g. for pairs with no signed_angle column, or with other storms: pair_mask(df['wind'], pair_track_angle(df, catalogue)).
+# The signed_angle column of the pair files was computed beforehand by other code; pair_mask only uses |angle|.
+def pair_track_angle(df,catalogue,lon='argo_lon',lat='argo_lat',storm='HurricaneID'):
+    lons = np.asarray(df[lon], dtype=float)
+    lats = np.asarray(df[lat], dtype=float)
+    storms = np.asarray(df[storm]).astype(str)
+    angle = np.full(len(lons), np.nan)
+    index = {sid: i for (i, sid) in enumerate(np.asarray(catalogue['storm_id']).astype(str))}
+    order = np.argsort(catalogue['storm'], kind='stable')
+    offsets = np.searchsorted(catalogue['storm'][order], np.arange(len(index)+1))
+    for sid in np.unique(storms):
+        if sid not in index:
+            continue
+        rows = np.flatnonzero(storms == sid)
+        points = order[offsets[index[sid]]:offsets[index[sid]+1]]
+        geometry = profile_track_geometry(catalogue['lon'][points], catalogue['lat'][points], catalogue['time'][points], lons[rows], lats[rows])
+        angle[rows] = geometry['cross_track_angle']
+    return angle
+
+
+# **pair_mask**
+# 
+# Boolean mask of the pairs co-located with a TC with wind >= min_wind (knots) and with |angle| <= max_angle (angle between the pair and the TC, 
+# e.g. signed_angle, or pair_track_angle from the tracks); None skips a condition.
+def pair_mask(wind,angle=None,min_wind=64,max_angle=0.25):
+    mask = np.ones(len(wind), dtype=bool)
+    if min_wind is not None:
+        mask &= np.asarray(wind, dtype=float) >= min_wind
+    if max_angle is not None and angle is not None:
+        mask &= np.abs(np.asarray(angle, dtype=float)) <= max_angle
+    return mask
+
+
+# **histogram_rows**
+# 
+# Histogram of each row of x (as np.histogram(x[i], bins=edges)[0] for each row i, nan are not counted).
+def histogram_rows(x,edges):
+    x = np.asarray(x, dtype=float)
+    edges = np.asarray(edges, dtype=float)
+    nbins = len(edges)-1
+    ind = np.searchsorted(edges, x, side='right') - 1
+    ind[x == edges[-1]] = nbins-1 # the last bin includes its right edge
+    valid = (ind >= 0) & (ind < nbins) & ~np.isnan(x)
+    rows = np.broadcast_to(np.arange(x.shape[0])[:,np.newaxis], x.shape)
+    return np.bincount(rows[valid]*nbins + ind[valid], minlength=x.shape[0]*nbins).reshape(x.shape[0], nbins)
+
+
+# **pair_statistics**
+# 
+# Statistics of the pairs selected by 'mask' (all the pairs by default) of the arrays before and after (pairs x levels, see stack_pairs) on pressure levels 'pres'. 
+# Returns a dictionary of arrays with one item (or one row) per selected pair ('pairs' is the index of the selected pairs):
+# - val_of_max_before/after and pres_of_max_before/after: maximum value of each profile and its pressure,
+# - val_at_shallowest_lev_before/after: value at the shallowest level with data (the first level, when it has data),
+# - val_at_pres_ref_before/after: value at pressure pres_ref (e.g. 50 dbar; nan if pres_ref is not one of the levels),
+# - max_val_in_top_lev_before/after: maximum value in the top_levels shallowest levels (b[0:9] in the pair notebooks),
+# - after_minus_before, before_minus_shallow, after_minus_shallow: profiles of the differences after - before and with the value at the shallowest level,
+# - the after - before differences of the values above ('_diff'),
+# - before_minus_shallow_hist: histogram of before_minus_shallow for each pair (bins hist_edges), 
+# - before_minus_shallow_ppoints_incr: percentage of the levels shallower than pres_max_incr where before_minus_shallow > 0,
+# - hist2d: 2D histogram of after_minus_before (bins diff_bins) and pressure (bins pres_bins) for all the selected pairs.
+# Values are nan where a profile has no data. With processes other than 1, the pairs are processed in a pool of processes (see pair_statistics_parallel).
+@traced('pair_statistics')
+def pair_statistics(before,after,pres,mask=None,top_levels=9,pres_ref=50,hist_edges=np.arange(-10,10,0.1),pres_max_incr=210,
+                    diff_bins=np.arange(-10,11,1),pres_bins=np.arange(10,100,2),processes=1):
+    if processes != 1:
+        return pair_statistics_parallel(before, after, pres, mask=mask, processes=processes, top_levels=top_levels, pres_ref=pres_ref, 
+                                        hist_edges=hist_edges, pres_max_incr=pres_max_incr, diff_bins=diff_bins, pres_bins=pres_bins)
+    pres  = np.asarray(pres, dtype=float)
+    pairs = np.arange(len(before)) if mask is None else np.flatnonzero(mask)
+    stats = {'pairs': pairs}
+    profiles = {'before': np.ma.masked_invalid(np.asarray(before, dtype=float)[pairs]), 
+                'after':  np.ma.masked_invalid(np.asarray(after, dtype=float)[pairs])}
+    rows = np.arange(len(pairs))
+    ref  = np.flatnonzero(pres == pres_ref)
+    for when in profiles:
+        x = profiles[when]
+        has_data = ~np.ma.getmaskarray(x)
+        stats['val_of_max_'+when]  = x.max(axis=1).filled(np.nan)
+        imax = x.argmax(axis=1, fill_value=-np.inf)
+        stats['pres_of_max_'+when] = np.where(has_data.any(axis=1), pres[imax], np.nan)
+        shallowest = x[rows, has_data.argmax(axis=1)].filled(np.nan)
+        stats['val_at_shallowest_lev_'+when] = np.where(has_data.any(axis=1), shallowest, np.nan)
+        stats['val_at_pres_ref_'+when] = x[:, ref[0]].filled(np.nan) if len(ref) else np.full(len(pairs), np.nan)
+        stats['max_val_in_top_lev_'+when] = x[:, 0:top_levels].max(axis=1).filled(np.nan)
+        stats[when+'_minus_shallow'] = (x - stats['val_at_shallowest_lev_'+when][:,np.newaxis]).filled(np.nan)
+    stats['after_minus_before'] = (profiles['after'] - profiles['before']).filled(np.nan)
+    for key in ('val_of_max', 'pres_of_max', 'val_at_shallowest_lev', 'val_at_pres_ref', 'max_val_in_top_lev'):
+        stats[key+'_diff'] = stats[key+'_after'] - stats[key+'_before']
+    stats['before_minus_shallow_hist'] = histogram_rows(stats['before_minus_shallow'], hist_edges)
+    stats['before_minus_shallow_ppoints_incr'] = ((stats['before_minus_shallow'] > 0) & (pres < pres_max_incr)).sum(axis=1) / len(pres) * 100
+    diff  = stats['after_minus_before']
+    valid = ~np.isnan(diff)
+    stats['hist2d'] = np.histogram2d(diff[valid], np.broadcast_to(pres, diff.shape)[valid], bins=(diff_bins, pres_bins))[0]
+    return stats
+
+
+# #### Shared-memory parallel functions
+# ---
+# Interpolation (interp_ragged) and pair statistics (pair_statistics) of large selections can be run in a pool of processes: the input arrays are copied once 
+# into shared memory (multiprocessing.shared_memory), each worker attaches them when it starts and writes its results directly into shared output arrays, 
+# so only the bounds of each shard (a range of rows) are sent to the workers and nothing else is pickled or copied between processes.
+# 
+# Rows are split into shards of chunk_size rows (PARALLEL_CHUNK_SIZE by default) whatever the number of processes, and each row is written by one shard only, 
+# so results are the same for any number of processes (processes=1 runs the same shards in the current process). E.g.:
+# 
+# plevArrays = interp_profiles_plev(profiles, plev, processes=None)          # all the CPUs (or ARGOVIS_PROCESSES)
+# stats = pair_statistics(before, after, pres, mask=mask, processes=16)
+# 
+# benchmarks/bench_parallel.py measures the scaling with the number of processes.
+PARALLEL_PROCESSES  = int(os.environ['ARGOVIS_PROCESSES']) if os.environ.get('ARGOVIS_PROCESSES') else None # None: number of CPUs
+PARALLEL_CHUNK_SIZE = 2000 # rows per shard
+
+_shared = {} # arrays attached by a worker (name: array), and their shared memory blocks
+
+def _shared_attach(specs):
+    _shared.clear()
+    for (name, (block, shape, dtype)) in specs.items():
+        shm = shared_memory.SharedMemory(name=block)
+        _shared[name] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        _shared['_shm_'+name] = shm
+
+def _shared_task(func,start,stop,shard,kwargs):
+    func(_shared, start, stop, shard, **kwargs)
+    return shard
+
+
+# **shared_run**
+# 
+# Run func(arrays, start, stop, shard, **kwargs) for the shards [start, stop) of n_rows rows (shard is the index of the shard) in 'processes' processes. 
+# arrays holds the 'inputs' (dictionary of arrays, copied into shared memory) and the 'outputs' (dictionary name: (shape, dtype, fill value), 
+# created in shared memory), and func writes its results into the outputs. func has to be a module-level function (it is sent to the workers by name). 
+# Returns the outputs as arrays (copied out of shared memory, which is released). Raises the first error of the shards, if any.
+def shared_run(func,inputs,outputs,n_rows,processes=None,chunk_size=None,kwargs=None):
+    if processes is None:
+        processes = PARALLEL_PROCESSES or os.cpu_count() or 1
+    if chunk_size is None:
+        chunk_size = PARALLEL_CHUNK_SIZE
+    kwargs = kwargs or {}
+    shards = [(start, min(start+chunk_size, n_rows)) for start in range(0, n_rows, chunk_size)]
+    processes = max(1, min(processes, len(shards)))
+    blocks = []
+    try:
+        specs  = {}
+        for name in list(inputs) + list(outputs):
+            if name in inputs:
+                values = np.ascontiguousarray(inputs[name])
+                (shape, dtype) = (values.shape, values.dtype)
+            else:
+                (shape, dtype, fill) = outputs[name]
+                dtype = np.dtype(dtype)
+            shm = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape))*dtype.itemsize))
+            blocks.append(shm)
+            array = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+            array[...] = values if name in inputs else fill
+            specs[name] = (shm.name, shape, dtype.str)
+        trace_count('parallel.shards', len(shards))
+        if processes == 1:
+            _shared_attach(specs)
+            try:
+                for (shard, (start, stop)) in enumerate(shards):
+                    _shared_task(func, start, stop, shard, kwargs)
+            finally:
+                _shared_close()
+        else:
+            with ProcessPoolExecutor(max_workers=processes, initializer=_shared_attach, initargs=(specs,)) as pool:
+                futures = [pool.submit(_shared_task, func, start, stop, shard, kwargs) for (shard, (start, stop)) in enumerate(shards)]
+                for future in futures:
+                    future.result()
+        return {name: np.ndarray(specs[name][1], dtype=specs[name][2], buffer=blocks[i].buf).copy() 
+                for (i, name) in enumerate(specs) if name in outputs}
+    finally:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+
+def _shared_close():
+    for name in [name for name in _shared if name.startswith('_shm_')]:
+        _shared[name].close()
+    _shared.clear()
+
+
+def _interp_shard(arrays,start,stop,shard,plev,method,fill_value):
+    offsets = arrays['offsets']
+    (m0, m1) = (offsets[start], offsets[stop])
+    arrays['out'][start:stop] = interp_ragged(arrays['pres'][m0:m1], arrays['values'][m0:m1], offsets[start:stop+1]-m0, plev, 
+                                              method=method, fill_value=fill_value)
+
+
+# **interp_ragged_parallel**
+# 
+# interp_ragged with the profiles split into shards of chunk_size profiles interpolated in 'processes' processes (see Shared-memory parallel functions).
+@traced('interpolate.parallel')
+def interp_ragged_parallel(pres, values, offsets, plev, method='linear', fill_value=-999, processes=None, chunk_size=None):
+    offsets = np.asarray(offsets, dtype=np.int64)
+    plev = np.asarray(plev, dtype=float)
+    n_prof = len(offsets)-1
+    inputs = {'pres': np.asarray(pres, dtype=float), 'values': np.asarray(values, dtype=float), 'offsets': offsets}
+    return shared_run(_interp_shard, inputs, {'out': ((n_prof, len(plev)), np.float32, np.nan)}, n_prof, processes=processes, 
+                      chunk_size=chunk_size, kwargs={'plev': plev, 'method': method, 'fill_value': fill_value})['out']
+
+
+def _pair_statistics_shard(arrays,start,stop,shard,pres,kwargs):
+    pairs = arrays['pairs'][start:stop]
+    stats = pair_statistics(arrays['before'][pairs], arrays['after'][pairs], pres, **kwargs)
+    for key in stats:
+        if key == 'hist2d':
+            arrays['hist2d'][shard] = stats['hist2d']
+        elif key != 'pairs':
+            arrays[key][start:stop] = stats[key]
+
+
+# **pair_statistics_parallel**
+# 
+# pair_statistics with the selected pairs split into shards of chunk_size pairs processed in 'processes' processes (see Shared-memory parallel functions); 
+# hist2d is the sum of the histograms of the shards, added in the order of the shards. Other arguments are those of pair_statistics.
+@traced('pair_statistics.parallel')
+def pair_statistics_parallel(before,after,pres,mask=None,processes=None,chunk_size=None,**kwargs):
+    if chunk_size is None:
+        chunk_size = PARALLEL_CHUNK_SIZE
+    before = np.asarray(before, dtype=float)
+    after  = np.asarray(after, dtype=float)
+    pres   = np.asarray(pres, dtype=float)
+    pairs  = np.arange(len(before)) if mask is None else np.flatnonzero(mask)
+    # shapes and dtypes of the statistics, from an empty selection
+    empty = pair_statistics(before[0:0], after[0:0], pres, **kwargs)
+    n_shards = -(-len(pairs) // chunk_size)
+    outputs = {key: ((len(pairs),)+empty[key].shape[1:], empty[key].dtype, 0 if empty[key].dtype.kind in 'iu' else np.nan) 
+               for key in empty if key not in ('pairs', 'hist2d')}
+    outputs['hist2d'] = ((n_shards,)+empty['hist2d'].shape, empty['hist2d'].dtype, 0)
+    stats = shared_run(_pair_statistics_shard, {'before': before, 'after': after, 'pairs': pairs}, outputs, len(pairs), 
+                       processes=processes, chunk_size=chunk_size, kwargs={'pres': pres, 'kwargs': kwargs})
+    hist2d = empty['hist2d'].copy()
+    for shard in range(n_shards):
+        hist2d += stats['hist2d'][shard]
+    stats['hist2d'] = hist2d
+    return dict({'pairs': pairs}, **{key: stats[key] for key in empty if key != 'pairs'})
+
+
+# #### Profile store functions
+# ---
+# Parsed profiles and TC-pair records can be kept in a columnar store on disk (instead of pickled data frames), in STORE_DIR (or ARGOVIS_STORE_DIR):
+# 
+# STORE_DIR/table/year=2017/basin=AL/part-.../  one directory per append, with one .npy file per column (columns/), 
+#                                               the measurements of the profiles one after the other (measurements/, with _offsets.npy as in parse_into_arrays) 
+#                                               and the minimum and maximum of each column (stats.json)
+# 
+# Columns are stored with compact dtypes (float32 for floats, int32 for integers that fit, fixed-width strings with STORE_NONE for missing values, 
+# arrays of the same length stacked into 2D float32 blocks) and read back as memory maps, i.e. without copying the data. Queries (where) skip the partitions and parts that cannot match (from the directory names and stats.json) 
+# before reading the rows of the remaining parts, e.g.:
+# 
+# parse_into_df(profiles, store='profiles')                                   # parse and append to the store
+# store_append_pairs(pd.read_pickle('HurricaneAdjRawVariableDF_noQC.pkl'))   # TC-pair records (one row per pair)
+# df = store_read_df('pairs', where={'proj_t': ('2013-01-01','2014-01-01'), 'wind': (64, None), 'platform': ['0002902086']})
+# 
+# A condition in 'where' is a tuple (min, max) of values included (None for no bound), a list of values, or a single value; the conditions are combined with 'and'. 
+# 'year' and 'basin' select partitions directly.
+STORE_DIR = os.environ.get('ARGOVIS_STORE_DIR', os.path.join('.', 'ProfileStore'))
+STORE_NONE = '\x1fNone' # stored for None (or nan) in string columns, read back as None by store_read_df
+
+# **basin_of**
+# 
+# Ocean basin of positions, with the basin codes of the TC ids ('AL' North Atlantic, 'EP' eastern North Pacific, 'WP' western North Pacific, 'IO' North Indian, 'SH' Southern Hemisphere).
+# The boundaries are approximate (coastlines of the Americas, Africa and Asia are replaced by meridians), which is enough to partition the store.
+def basin_of(lons,lats):
+    lon = (np.asarray(lons, dtype=float)+180) % 360 - 180
+    lat = np.asarray(lats, dtype=float)
+    return np.select([lat < 0, (lon >= 30) & (lon < 100), lon >= 100, (lon < -100) | ((lon < -85) & (lat < 16))], 
+                     ['SH', 'IO', 'WP', 'EP'], default='AL')
+
+
+# **compact_array**
+# 
+# Convert a column (array or list) to the dtype used in the store: float32, int32 (for integers that fit), fixed-width strings (None and nan as STORE_NONE), 
+# datetime64/timedelta64 (unchanged), and a 2D float32 block for columns whose items are arrays of the same length.
+def compact_array(values):
+    values = np.asarray(values) if not isinstance(values, pd.Series) else values.to_numpy()
+    if values.dtype == object and len(values) > 0:
+        if all(isinstance(value, str) for value in values):
+            values = values.astype(str)
+        elif all(isinstance(value, (list, tuple, np.ndarray)) for value in values):
+            values = np.stack([np.asarray(value, dtype=np.float32) for value in values])
+        elif all(isinstance(value, (pd.Timestamp, datetime)) for value in values):
+            values = pd.DatetimeIndex(values).to_numpy()
+        else:
+            values = values_to_array(list(values))
+        if values.dtype == object:
+            missing = np.array([value is None or (isinstance(value, float) and np.isnan(value)) for value in values], dtype=bool)
+            values = np.where(missing, STORE_NONE, values.astype(str))
+    if values.dtype.kind == 'f':
+        return values.astype(np.float32)
+    if values.dtype.kind in 'iu' and values.dtype.itemsize > 4:
+        if len(values) == 0 or (values.min() >= np.iinfo(np.int32).min and values.max() <= np.iinfo(np.int32).max):
+            return values.astype(np.int32)
+    return values
+
+
+def _store_stats(columns):
+    stats = {'rows': len(next(iter(columns.values()))) if columns else 0, 'columns': list(columns), 'min': {}, 'max': {}}
+    for key in columns:
+        values = columns[key]
+        if values.ndim != 1 or len(values) == 0 or values.dtype.kind not in 'iufUMm':
+            continue
+        if values.dtype.kind == 'f':
+            if np.isnan(values).all():
+                continue
+            (low, high) = (np.nanmin(values), np.nanmax(values))
+        elif values.dtype.kind in 'Mm':
+            if np.isnat(values).all():
+                continue
+            (low, high) = (values[~np.isnat(values)].min(), values[~np.isnat(values)].max())
+        elif values.dtype.kind == 'U':
+            (low, high) = (min(values), max(values))
+        else:
+            (low, high) = (values.min(), values.max())
+        stats['min'][key] = low.item() if values.dtype.kind in 'iuf' else str(low)
+        stats['max'][key] = high.item() if values.dtype.kind in 'iuf' else str(high)
+    return stats
+
+
+def _store_table(table,store_dir=None):
+    return os.path.join(store_dir or STORE_DIR, table)
+
+def _store_info(table,store_dir=None):
+    try:
+        with open(os.path.join(_store_table(table, store_dir), 'table.json')) as f:
+            return json.load(f)
+    except OSError:
+        return None
+
+
+# **store_append**
+# 
+# Append rows to a table of the store: columns is a dictionary of arrays with one item (or one row, for 2D columns) per record, and measurements/offsets 
+# optionally hold the measurements of each record one after the other (as in parse_into_arrays, record i has measurements offsets[i]:offsets[i+1]).
+# Rows are partitioned by the year of columns[date_key] and by basin (columns['basin'] if given, otherwise basin_of(lon, lat)). 
+# Each partition is written to a new part directory, renamed into place when complete, so readers never see a partial append.
+@traced('store.append')
+def store_append(table,columns,measurements=None,offsets=None,date_key='date',store_dir=None):
+    columns = {key: compact_array(columns[key]) for key in columns}
+    measurements = {key: compact_array(measurements[key]) for key in (measurements or {})}
+    rows = len(columns[date_key])
+    if rows == 0:
+        return []
+    table_dir = _store_table(table, store_dir)
+    os.makedirs(table_dir, exist_ok=True)
+    info = _store_info(table, store_dir)
+    if info is None:
+        with open(os.path.join(table_dir, 'table.json'), 'w') as f:
+            json.dump({'date_key': date_key}, f)
+    elif info['date_key'] != date_key:
+        raise ValueError("table '" + table + "' is partitioned by '" + info['date_key'] + "', not '" + date_key + "'")
+    years = pd.DatetimeIndex(columns[date_key]).year.to_numpy()
+    if 'basin' in columns:
+        basins = columns['basin'].astype(str)
     else:
-        plt.plot(b[b_mask],b_yax[b_mask],linewidth=0,color='k',marker='*',label=b_tag)
-        plt.plot(a[a_mask],a_yax[a_mask],linewidth=0,color='r',marker='*',label=a_tag)
-    plt.title(title_plot,fontsize=font_size)
-    plt.gca().set_xlabel(x_tag,fontsize=font_size)
-    plt.gca().set_ylabel(y_tag,fontsize=font_size)
-    plt.ylim(y_lim)
-    plt.gca().invert_yaxis()
-    plt.legend(fontsize=font_size*.8)
+        basins = basin_of(columns['lon'], columns['lat'])
+    if offsets is not None:
+        offsets = np.asarray(offsets, dtype=np.int64)
+    written = []
+    for (year, basin) in sorted(set(zip(years, basins))):
+        rows_part = np.flatnonzero((years == year) & (basins == basin))
+        part_columns = {key: columns[key][rows_part] for key in columns}
+        part_dir = os.path.join(table_dir, 'year='+str(year), 'basin='+basin, 
+                                'part-{}-{}'.format(time.time_ns(), hashlib.sha256(os.urandom(8)).hexdigest()[:8]))
+        tmp_dir = os.path.join(table_dir, '.tmp-' + os.path.basename(part_dir))
+        os.makedirs(os.path.join(tmp_dir, 'columns'))
+        for key in part_columns:
+            np.save(os.path.join(tmp_dir, 'columns', key+'.npy'), part_columns[key])
+        if offsets is not None:
+            (index, part_offsets) = ragged_take(offsets, rows_part)
+            os.makedirs(os.path.join(tmp_dir, 'measurements'))
+            np.save(os.path.join(tmp_dir, 'measurements', '_offsets.npy'), part_offsets)
+            for key in measurements:
+                np.save(os.path.join(tmp_dir, 'measurements', key+'.npy'), measurements[key][index])
+        stats = _store_stats(part_columns)
+        stats['measurements'] = list(measurements) if offsets is not None else []
+        with open(os.path.join(tmp_dir, 'stats.json'), 'w') as f:
+            json.dump(stats, f)
+        os.makedirs(os.path.dirname(part_dir), exist_ok=True)
+        os.replace(tmp_dir, part_dir)
+        written.append(part_dir)
+    return written
+
+
+# **ragged_take**
+# 
+# Index of the measurements of records 'rows' (for records stored one after the other with offsets) and the offsets of the selected records.
+def ragged_take(offsets,rows):
+    counts = np.diff(offsets)[rows]
+    new_offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+    index = np.arange(new_offsets[-1]) - np.repeat(new_offsets[:-1] - offsets[:-1][rows], counts)
+    return index, new_offsets
+
+
+def _store_bound(value,dtype):
+    if value is None:
+        return None
+    if dtype.kind == 'M':
+        return np.datetime64(to_utc_naive([value])[0])
+    if dtype.kind == 'm':
+        return np.timedelta64(pd.Timedelta(value))
+    return value
+
+# does condition 'cond' select rows of 'values' (or, with values=None, could it select rows in the range [low, high])
+def _store_match(cond,values=None,low=None,high=None,dtype=None):
+    if values is not None:
+        dtype = values.dtype
+    if isinstance(cond, tuple):
+        (cmin, cmax) = (_store_bound(cond[0], dtype), _store_bound(cond[1], dtype))
+        if values is None:
+            return (cmin is None or high >= cmin) and (cmax is None or low <= cmax)
+        mask = np.ones(len(values), dtype=bool)
+        if cmin is not None:
+            mask &= values >= cmin
+        if cmax is not None:
+            mask &= values <= cmax
+        return mask
+    choices = [_store_bound(value, dtype) for value in (cond if isinstance(cond, (list, set, np.ndarray)) else [cond])]
+    if values is None:
+        return any(low <= value <= high for value in choices)
+    return np.isin(values, np.array(choices, dtype=dtype if dtype.kind in 'Mm' else None))
+
+def _store_stat(value,dtype):
+    return np.array(value, dtype=dtype)[()] if dtype.kind in 'Mm' else value
+
+
+# **iter_store_parts**
+# 
+# Parts of a table that match 'where' (see Profile store functions), yielding for each part (columns, measurements, offsets, rows): 
+# the memory-mapped arrays of the part (no data is read until used) and the index of the rows that match. 
+# Partitions are skipped from their names ('year', 'basin' and the year of the date column), and parts from their stats.json.
+def iter_store_parts(table,where=None,store_dir=None):
+    where = dict(where or {})
+    info  = _store_info(table, store_dir)
+    if info is None:
+        return
+    date_key = info['date_key']
+    years  = where.pop('year', None)
+    basins = where.pop('basin', None)
+    if years is not None and not isinstance(years, tuple):
+        years = set(int(year) for year in (years if isinstance(years, (list, set, np.ndarray)) else [years]))
+    if basins is not None and not isinstance(basins, (list, set, np.ndarray)):
+        basins = [basins]
+    if isinstance(where.get(date_key), tuple):
+        (start, end) = where[date_key]
+        date_years = (None if start is None else pd.Timestamp(start).year, None if end is None else pd.Timestamp(end).year)
+    else:
+        date_years = (None, None)
+    table_dir = _store_table(table, store_dir)
+    for year_dir in sorted(os.listdir(table_dir)):
+        if not year_dir.startswith('year='):
+            continue
+        year = int(year_dir[5:])
+        if isinstance(years, tuple) and not ((years[0] is None or year >= years[0]) and (years[1] is None or year <= years[1])):
+            continue
+        if isinstance(years, set) and year not in years:
+            continue
+        if (date_years[0] is not None and year < date_years[0]) or (date_years[1] is not None and year > date_years[1]):
+            continue
+        for basin_dir in sorted(os.listdir(os.path.join(table_dir, year_dir))):
+            if basins is not None and basin_dir[6:] not in basins:
+                continue
+            for part in sorted(os.listdir(os.path.join(table_dir, year_dir, basin_dir))):
+                part_dir = os.path.join(table_dir, year_dir, basin_dir, part)
+                with open(os.path.join(part_dir, 'stats.json')) as f:
+                    stats = json.load(f)
+                columns = {key: np.load(os.path.join(part_dir, 'columns', key+'.npy'), mmap_mode='r') for key in stats['columns']}
+                skip = False
+                for key in where:
+                    if key not in columns:
+                        raise KeyError("no column '" + key + "' in table '" + table + "'")
+                    dtype = columns[key].dtype
+                    if key not in stats['min']:
+                        skip = True # only missing values
+                    elif not _store_match(where[key], low=_store_stat(stats['min'][key], dtype), high=_store_stat(stats['max'][key], dtype), dtype=dtype):
+                        skip = True
+                    if skip:
+                        break
+                if skip:
+                    continue
+                mask = np.ones(stats['rows'], dtype=bool)
+                for key in where:
+                    mask &= _store_match(where[key], values=columns[key])
+                rows = np.flatnonzero(mask)
+                if len(rows) == 0:
+                    continue
+                measurements = {}
+                offsets = None
+                if os.path.isdir(os.path.join(part_dir, 'measurements')):
+                    measurements = {key: np.load(os.path.join(part_dir, 'measurements', key+'.npy'), mmap_mode='r') for key in stats['measurements']}
+                    offsets = np.load(os.path.join(part_dir, 'measurements', '_offsets.npy'), mmap_mode='r')
+                yield columns, measurements, offsets, rows
+
+
+# **store_read**
+# 
+# Read the rows of a table that match 'where' (see Profile store functions) as arrays: returns (columns, measurements, offsets) as for store_append 
+# (measurements is empty and offsets is None for tables without measurements). 'columns' and 'variables' restrict the columns and measurements read.
+# When all the rows of a single part match, the arrays are the memory maps themselves (no copy). Missing values of string columns are STORE_NONE.
+@traced('store.read')
+def store_read(table,where=None,columns=None,variables=None,store_dir=None):
+    parts = list(iter_store_parts(table, where, store_dir))
+    # parts may not have the same columns (e.g. bgc variables), missing values are nan
+    if columns is None:
+        columns = list(dict.fromkeys(key for part in parts for key in part[0]))
+    if variables is None:
+        variables = list(dict.fromkeys(key for part in parts for key in part[1]))
+    out_columns, out_measurements, out_offsets = {}, {}, [np.zeros(1, dtype=np.int64)]
+    for (part_columns, part_measurements, offsets, rows) in parts:
+        whole = len(parts) == 1 and len(rows) == len(next(iter(part_columns.values())))
+        for key in columns:
+            if key in part_columns:
+                out_columns.setdefault(key, []).append(part_columns[key] if whole else part_columns[key][rows])
+            else:
+                out_columns.setdefault(key, []).append(np.full(len(rows), np.nan, dtype=np.float32))
+        if offsets is None:
+            continue
+        (index, new_offsets) = (None, np.asarray(offsets)) if whole else ragged_take(offsets, rows)
+        for key in variables:
+            if key in part_measurements:
+                out_measurements.setdefault(key, []).append(part_measurements[key] if whole else part_measurements[key][index])
+            else:
+                out_measurements.setdefault(key, []).append(np.full(new_offsets[-1], np.nan, dtype=np.float32))
+        out_offsets.append(new_offsets[1:] + out_offsets[-1][-1])
+    if len(parts) == 1:
+        return ({key: out_columns[key][0] for key in out_columns}, {key: out_measurements[key][0] for key in out_measurements}, 
+                (np.concatenate(out_offsets) if len(out_offsets) > 1 else None))
+    return ({key: np.concatenate(out_columns[key]) for key in out_columns}, 
+            {key: np.concatenate(out_measurements[key]) for key in out_measurements}, 
+            (np.concatenate(out_offsets) if len(out_offsets) > 1 else None))
+
+
+# **store_read_df**
+# 
+# store_read as a data frame. For tables with measurements, one row per measurement (the columns of each record are repeated, and the index restarts 
+# from 0 for each record, as in parse_into_df); otherwise one row per record, 2D columns (e.g. profiles on pressure levels) holding one array per row 
+# (a view of the stored block). Missing values of string columns are None.
+def store_read_df(table,where=None,columns=None,variables=None,store_dir=None):
+    (columns, measurements, offsets) = store_read(table, where, columns, variables, store_dir)
+    columns = _store_none(dict(columns))
+    if offsets is not None:
+        counts = np.diff(offsets)
+        data = {key: np.repeat(columns[key], counts) for key in columns}
+        data.update(measurements)
+        return pd.DataFrame(data, index=np.arange(offsets[-1]) - np.repeat(offsets[:-1], counts))
+    return pd.DataFrame({key: (list(columns[key]) if columns[key].ndim > 1 else columns[key]) for key in columns})
+
+# string columns with missing values (STORE_NONE) as objects with None
+def _store_none(columns):
+    for key in columns:
+        values = columns[key]
+        if values.ndim == 1 and values.dtype.kind == 'U':
+            missing = values == STORE_NONE
+            if missing.any():
+                values = values.astype(object)
+                values[missing] = None
+                columns[key] = values
+    return columns
+
+
+# **store_profile_ids**
+# 
+# Set of the values of column 'key' (e.g. the profile ids) in the table (or in the partitions selected by 'where').
+def store_profile_ids(table,where=None,key='profile_id',store_dir=None):
+    ids = set()
+    for (columns, measurements, offsets, rows) in iter_store_parts(table, where, store_dir):
+        ids.update(np.asarray(columns[key][rows]).tolist())
+    return ids
+
+
+# **profile_records**
+# 
+# One record per profile for the store (see store_append_profiles).
+def profile_records(profiles):
+    if is_profile_arrays(profiles):
+        return {key: profiles[key] for key in ('profile_id', 'platform', 'cycle_number', 'date', 'lat', 'lon', 'position_qc', 'containsBGC') if key in profiles}
+    record = {'profile_id':   np.array([profile['_id'] for profile in profiles], dtype=str),
+              'platform':     np.array([str(profile['_id']).split('_')[0] for profile in profiles], dtype=str),
+              'cycle_number': np.array([profile['cycle_number'] for profile in profiles], dtype=np.int32),
+              'date':         to_utc_naive([profile['date'] for profile in profiles]).to_numpy(),
+              'lat':          values_to_array([profile['lat'] for profile in profiles]),
+              'lon':          values_to_array([profile['lon'] for profile in profiles]),
+              'position_qc':  values_to_array([profile.get('position_qc') for profile in profiles])}
+    if any('containsBGC' in profile for profile in profiles):
+        record['containsBGC'] = values_to_array([profile.get('containsBGC') for profile in profiles])
+    return record
+
+
+# profiles of 'record' that are not yet in the table
+def _store_new(table,record,store_dir=None):
+    if _store_info(table, store_dir) is None or len(record['profile_id']) == 0:
+        return np.ones(len(record['profile_id']), dtype=bool)
+    years = pd.DatetimeIndex(record['date']).year
+    existing = store_profile_ids(table, where={'year': (int(years.min()), int(years.max()))}, store_dir=store_dir)
+    return ~np.isin(record['profile_id'], list(existing))
+
+
+# **store_append_profiles**
+# 
+# Append profiles (e.g. get_platform_profiles or get_selection_profiles output) to a table: one record per profile (profile_id, platform, cycle_number, 
+# date, lat, lon, position_qc and containsBGC if present) with its measurements. 'arrays' is the output of parse_into_arrays for these profiles, if already computed.
+# Profiles already in the table are skipped (skip_existing=False to append them again).
+def store_append_profiles(profiles,table='profiles',arrays=None,skip_existing=True,store_dir=None):
+    (columns, offsets) = arrays if arrays is not None else parse_into_arrays(profiles)
+    record = profile_records(profiles)
+    keep = _store_new(table, record, store_dir) if skip_existing else np.ones(len(record['profile_id']), dtype=bool)
+    rows = np.flatnonzero(keep)
+    (index, offsets) = ragged_take(np.asarray(offsets), rows)
+    measurements = {key: columns[key][index] for key in columns if key not in record and key not in ('profile_id', 'containsBGC')}
+    return store_append(table, {key: record[key][rows] for key in record}, measurements, offsets, store_dir=store_dir)
+
+
+# **store_append_plev**
+# 
+# Append profiles interpolated on pressure levels plev (plevArrays is the output of interp_profiles_plev for these profiles) to a table: 
+# one record per profile (as store_append_profiles, plus date_qc) with one row of temp, psal and pres per profile. 
+# Profiles already in the table are skipped (skip_existing=False to append them again).
+def store_append_plev(profiles,plev,plevArrays,table='profiles_plev',skip_existing=True,store_dir=None):
+    record = profile_records(profiles)
+    record['date_qc'] = profile_values(profiles, 'date_qc')
+    for var in plevArrays:
+        record[var] = plevArrays[var]
+    record['pres'] = np.tile(np.asarray(plev, dtype=np.float32), (len(record['profile_id']), 1))
+    keep = _store_new(table, record, store_dir) if skip_existing else np.ones(len(record['profile_id']), dtype=bool)
+    return store_append(table, {key: record[key][keep] for key in record}, store_dir=store_dir)
+
+
+# **store_append_pairs**
+# 
+# Append TC-pair records (one row per pair of profiles before/after a TC, e.g. the data frame in HurricaneAdjRawVariableDF_noQC.pkl) to a table. 
+# Rows are partitioned by the year of the TC passage (proj_t) and by the basin of the TC (first two letters of HurricaneID); 
+# a 'platform' column (from before_pid) is added for queries by platform.
+def store_append_pairs(df,table='pairs',store_dir=None):
+    columns = {key: df[key].to_numpy() for key in df.columns}
+    columns['basin'] = df['HurricaneID'].astype(str).str[0:2].to_numpy()
+    columns['platform'] = df['before_pid'].astype(str).str.split('_').str[0].to_numpy()
+    return store_append(table, columns, date_key='proj_t', store_dir=store_dir)
+
+
+# #### Platform section functions
+# ---
+# Time sections of a platform (temp2d, psal2d in the notebooks: one row per pressure level, one column per cycle) kept on disk in STORE_DIR/sections/<platform_number>/ 
+# and updated incrementally: platform_section_update only parses and interpolates the profiles not stored yet (by profile id), and writes them after the cycles 
+# already stored, in place. Each variable (and each metadata column) is a raw file with one row of levels per cycle, preallocated for SECTION_CAPACITY cycles and 
+# grown by extending the file when full, so the cycles already stored are never copied; the section (levels x cycles) is a transposed view of it. 
+# section.json (pressure levels, dtypes, capacity and number of cycles) is replaced once the new cycles are written, so readers never see a partial update 
+# (except when a late profile belongs before cycles already stored, e.g. a descending profile '_D' received after the next cycle: the stored cycles after it 
+# are then rewritten in place to keep the order by cycle number and profile id):
+# 
+# section = platform_section_update('7900414', np.arange(5,505,5))    # first call: all the cycles, then only the new ones
+# temp2d, psal2d = section['temp'], section['psal']                     # levels x cycles (memory maps, read only)
+SECTION_CAPACITY = 256 # cycles preallocated for a new section (the capacity is doubled when full)
+SECTION_META = {'cycle_number': 'i4', 'profile_id': 'U32', 'date': 'M8[s]', 'lat': 'f8', 'lon': 'f8', 'position_qc': 'f4', 'date_qc': 'f4'}
+
+def _section_dir(platform_number,store_dir=None):
+    return os.path.join(store_dir or STORE_DIR, 'sections', str(platform_number))
+
+def _section_info(section_dir):
+    try:
+        with open(os.path.join(section_dir, 'section.json')) as f:
+            return json.load(f)
+    except OSError:
+        return None
+
+def _section_row_bytes(info,key):
+    return np.dtype(info['dtypes'][key]).itemsize * (len(info['plev']) if key in info['variables'] else 1)
+
+def _section_map(section_dir,info,key,mode='r'):
+    shape = (info['capacity'], len(info['plev'])) if key in info['variables'] else (info['capacity'],)
+    return np.memmap(os.path.join(section_dir, key+'.bin'), dtype=info['dtypes'][key], mode=mode, shape=shape)
+
+def _section_resize(section_dir,info,capacity):
+    # extending a file does not move the data already written (the new rows are zeros)
+    for key in info['dtypes']:
+        with open(os.path.join(section_dir, key+'.bin'), 'ab') as f:
+            f.truncate(capacity*_section_row_bytes(info, key))
+    info['capacity'] = capacity
+
+# number of stored cycles before (cycle_number, profile_id), the order of the section
+def _section_position(section_dir,info,cycle_number,profile_id):
+    n = info['n']
+    if n == 0:
+        return 0
+    cycles = _section_map(section_dir, info, 'cycle_number')[0:n]
+    (p, q) = (np.searchsorted(cycles, cycle_number, 'left'), np.searchsorted(cycles, cycle_number, 'right'))
+    return int(p + np.searchsorted(_section_map(section_dir, info, 'profile_id')[p:q], str(profile_id)))
+
+
+# **platform_section**
+# 
+# The section of a platform stored by platform_section_update (None if there is none): a dictionary with platform, plev, n (number of cycles), 
+# one array per variable (levels x cycles) and one array per metadata column (cycle_number, profile_id, date, lat, lon, position_qc, date_qc), 
+# all memory-mapped views of the stored files, ordered by cycle number (and profile id for the profiles of a cycle, e.g. '_D' after the ascending profile).
+def platform_section(platform_number,store_dir=None):
+    section_dir = _section_dir(platform_number, store_dir)
+    info = _section_info(section_dir)
+    if info is None:
+        return None
+    n = info['n']
+    section = {'platform': str(platform_number), 'plev': np.array(info['plev']), 'n': n}
+    for key in info['dtypes']:
+        values = _section_map(section_dir, info, key)[0:n]
+        section[key] = values.T if key in info['variables'] else values
+    return section
+
+
+# **platform_section_update**
+# 
+# Add the profiles of a platform that are not in its section yet (by profile id) to the section, creating the section on the first call 
+# (plev is then required; later calls use the stored levels, and a different plev raises ValueError). 'profiles' are the profiles of the platform if already 
+# fetched (e.g. get_platform_profiles output, or profile arrays); otherwise the platform is queried with stream_json_items and the stored profiles are skipped as they are read 
+# (Argovis has no query for the cycles after a given one), so only the new profiles are kept, parsed and interpolated (interp_profiles_plev, 'method' as in 
+# parse_into_df_plev). New profiles are usually the cycles after the last one stored; a late profile of an older cycle is inserted in order (see Platform section functions). 
+# Raises RuntimeError if the query fails. Returns the updated section (see platform_section).
+@traced('section.update')
+def platform_section_update(platform_number,plev=None,profiles=None,variables=('temp','psal'),method='linear',store_dir=None):
+    section_dir = _section_dir(platform_number, store_dir)
+    info = _section_info(section_dir)
+    if info is None:
+        if plev is None:
+            raise ValueError('no section for platform ' + str(platform_number) + ', plev is required to create it')
+        info = {'plev': np.asarray(plev, dtype=float).tolist(), 'variables': list(variables), 'n': 0, 'capacity': 0,
+                'dtypes': dict(SECTION_META, **{var: 'f4' for var in variables})}
+        os.makedirs(section_dir, exist_ok=True)
+        _section_resize(section_dir, info, SECTION_CAPACITY)
+    elif plev is not None and not np.array_equal(np.asarray(plev, dtype=float), info['plev']):
+        raise ValueError('the section of platform ' + str(platform_number) + ' is on other pressure levels')
+    n = info['n']
+    stored = set(_section_map(section_dir, info, 'profile_id')[0:n].tolist()) if n > 0 else set()
+    if profiles is None:
+        profiles = stream_json_items(platform_profiles_url(platform_number))
+    if is_profile_arrays(profiles):
+        rows = np.flatnonzero(~np.isin(profiles['profile_id'], list(stored)))
+        new = take_profiles(profiles, rows[np.lexsort((profiles['profile_id'][rows], profiles['cycle_number'][rows]))])
+    else:
+        new = [profile for profile in profiles if str(profile['_id']) not in stored]
+        new.sort(key=lambda profile: (profile['cycle_number'], str(profile['_id'])))
+    record = profile_records(new)
+    k = len(record['profile_id'])
+    trace_count('section.cycles', k)
+    if k == 0:
+        return platform_section(platform_number, store_dir)
     
-    for tick in plt.gca().xaxis.get_majorticklabels():  # example for xaxis
-        tick.set_fontsize(font_size) 
-    for tick in plt.gca().yaxis.get_majorticklabels():  # example for xaxis
-        tick.set_fontsize(font_size) 
\ No newline at end of file
+    record['date_qc'] = profile_values(new, 'date_qc')
+    record.update(interp_profiles_plev(new, info['plev'], variables=info['variables'], method=method))
+    # stored cycles after the first new profile (none unless a late profile of an older cycle arrived) are merged with the new profiles and rewritten
+    p = _section_position(section_dir, info, record['cycle_number'][0], record['profile_id'][0])
+    if p < n:
+        record = {key: np.concatenate((np.array(_section_map(section_dir, info, key)[p:n]), np.asarray(record[key], dtype=info['dtypes'][key])))
+                  for key in info['dtypes']}
+        order = np.lexsort((record['profile_id'], record['cycle_number']))
+        record = {key: values[order] for (key, values) in record.items()}
+    capacity = info['capacity']
+    while n+k > capacity:
+        capacity *= 2
+    if capacity > info['capacity']:
+        _section_resize(section_dir, info, capacity)
+    for key in info['dtypes']:
+        values = _section_map(section_dir, info, key, mode='r+')
+        values[p:n+k] = record[key]
+        values.flush()
+        del values
+    info['n'] = n+k
+    tmp = os.path.join(section_dir, 'section.json.tmp-'+str(os.getpid()))
+    with open(tmp, 'w') as f:
+        json.dump(info, f)
+    os.replace(tmp, os.path.join(section_dir, 'section.json'))
+    return platform_section(platform_number, store_dir)
+
+
+# **platform_section_df**
+# 
+# A platform section as a data frame with the columns of parse_into_df_plev (one row per cycle; pres, temp and psal hold one array per row, views of the section).
+def platform_section_df(section):
+    df = pd.DataFrame({'cycle_number': section['cycle_number'], '_id': section['profile_id'], 
+                       'date': argovis_dates(section['date']), 'lon': section['lon'], 'lat': section['lat']})
+    df['pres'] = [section['plev']]*section['n']
+    for var in ('temp', 'psal'):
+        if var in section:
+            df[var] = list(section[var].T)
+    df['position_qc'] = section['position_qc']
+    df['date_qc'] = section['date_qc']
+    return df
+
+
+# #### Lazy imports
+# ---
+# The plotting functions (maps, profile plots, batch rendering) are in utilities_plotting, and scipy, matplotlib, cartopy and svgpath2mpl are only 
+# imported when first needed, so that 'import utilities' only loads numpy, pandas and requests. The names below are resolved on first access 
+# (utilities.map_TC, or 'from utilities import *' in a notebook) and then kept in the module, e.g.:
+# 
+# from utilities import *      # loads the plotting layer as well, as before
+# import utilities             # data functions only (fetch, parse, interpolate)
+# 
+# benchmarks/bench_startup.py checks the import time of utilities and that it does not load the heavy dependencies.
+LAZY_MODULES = {'interpolate':         ('scipy.interpolate', None),
+                'cKDTree':             ('scipy.spatial', 'cKDTree'),
+                'matplotlib':          ('matplotlib', None),
+                'plt':                 ('matplotlib.pylab', None),
+                'cm':                  ('matplotlib.cm', None),
+                'mdates':              ('matplotlib.dates', None),
+                'ccrs':                ('cartopy.crs', None),
+                'cft':                 ('cartopy.feature', None),
+                'LONGITUDE_FORMATTER': ('cartopy.mpl.gridliner', 'LONGITUDE_FORMATTER'),
+                'LATITUDE_FORMATTER':  ('cartopy.mpl.gridliner', 'LATITUDE_FORMATTER'),
+                'parse_path':          ('svgpath2mpl', 'parse_path')}
+LAZY_PLOTTING = ['hurricane', 'get_hurricane_marker', 'hurricane_marker', 'map_features', 
+                 'plot_tracks_time_in_col', 'map_km_per_pixel', 'map_TC_tracks', 'draw_TC_map', 'map_TC', 'map_TC_and_Argo', 
+                 'plot_prof', 'draw_prof_pair', 'plot_prof_pairs', 'plot_bgc_var', 'make_plot', 
+                 'new_figure', 'build_map_TC', 'build_prof_pair', 'build_make_plot', 'FIGURE_BUILDERS', 
+                 'prof_pairs_jobs', 'render_figures']
+
+def __getattr__(name):
+    import importlib
+    if name in LAZY_MODULES:
+        (module_name, attr) = LAZY_MODULES[name]
+        value = importlib.import_module(module_name)
+        if attr is not None:
+            value = getattr(value, attr)
+    elif name in LAZY_PLOTTING:
+        value = getattr(importlib.import_module('utilities_plotting'), name)
+    else:
+        raise AttributeError("module 'utilities' has no attribute '" + name + "'")
+    globals()[name] = value
+    return value
+
+__all__ = [name for name in list(globals()) if not name.startswith('_')] + list(LAZY_MODULES) + LAZY_PLOTTING
+
+def __dir__():
+    return sorted(set(list(globals()) + __all__))
@@ -0,0 +1,484 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Plotting functions of utilities (maps of TC tracks and Argo profiles, profile plots and batch rendering of figures). 
+# utilities loads this module on first use of any of these functions, so that the data functions can be used without matplotlib and cartopy.
+
+# Data manipulation
+import os
+import time
+import functools
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+# Visualizations
+import matplotlib
+import matplotlib.pylab as plt
+import matplotlib.figure
+import matplotlib.colors
+from matplotlib.collections import LineCollection
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+import cartopy.crs as ccrs
+import cartopy.feature as cft
+from cartopy.mpl.gridliner import LONGITUDE_FORMATTER, LATITUDE_FORMATTER
+
+from utilities import TC_track_arrays, simplify_tracks, EARTH_RADIUS_KM, colocate_TC_and_Argo, load_bgc_profiles, bgc_profile_ids, bgc_profiles_with, bgc_profile, traced, trace_count, trace_time
+
+#prevent warnings from showing on screen
+import warnings
+warnings.filterwarnings('ignore')
+
+
+# **get_hurricane_marker**
+# 
+# Generates a hurricane marker for plotting.
+#
+# create a marker for tropical cyclones
+def get_hurricane_marker():
+    from svgpath2mpl import parse_path
+    hurricane = parse_path("""M 188.79857,492.55018 L 180.09663,484.17671 L 188.57725,474.97463 
+     C 212.44187,449.07984 230.37031,423.34927 246.04359,392.5 
+     C 254.14781,376.5487 265.0005,350.78866 265.0005,347.50373 
+     C 265.0005,346.53236 263.21255,347.40666 259.7505,350.07094 
+     C 251.67361,356.28665 233.85001,364.64767 222.5005,367.54485 
+     C 204.24051,372.20605 178.92084,371.97166 159.45635,366.96123 
+     C 147.77122,363.95331 130.93184,355.3283 122.0005,347.77659 
+     C 95.11018,325.04006 81.65749,291.36529 81.74139,247 
+     C 81.78993,221.33674 85.91479,197.1747 94.55247,171.95714 
+     C 111.06665,123.74428 136.98179,82.210848 180.29075,34.54693 
+     L 185.6999,28.59386 L 189.6002,31.718323 
+     C 191.74536,33.436777 195.9159,37.308373 198.86805,40.32187 
+     L 204.23561,45.800955 L 193.66355,57.483549 
+     C 168.69038,85.080007 151.53704,109.91644 136.8182,139.79028 
+     C 130.67851,152.2516 118.91503,180.17836 119.52809,180.83739 
+     C 119.70071,181.02295 122.91512,178.62979 126.67122,175.51926 
+     C 144.84799,160.46658 171.06913,152.9127 200.0005,154.39429 
+     C 227.96505,155.82638 249.78837,164.40176 267.15103,180.78081 
+     C 291.49094,203.74185 302.41509,234.21538 302.36063,279 
+     C 302.33536,299.77768 300.97355,312.12979 296.41891,332.89349 
+     C 286.70405,377.18157 262.85893,424.36347 228.55502,467.17452 
+     C 219.26505,478.76833 199.25099,501.02345 198.17004,500.96183 
+     C 197.80179,500.94084 193.58463,497.15559 188.79857,492.55018 
+     z M 212.92994,343.99452 C 242.28307,336.85605 266.31414,312.68729 
+     273.9846,282.59004 C 276.76052,271.6979 276.75301,253.72727 273.96762,242 
+     C 266.78666,211.76606 241.98871,187.12253 211.5005,179.92186 
+     C 203.8953,178.12567 200.40831,177.86988 189.0005,178.27134 
+     C 173.93019,178.80168 167.30498,180.26871 156.08925,185.55888 
+     C 132.8924,196.50023 116.23621,216.81521 109.90648,241.88639 
+     C 108.09535,249.06004 107.84969,252.38603 108.2077,264.88639 
+     C 108.58615,278.10034 108.93262,280.39476 111.82513,288.842 
+     C 113.58452,293.98009 116.23139,300.28009 117.70707,302.842 
+     C 137.50495,337.21285 174.70639,353.29022 212.92994,343.99452 z""")
+    return hurricane
+# **hurricane_marker**
+# 
+# The hurricane marker centred on (0, 0), created on first use (also available as 'hurricane').
+@functools.lru_cache(maxsize=None)
+def hurricane_marker():
+    hurricane = get_hurricane_marker()
+    hurricane.vertices -= hurricane.vertices.mean()
+    return hurricane
+
+def __getattr__(name):
+    if name == 'hurricane':
+        return hurricane_marker()
+    raise AttributeError("module 'utilities_plotting' has no attribute '" + name + "'")
+
+
+# ### Data visualization functions
+# ---
+# #### Tropical cyclone visualization functions
+# ---
+
+# **plot_tracks_time_in_col**
+# 
+# This function plots Tropical Cyclone tracks ('TCs_Dict') that are output by get_TCs_byDate and get_TCs_byNameYear.
+# 
+# df_ctag is a tag for the variable plotted in the colorbar: e.g. df_ctag='wind' plots maximum sustained winds for the TC at each position along the track. 
+# 
+# df_title is a tag for the figure title. If df_title='', the default title is used: 'Tropical Cyclone tracks'.
+# 
+# tag_TC_or_SH_FILT = 'TC' to map TCs only.
+# 
+# This function has the capability to map tracks for Southern Hemisphere storms using tag_TC_or_SH_FILT = 'SH_FILT'. Nevertheless, the database for Southern Hemisphere storms is still in development. See Section 1.9.
+# 
+# Tracks are drawn as one collection of line segments (coloured by df_ctag at the start of each segment) instead of one scatter plot per storm: 
+# the track points of all the storms are put in arrays (TC_track_arrays) and simplified (simplify_tracks) with a tolerance of tolerance_px pixels 
+# at the resolution of the map (map_km_per_pixel), so that a multi-year global map only draws the points that can be seen (tolerance_px=0 keeps all the points). 
+# Storms with a single track point are drawn as points. ax is the (cartopy) axes to draw on; by default, the tracks are drawn on the current axes and shown 
+# (plt.show), while nothing is shown when ax is given (e.g. map_TC_tracks, render_figures).
+def plot_tracks_time_in_col(TCs_Dict,df_ctag='wind',df_title='',tag_TC_or_SH_FILT='TC',ax=None,tolerance_px=1):
+    show = ax is None
+    ax = plt.gca() if ax is None else ax
+    (arrays, offsets) = TC_track_arrays(TCs_Dict, keys=('lon','lat',df_ctag), tag_TC_or_SH_FILT=tag_TC_or_SH_FILT)
+    (lon, lat, value) = (arrays['lon'], arrays['lat'], arrays[df_ctag])
+    keep = simplify_tracks(lon, lat, offsets, tolerance_px*map_km_per_pixel(ax))
+    track = np.repeat(np.arange(len(offsets)-1), np.diff(offsets))[keep]
+    (lon, lat, value) = (lon[keep], lat[keep], value[keep])
+    # segments between consecutive points kept of the same storm; segments crossing the edge of the map are split there
+    a = np.flatnonzero(track[1:] == track[:-1])
+    b = a+1
+    lon0 = getattr(ax, 'projection', ccrs.PlateCarree()).proj4_params.get('lon_0', 0)
+    rel  = (lon-lon0+180) % 360 - 180
+    cut  = np.abs(rel[b]-rel[a]) > 180
+    side = np.sign(rel[a[cut]])
+    edge = lat[a[cut]] + (side*180-rel[a[cut]])/((rel[b[cut]]+side*360)-rel[a[cut]])*(lat[b[cut]]-lat[a[cut]])
+    seg_lon = np.concatenate((np.stack((lon[a[~cut]], lon[b[~cut]]), axis=1), np.stack((lon[a[cut]], lon0+side*180), axis=1), 
+                              np.stack((lon0-side*180, lon[b[cut]]), axis=1)))
+    seg_lat = np.concatenate((np.stack((lat[a[~cut]], lat[b[~cut]]), axis=1), np.stack((lat[a[cut]], edge), axis=1), 
+                              np.stack((edge, lat[b[cut]]), axis=1)))
+    seg_value = np.concatenate((value[a[~cut]], value[a[cut]], value[a[cut]]))
+    alone = np.flatnonzero(np.diff(offsets) == 1)
+    (alone_lon, alone_lat) = (arrays['lon'][offsets[alone]], arrays['lat'][offsets[alone]])
+    # positions are projected once, and drawn in the coordinates of the map
+    if hasattr(ax, 'projection'):
+        xy = ax.projection.transform_points(ccrs.PlateCarree(), np.concatenate((seg_lon.ravel(), alone_lon)), np.concatenate((seg_lat.ravel(), alone_lat)))
+        (x, y) = (xy[:,0], xy[:,1])
+    else:
+        (x, y) = (np.concatenate((seg_lon.ravel(), alone_lon)), np.concatenate((seg_lat.ravel(), alone_lat)))
+    n = seg_lon.size
+    values = np.concatenate((value, arrays[df_ctag][offsets[alone]]))
+    norm = matplotlib.colors.Normalize(np.nanmin(values), np.nanmax(values)) if np.isfinite(values).any() else None
+    lc = LineCollection(np.stack((x[0:n], y[0:n]), axis=1).reshape(-1,2,2), array=seg_value, cmap='viridis', norm=norm, linewidths=1.5)
+    ax.add_collection(lc, autolim=not hasattr(ax, 'projection'))
+    if len(alone) > 0:
+        ax.scatter(x[n:], y[n:], s=5, c=arrays[df_ctag][offsets[alone]], cmap='viridis', norm=norm)
+    if not hasattr(ax, 'projection'):
+        ax.autoscale_view()
+    trace_count('plot.track_segments', len(seg_value))
+    cb = ax.figure.colorbar(lc,ax=ax,orientation='vertical',fraction=0.03,pad=0.02)
+    cb.ax.tick_params(labelsize=15)
+    cb.set_label('maximum sustained winds, knots', fontsize=16)
+    tt = ax.set_title(df_title,fontsize=24)
+    if show:
+        plt.show()
+
+
+# **map_km_per_pixel**
+# 
+# Approximate size of a pixel of the axes 'ax' in km (at the equator), from the width of the map in data coordinates and in pixels: 
+# the tolerance used to simplify tracks for that map.
+def map_km_per_pixel(ax):
+    width_px = ax.get_window_extent().width
+    (x0, x1) = ax.get_xlim()
+    if hasattr(ax, 'projection'):
+        # the projection spans 360 degrees of longitude at the equator
+        km_per_unit = 2*np.pi*EARTH_RADIUS_KM/(ax.projection.x_limits[1]-ax.projection.x_limits[0])
+    else:
+        km_per_unit = 2*np.pi*EARTH_RADIUS_KM/360 # degrees
+    return abs(x1-x0)*km_per_unit/max(width_px, 1)
+
+
+# **map_TC_tracks**
+# 
+# Global map (Mollweide projection) of the tracks in 'TCs_Dict', as made by TC_and_storms_view (see plot_tracks_time_in_col for the arguments).
+@traced('plot.tracks')
+def map_TC_tracks(TCs_Dict,df_ctag='wind',df_title='',tag_TC_or_SH_FILT='TC'):
+    fig = plt.figure(figsize=(15,15))
+    ax = plt.axes(projection=ccrs.Mollweide())
+    gl = ax.gridlines(draw_labels=True,color='black')
+    gl.xlabels_top = False
+    gl.ylabels_right = False
+    gl.xformatter = LONGITUDE_FORMATTER
+    gl.yformatter = LATITUDE_FORMATTER
+    ax.stock_img()
+    plot_tracks_time_in_col(TCs_Dict,df_ctag,df_title,tag_TC_or_SH_FILT,ax=ax)
+    plt.show()
+    return fig
+
+# **map_features**
+# 
+# Cartopy features used in the maps (coastlines, land and ocean), created once and shared by all the maps.
+@functools.lru_cache(maxsize=None)
+def map_features():
+    coastline = cft.NaturalEarthFeature('physical', 'coastline', cft.auto_scaler, edgecolor='black', facecolor='never')
+    return (coastline, cft.LAND, cft.OCEAN)
+
+
+# **draw_TC_map**
+# 
+# Draw the map of the TC track in 'df' (output of get_track_for_storm) on the figure 'fig' and cartopy axes 'ax' (PlateCarree projection). 
+# Profiles in prof_beforeTC and prof_afterTC (output of colocate_TC_and_Argo), if given, are added to the map (in magenta).
+@traced('plot.map')
+def draw_TC_map(fig,ax,df,dx_buffer=5,dy_buffer=5,font_size=20,prof_beforeTC=None,prof_afterTC=None):
+    gl = ax.gridlines(draw_labels=True,color='black')
+    gl.xlabels_top = False
+    gl.ylabels_right = False
+    gl.xlabel_style = {'size': font_size}
+    gl.ylabel_style = {'size': font_size}
+    gl.xformatter = LONGITUDE_FORMATTER
+    gl.yformatter = LATITUDE_FORMATTER
+    for feature in map_features():
+        ax.add_feature(feature)
+    im = ax.scatter(df['lon'],df['lat'],transform=ccrs.PlateCarree(),s=2000,marker=hurricane_marker(),
+                c=df['wind'], facecolors='none', linewidth=3.5)
+    cb = fig.colorbar(im,ax=ax,orientation='vertical',fraction=0.03,pad=0.02)
+    cb.ax.tick_params(labelsize=15)
+    cb.set_label('maximum sustained winds, knots', fontsize=16)
+    ax.set_extent([min(df['lon'])-dx_buffer, max(df['lon'])+dx_buffer,
+                   min(df['lat'])-dy_buffer, max(df['lat'])+dy_buffer,], crs=ccrs.PlateCarree())
+    if prof_beforeTC is None and prof_afterTC is None:
+        return
+    col='magenta'
+    mrkr = '*'
+    # each profile is plotted once, even when co-located with several track points
+    groups = {}
+    for x in (prof_beforeTC or [])+(prof_afterTC or []):
+        if any(x):
+            groups.update(x)
+    for tag_id in groups:
+        ax.plot(groups[tag_id]['lon'][0],groups[tag_id]['lat'][0],mrkr,transform=ccrs.Geodetic(),markersize=15,linewidth=4,color=col)
+        ax.text(groups[tag_id]['lon'][0]+.25, groups[tag_id]['lat'][0], tag_id,transform=ccrs.Geodetic(),color=col)
+    ax.set_title('Tropical Cyclone track and location of Argo profiles (magenta)',fontsize=20)
+
+
+# **map_TC**
+
+# Map of the TC track. TC track info is stored in the dataframe 'df' (which is output of get_track_for_storm)
+def map_TC(df,printing=False,printing_flag='',dx_buffer = 5,dy_buffer = 5,font_size=20):
+    fig = plt.figure(figsize=(15,15))
+    ax = plt.axes(projection=ccrs.PlateCarree()) #Mollweide
+    draw_TC_map(fig,ax,df,dx_buffer=dx_buffer,dy_buffer=dy_buffer,font_size=font_size)
+    
+    if printing:
+        plt.show()
+        fig.savefig('./Figures/'+printing_flag+'_map.png')
+                
+    return fig
+
+# **map_TC_and_Argo**
+
+# Co-locate Argo profiles along TC track and map location of profiles and TC track. TC track info is stored in the dataframe 'df' (which is output of get_track_for_storm)
+# 
+# Profiles are co-located with colocate_TC_and_Argo (which can be used without making the map).
+def map_TC_and_Argo(df, delta_days, dx, dy, presRange,printing=False,printing_flag='',font_size=20):
+    prof_beforeTC,prof_afterTC = colocate_TC_and_Argo(df, delta_days, dx, dy, presRange)
+    fig = plt.figure(figsize=(15,15))
+    ax = plt.axes(projection=ccrs.PlateCarree()) #Mollweide
+    draw_TC_map(fig,ax,df,font_size=font_size,prof_beforeTC=prof_beforeTC,prof_afterTC=prof_afterTC)
+    plt.show()
+    if printing:
+        fig.savefig('./Figures/'+printing_flag+'_map.png')
+                
+    return prof_beforeTC,prof_afterTC
+
+
+# #### Argo profiles visualization functions
+# ---
+
+# **plot_prof**
+# 
+# This function plots Argo float profiles.
+# 
+# dataX is an array vector containing the profile variable. E.g. temperature (df['temp'])  or salinity (df['sal']) at each pressure level from the output of parse_into_df_plev ('df').
+# 
+# dataY is an array vector containing the profile pressure levels (df['pres']) from the output of  parse_into_df_plev ('df').
+# 
+# xlab, ylab are the labels for each axis (e.g. xlab = 'Temperature, degC' and ylab=''Pressure, dbar').
+# 
+# xlim and ylim define the x and y axes limits. If xlim=[], the axis is adjusted automatically to fit the data range, otherwise specified as xlim=[min value, max value]. E.g. xlim=[22,30] for temperature. 
+# 
+# ylim =[presRange], where presRange=[min value, max_vale]. E.g. presRange=[0,100].
+# 
+# label sets the label for the plot legend (e.g. label='before' for before TC profiles).
+# 
+# col sets the color for the profile based on wether the profile was recorded before or after the TC's passage. E.g. col='k' , for black if the profile was recorded before the TC.
+# 
+# ax sets the axes to plot on (default: current axes).
+def plot_prof(dataX,dataY,xlab,ylab,xlim,ylim,label,col,ax=None):
+    if ax is None:
+        ax = plt.gca()
+    ax.plot(dataX,dataY,label=label,color=col,linewidth=5)
+    ax.set_xlabel(xlab,fontsize=24)
+    ax.set_ylabel(ylab,fontsize=24)
+    ax.set_ylim(ylim)
+    if xlim:
+        ax.set_xlim(xlim)
+    ax.invert_yaxis()
+    for tick in ax.xaxis.get_majorticklabels():  # example for xaxis
+        tick.set_fontsize(24) 
+    for tick in ax.yaxis.get_majorticklabels():  # example for xaxis
+        tick.set_fontsize(24) 
+    return
+
+
+# **draw_prof_pair**
+# 
+# Plot temperature and salinity profiles before (x) and after (y) the TC, i.e. one item of each of the two lists prof_beforeTC, prof_afterTC, on the figure 'fig' 
+# (two panels, see plot_prof_pairs). If verbose=True, the ID of each profile is printed.
+@traced('plot.prof_pair')
+def draw_prof_pair(fig,x,y,presRange=[0,100],verbose=True):
+    for (panel, var, xlab, title) in ((121, 'temp', 'Temperature, degC', 'Temperature profiles'), (122, 'psal', 'Salinity, psu', 'Salinity profiles')):
+        ax = fig.add_subplot(panel)
+        for (profiles, when, col, col_name) in ((x, 'before', 'k', 'black'), (y, 'after', 'r', 'red')):
+            for d in profiles.keys():
+                if verbose:
+                    print(title.split()[0]+', '+when+' ('+col_name+'): ' + d)
+                try:
+                    plot_prof(dataX=profiles[d][var],dataY=profiles[d]['pres'],xlab=xlab,ylab='Pressure, dbar',xlim=[],ylim=presRange,label=when,col=col,ax=ax)
+                except KeyError:
+                    pass # some profiles have no salinity
+        ax.set_title(title,fontsize=24)
+        ax.legend(fontsize=18)
+
+
+# **plot_prof_pairs**
+
+# Print ID (i.e. platformNumber_cycleNumber) of oceanic profiles in each item of two lists (prof_beforeTC,prof_afterTC), when the item (i.e. the item that corresponds to a certain index) has profiles in both lists. This function was build to plot profiles before the TC in red and after in black, i.e. when the two lists are indeed for profiles before/after the TC, the plot is done only for locations along the tropical cyclone track of interest where co-located oceanic profiles (stored in prof_beforeTC,prof_afterTC for the TC of interest) are available both before and after the cyclone.
+def plot_prof_pairs(prof_beforeTC,prof_afterTC,presRange=[0,100]):
+    for x,y in zip(prof_beforeTC,prof_afterTC):
+        if any(x) and any(y):
+            print('-------------')
+            fig = plt.figure(figsize=(30,10))
+            draw_prof_pair(fig,x,y,presRange)
+            plt.show()
+
+
+# function to plot the profiles (on the axes 'ax', default: current axes)
+@traced('plot.make_plot')
+def make_plot(b,a,b_tag,a_tag,x_tag,b_yax,a_yax,y_tag,y_lim,title_plot,font_size=20,ax=None):
+    if ax is None:
+        ax = plt.gca()
+    b_mask = (b_yax>=min(y_lim)) & (b_yax<=max(y_lim))
+    a_mask = (a_yax>=min(y_lim)) & (a_yax<=max(y_lim))
+    if 'QC' not in x_tag:
+        ax.plot(b[b_mask],b_yax[b_mask],linewidth=3,color='k',marker='*',label=b_tag)
+        ax.plot(a[a_mask],a_yax[a_mask],linewidth=3,color='r',marker='*',label=a_tag)
+    else:
+        ax.plot(b[b_mask],b_yax[b_mask],linewidth=0,color='k',marker='*',label=b_tag)
+        ax.plot(a[a_mask],a_yax[a_mask],linewidth=0,color='r',marker='*',label=a_tag)
+    ax.set_title(title_plot,fontsize=font_size)
+    ax.set_xlabel(x_tag,fontsize=font_size)
+    ax.set_ylabel(y_tag,fontsize=font_size)
+    ax.set_ylim(y_lim)
+    ax.invert_yaxis()
+    ax.legend(fontsize=font_size*.8)
+    
+    for tick in ax.xaxis.get_majorticklabels():  # example for xaxis
+        tick.set_fontsize(font_size) 
+    for tick in ax.yaxis.get_majorticklabels():  # example for xaxis
+        tick.set_fontsize(font_size) 
+
+
+# **plot_bgc_var**
+# 
+# Plot the profiles of the BGC variable bgc_name (e.g. 'chla', 'doxy') for the profiles flagged with containsBGC in bgc_dict (one item of prof_beforeTC or prof_afterTC), 
+# on the axes 'ax' (default: current axes). 'bgc' is the output of load_bgc_profiles for these profiles (e.g. loaded once for all the pairs of a storm); 
+# if bgc=None, the profiles of bgc_dict are loaded here. Returns True if at least one profile was plotted.
+def plot_bgc_var(bgc_dict,bgc_name,prof_lab,prof_col,presRange=[0,100],bgc=None,ax=None):
+    if bgc is None:
+        bgc = load_bgc_profiles(bgc_profile_ids([bgc_dict]))
+    with_var = set(bgc_profiles_with(bgc, bgc_name))
+    plot_status = False
+    for prf in bgc_dict.keys():
+        if 'containsBGC' in bgc_dict[prf].keys() and prf in with_var:
+            profile = bgc_profile(bgc, prf)
+            print(bgc_name+', '+prof_lab+' ('+prof_col+'): ' + prf)
+            plot_prof(dataX=profile[bgc_name],dataY=profile['pres'],xlab=bgc_name,ylab='Pressure, dbar',xlim=[],
+                      ylim=presRange,label=prof_lab,col=prof_col,ax=ax)
+            plot_status = True
+    return plot_status
+
+# ### Batch rendering functions
+# ---
+# Figures for many storms or pairs can be rendered without a display and in parallel with render_figures: each figure is drawn on an explicit 
+# matplotlib Figure with the Agg canvas (no pyplot state), in a pool of processes, and saved to ./Figures/. Cartopy features (map_features) and the 
+# hurricane marker are created once per process.
+# 
+# A job is a tuple (kind, filename, arguments), where kind is a key of FIGURE_BUILDERS and arguments is a dictionary of arguments for the builder, e.g. 
+# ('map_TC', 'AL152017_map.png', {'df': df}). prof_pairs_jobs makes the jobs for all the pairs of a storm.
+
+# **new_figure**
+# 
+# A matplotlib Figure attached to an Agg canvas (not managed by pyplot, hence not shown and freed as soon as it is not used).
+def new_figure(figsize):
+    fig = matplotlib.figure.Figure(figsize=figsize)
+    FigureCanvasAgg(fig)
+    return fig
+
+# **build_map_TC**, **build_prof_pair**, **build_make_plot**
+# 
+# Figure builders for render_figures: the map of a TC track (with co-located profiles if prof_beforeTC/prof_afterTC are given, as map_TC_and_Argo), 
+# the temperature and salinity profiles of one pair (as plot_prof_pairs) and make_plot panels.
+def build_map_TC(df,dx_buffer=5,dy_buffer=5,font_size=20,prof_beforeTC=None,prof_afterTC=None):
+    fig = new_figure((15,15))
+    ax = fig.add_subplot(projection=ccrs.PlateCarree())
+    draw_TC_map(fig,ax,df,dx_buffer=dx_buffer,dy_buffer=dy_buffer,font_size=font_size,prof_beforeTC=prof_beforeTC,prof_afterTC=prof_afterTC)
+    return fig
+
+def build_prof_pair(x,y,presRange=[0,100]):
+    fig = new_figure((30,10))
+    draw_prof_pair(fig,x,y,presRange,verbose=False)
+    return fig
+
+# panels is a list of dictionaries of make_plot arguments, plotted side by side.
+def build_make_plot(panels,figsize=None):
+    fig = new_figure(figsize or (7.5*len(panels),7.5))
+    for (i, panel) in enumerate(panels):
+        make_plot(ax=fig.add_subplot(1,len(panels),i+1), **panel)
+    return fig
+
+FIGURE_BUILDERS = {'map_TC':          build_map_TC,
+                   'map_TC_and_Argo': build_map_TC,
+                   'prof_pair':       build_prof_pair,
+                   'make_plot':       build_make_plot}
+
+
+# **prof_pairs_jobs**
+# 
+# Jobs (see render_figures) for the profile pairs of a storm (prof_beforeTC, prof_afterTC from colocate_TC_and_Argo), one figure per track point 
+# with profiles both before and after the TC, saved as printing_flag+'_prof'+number+'.png'.
+def prof_pairs_jobs(prof_beforeTC,prof_afterTC,presRange=[0,100],printing_flag=''):
+    jobs = []
+    for x,y in zip(prof_beforeTC,prof_afterTC):
+        if any(x) and any(y):
+            jobs.append(('prof_pair', printing_flag+'_prof'+str(len(jobs)+1).zfill(2)+'.png', {'x': x, 'y': y, 'presRange': presRange}))
+    return jobs
+
+
+def _render_init(set_backend=True):
+    if set_backend:
+        matplotlib.use('Agg')
+    # read the geometries of the features and create the marker once per process
+    hurricane_marker()
+    try:
+        for feature in map_features():
+            list(feature.geometries())
+    except Exception:
+        pass # e.g. Natural Earth files not available, reported for each map by _render_job
+
+def _render_job(job,out_dir='./Figures/',dpi=100):
+    (kind, filename, kwargs) = job
+    start = time.perf_counter()
+    try:
+        fig = FIGURE_BUILDERS[kind](**kwargs)
+        fig.savefig(os.path.join(out_dir, filename), dpi=dpi)
+        error = ''
+    except Exception as err:
+        error = '{}: {}'.format(type(err).__name__, err)
+    return {'filename': filename, 'kind': kind, 'seconds': time.perf_counter()-start, 'error': error}
+
+
+# **render_figures**
+# 
+# Render the figures for a list of jobs in a pool of 'processes' processes (default: number of CPUs; processes=1 renders in the current process) 
+# and save them in out_dir. Returns a data frame with the time spent on each figure ('seconds') and the error message for figures that failed ('error').
+def render_figures(jobs,processes=None,out_dir='./Figures/',dpi=100):
+    os.makedirs(out_dir, exist_ok=True)
+    render = functools.partial(_render_job, out_dir=out_dir, dpi=dpi)
+    start = time.perf_counter()
+    if processes == 1 or len(jobs) <= 1:
+        _render_init(set_backend=False)
+        results = [render(job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=processes, initializer=_render_init) as pool:
+            results = list(pool.map(render, jobs))
+    report = pd.DataFrame(results, columns=['filename','kind','seconds','error'])
+    # figures rendered in other processes are added to the timers and counters of this process
+    for result in results:
+        trace_time('render.'+result['kind'], result['seconds'])
+        trace_count('figures.failed' if result['error'] else 'figures.rendered')
+    print('{} figures rendered in {:.1f} s ({:.1f} s per figure, {} failed)'.format(
+        len(report), time.perf_counter()-start, report['seconds'].mean() if len(report) else 0, (report['error'] != '').sum()))
+    return report